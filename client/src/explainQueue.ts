@@ -27,6 +27,8 @@ export function requestExplanation(element: HTMLElement, params: ExplainProps) {
 }
 
 const BOTTOM_BOUNDARY = 0;
+// Max number of results to explain in one request
+const EXPLAIN_BATCH_SIZE = 10;
 
 let explaining = false;
 
@@ -55,8 +57,11 @@ function explainTopOfQueue() {
     return rect1B - rect2B;
   });
 
-  while (sortedQueue.length > 0) {
-    const [element, key] = sortedQueue.shift()!;
+  // Explain the visible results for the same queries and preferences together
+  const batch: string[] = [];
+  let batchQuery: string | null = null;
+  const remaining: [HTMLElement, string][] = [];
+  for (const [element, key] of sortedQueue) {
     if (
       element == null ||
       element.getBoundingClientRect().bottom < BOTTOM_BOUNDARY
@@ -64,8 +69,51 @@ function explainTopOfQueue() {
       continue;
     }
 
-    explain(key);
-    return;
+    const { queries, preferences } = JSON.parse(key) as ExplainProps;
+    const query = JSON.stringify({ queries, preferences });
+    if (
+      batch.length < EXPLAIN_BATCH_SIZE &&
+      (batchQuery == null || query === batchQuery)
+    ) {
+      batchQuery = query;
+      batch.push(key);
+    } else {
+      remaining.push([element, key]);
+    }
+  }
+  explanationQueue.splice(0, explanationQueue.length, ...remaining);
+
+  if (batch.length > 0) {
+    explainBatch(batch);
+  }
+}
+
+async function explainBatch(keys: string[]) {
+  explaining = true;
+  try {
+    const params = keys.map((key) => JSON.parse(key) as ExplainProps);
+    const { queries, preferences } = params[0];
+    const request = await fetch("/api/explain", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({
+        queries,
+        preferences,
+        results: params.map(({ filename, offset }) => ({ filename, offset })),
+      }),
+    });
+    const highlights: Highlight[][] = await request.json();
+
+    explainDictionary.update((dict) => {
+      keys.forEach((key, i) => {
+        dict[key] = highlights[i];
+      });
+      return dict;
+    });
+  } finally {
+    explaining = false;
   }
 }
 
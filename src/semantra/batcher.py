@@ -0,0 +1,126 @@
+import numpy as np
+
+from models import as_numpy
+from util import write_embeddings
+
+
+class EmbeddingSink:
+    """Receives the embeddings of one window configuration of one document.
+
+    Embeddings are stored into the in-memory `embeddings` array starting at
+    `embedding_index` and appended to the `.embeddings` file in order. The
+    file is only open while a batch is being appended, so no handle is left
+    behind if the document fails. Once `finish` has been called and every
+    queued window has been embedded, `on_complete` is called with the
+    embeddings array and the sink is marked `complete`. Without an
+    `embeddings` array, embeddings are only written to the file.
+    """
+
+    def __init__(self, filename, embeddings, embedding_index, on_complete=None):
+        self.filename = filename
+        # Create the file up front, as readers expect it to exist
+        open(filename, "ab").close()
+        self.embeddings = embeddings
+        self.embedding_index = embedding_index
+        self.on_complete = on_complete
+        self.num_pending = 0
+        self.finished = False
+        self.complete = False
+
+    def write(self, embedding_results):
+        count = len(embedding_results)
+        if self.embeddings is None:
+            sink_embeddings = embedding_results
+        else:
+            sink_embeddings = self.embeddings[
+                self.embedding_index : self.embedding_index + count
+            ]
+            sink_embeddings[:] = embedding_results
+        with open(self.filename, "ab") as f:
+            write_embeddings(f, sink_embeddings)
+        self.embedding_index += count
+        self.num_pending -= count
+        self.complete_if_done()
+
+    def get_embeddings(self):
+        # Embeddings calculated so far, or None once the sink is complete
+        embeddings = self.embeddings
+        if embeddings is None:
+            return None
+        return embeddings[: self.embedding_index]
+
+    def finish(self):
+        self.finished = True
+        self.complete_if_done()
+
+    def complete_if_done(self):
+        if self.finished and self.num_pending == 0 and not self.complete:
+            if self.on_complete is not None:
+                self.on_complete(self.embeddings)
+            self.complete = True
+            # Embeddings are loaded from the file from now on
+            self.embeddings = None
+
+
+class EmbeddingBatcher:
+    """Packs pending windows from many documents into full model batches.
+
+    Windows are queued with the sink their embeddings belong to and embedded
+    together once the queue reaches `pool_size` tokens or `pool_count`
+    windows, so many small documents share full batches instead of each
+    issuing their own underfilled `model.embed` calls. Windows found in the
+    optional chunk cache are not embedded again.
+    """
+
+    def __init__(self, model, pool_size, pool_count=None, chunk_cache=None):
+        self.model = model
+        self.pool_size = pool_size
+        self.pool_count = pool_count
+        self.chunk_cache = chunk_cache
+        self.pool = []
+        self.pool_token_count = 0
+
+    def add(self, sink, tokens, offset):
+        sink.num_pending += 1
+        self.pool.append((sink, tokens, offset))
+        self.pool_token_count += offset[1] - offset[0]
+        if (
+            self.pool_count is not None and len(self.pool) >= self.pool_count
+        ) or self.pool_token_count >= self.pool_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pool) == 0:
+            return
+        pool = self.pool
+        self.pool = []
+        self.pool_token_count = 0
+
+        embedding_results = self.embed([(tokens, offset) for _, tokens, offset in pool])
+
+        # Route each consecutive run of results back to its sink
+        start = 0
+        while start < len(pool):
+            sink = pool[start][0]
+            end = start + 1
+            while end < len(pool) and pool[end][0] is sink:
+                end += 1
+            sink.write(embedding_results[start:end])
+            start = end
+
+    def embed(self, items):
+        if self.chunk_cache is None:
+            return as_numpy(self.model.embed_batch(items))
+
+        # Only embed windows (once each) that aren't already in the cache
+        keys = [self.chunk_cache.get_key(tokens, offset) for tokens, offset in items]
+        cached = self.chunk_cache.get_many(keys)
+        missing = {}
+        for item, key in zip(items, keys):
+            if key not in cached and key not in missing:
+                missing[key] = item
+        if len(missing) > 0:
+            missing_results = as_numpy(self.model.embed_batch(list(missing.values())))
+            self.chunk_cache.put_many(list(missing.keys()), missing_results)
+            cached.update(zip(missing.keys(), missing_results))
+        return np.array([cached[key] for key in keys], dtype=np.float32)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import sqlite3
+import time
+from threading import Lock
+
+import numpy as np
+
+from util import HASH_LENGTH
+
+
+class ChunkEmbeddingCache:
+    """Persistent cache of window embeddings keyed by their token content.
+
+    Keys combine a hash of the model config with a hash of the window's
+    tokens, so identical windows are only embedded once across documents,
+    revisions and re-uploads. Entries live in an SQLite database as raw
+    float32 blobs and the least recently used ones are evicted beyond
+    `max_entries`.
+    """
+
+    def __init__(self, filename, model, max_entries=None):
+        self.model = model
+        self.num_dimensions = model.get_num_dimensions()
+        self.config_hash = hashlib.shake_256(
+            json.dumps(model.get_config()).encode()
+        ).digest(HASH_LENGTH)
+        self.max_entries = max_entries
+        self.filename = filename
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key BLOB PRIMARY KEY, embedding BLOB, last_used REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+                "ON embeddings (last_used)"
+            )
+
+    def get_key(self, tokens, offset):
+        return hashlib.blake2b(
+            self.config_hash + self.model.get_window_bytes(tokens, offset),
+            digest_size=16,
+        ).digest()
+
+    def get_many(self, keys):
+        # Return a dict of the cached embeddings found for the given keys
+        found = {}
+        unique_keys = list(set(keys))
+        with self.lock:
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i : i + 500]
+                rows = self.db.execute(
+                    "SELECT key, embedding FROM embeddings WHERE key IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for key, embedding in rows:
+                    found[key] = np.frombuffer(embedding, dtype=np.float32)
+            if len(found) > 0:
+                now = time.time()
+                with self.db:
+                    self.db.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(now, key) for key in found],
+                    )
+        return found
+
+    def put_many(self, keys, embeddings):
+        now = time.time()
+        rows = [
+            (key, np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for key, embedding in zip(keys, embeddings)
+        ]
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows
+            )
+            if self.max_entries is not None:
+                (num_entries,) = self.db.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()
+                if num_entries > self.max_entries:
+                    self.db.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM "
+                        "embeddings ORDER BY last_used LIMIT ?)",
+                        (num_entries - self.max_entries,),
+                    )
+
+    def reopen(self):
+        # SQLite connections must not be used across a fork, so forked
+        # processes open their own, leaving the parent's untouched
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,162 @@
+import json
+import mmap
+import os
+
+import numpy as np
+
+from util import safe_remove
+
+
+def get_token_ids_filename(filename):
+    # Token ids of the chunks, next to their text, e.g. "<md5>.<hash>.chunks.ids"
+    return f"{os.path.splitext(filename)[0]}.ids"
+
+
+def encode_chunks(text_chunks):
+    # Lone surrogates can't be encoded strictly, but must round-trip
+    return [chunk.encode("utf-8", errors="surrogatepass") for chunk in text_chunks]
+
+
+class ChunkStoreWriter:
+    """Writes text chunks to a chunk store incrementally.
+
+    The UTF-8 text of the chunks is appended to one file and the uint64 byte
+    offset of the end of each chunk to another. The uint32 model token id of
+    each chunk goes to a third file, if every chunk came with one. All are
+    written under temporary names and only moved into place by `close`, so
+    an interrupted write never leaves a partial store behind.
+    """
+
+    def __init__(self, filename, offsets_filename):
+        self.filename = filename
+        self.offsets_filename = offsets_filename
+        self.token_ids_filename = get_token_ids_filename(filename)
+        self.text_file = open(f"{filename}.tmp", "wb")
+        self.offsets_file = open(f"{offsets_filename}.tmp", "wb")
+        self.token_ids_file = open(f"{self.token_ids_filename}.tmp", "wb")
+        self.has_token_ids = True
+        self.size = 0
+        self.offsets_file.write(np.zeros(1, dtype="<u8").tobytes())
+
+    def append(self, text_chunks, token_ids=None):
+        encoded_chunks = encode_chunks(text_chunks)
+        ends = self.size + np.cumsum(
+            [len(chunk) for chunk in encoded_chunks], dtype="<u8"
+        )
+        self.text_file.write(b"".join(encoded_chunks))
+        self.offsets_file.write(ends.tobytes())
+        if len(ends) > 0:
+            self.size = int(ends[-1])
+        if token_ids is None:
+            self.has_token_ids = False
+        elif self.has_token_ids:
+            self.token_ids_file.write(np.asarray(token_ids, dtype="<u4").tobytes())
+
+    def close(self):
+        self.text_file.close()
+        self.offsets_file.close()
+        self.token_ids_file.close()
+        os.replace(self.text_file.name, self.filename)
+        os.replace(self.offsets_file.name, self.offsets_filename)
+        if self.has_token_ids:
+            os.replace(self.token_ids_file.name, self.token_ids_filename)
+        else:
+            # Don't leave the token ids of a previous store behind
+            safe_remove(self.token_ids_file.name)
+            safe_remove(self.token_ids_filename)
+
+    def abort(self):
+        self.text_file.close()
+        self.offsets_file.close()
+        self.token_ids_file.close()
+        safe_remove(self.text_file.name)
+        safe_remove(self.offsets_file.name)
+        safe_remove(self.token_ids_file.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_chunk_store(filename, offsets_filename, text_chunks, token_ids=None):
+    with ChunkStoreWriter(filename, offsets_filename) as writer:
+        writer.append(text_chunks, token_ids)
+
+
+def migrate_tokens_json(tokens_filename, filename, offsets_filename):
+    # Convert the JSON list of text chunks written by older versions
+    with open(tokens_filename, "r") as f:
+        text_chunks = json.loads(f.read())
+    write_chunk_store(filename, offsets_filename, text_chunks)
+    safe_remove(tokens_filename)
+
+
+class ChunkStore:
+    """Memory-mapped text chunks of a document.
+
+    Behaves like the list of text chunks it was written from, but `text`
+    decodes the joined text of a range of chunks straight from the mapped
+    bytes without materializing the chunks in between, and `token_ids` reads
+    the model token ids of a range of chunks.
+    """
+
+    def __init__(self, filename, offsets_filename):
+        self.offsets = np.fromfile(offsets_filename, dtype="<u8")
+        self.token_ids_filename = get_token_ids_filename(filename)
+        with open(filename, "rb") as f:
+            # Empty files can't be mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                self.buffer = b""
+            else:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def nbytes(self):
+        return len(self.buffer) + self.offsets.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, start, end):
+        start, end, _ = slice(start, end).indices(len(self))
+        if start >= end:
+            return ""
+        return self.buffer[self.offsets[start] : self.offsets[end]].decode(
+            "utf-8", errors="surrogatepass"
+        )
+
+    def token_ids(self, start, end):
+        # Stores written by older versions have no token ids
+        start, end, _ = slice(start, end).indices(len(self))
+        try:
+            return np.fromfile(
+                self.token_ids_filename,
+                dtype="<u4",
+                count=max(0, end - start),
+                offset=start * 4,
+            )
+        except FileNotFoundError:
+            return None
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(len(self))
+            if step != 1:
+                return self.tolist()[key]
+            return [self.text(i, i + 1) for i in range(start, end)]
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("chunk index out of range")
+        return self.text(key, key + 1)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def tolist(self):
+        return self[:]
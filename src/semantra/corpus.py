@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+from threading import Lock, RLock
+
+from util import LRUCache
+
+
+def get_resource_size(value):
+    # Estimate the resident size in bytes of a loaded document resource
+    return getattr(value, "nbytes", 0)
+
+
+class CorpusStore:
+    """Keeps loaded document resources resident for the server's lifetime.
+
+    Documents added to the store serve their embeddings (memory-mapped),
+    quantized embeddings, vector index and text chunks from memory instead of
+    reloading them from disk on every access. Once the combined size of the
+    loaded resources exceeds `memory_budget` bytes, the least recently used
+    ones are evicted and reloaded on demand. Memory held elsewhere on the
+    documents' behalf (e.g. the exact search matrix) can be counted against
+    the budget with `reserve`.
+    """
+
+    resources = [
+        "embeddings",
+        "quantized_embeddings",
+        "embedding_index",
+        "text_chunks",
+    ]
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self.cache = LRUCache(
+            max_size=memory_budget,
+            sizeof=lambda entry: entry[1],
+        )
+        self.reserved = {}
+        self.lock = Lock()
+
+    def reserve(self, name, nbytes):
+        # Shrink the budget left for loaded resources by the `nbytes` now
+        # held under `name`
+        with self.lock:
+            self.reserved[name] = nbytes
+            if self.memory_budget is not None:
+                self.cache.resize(
+                    max(0, self.memory_budget - sum(self.reserved.values()))
+                )
+
+    def add(self, document, warm=True):
+        document.store = self
+        if warm:
+            self.warm(document)
+
+    def warm(self, document):
+        # Load every resource the document will need to answer queries
+        for resource in self.resources:
+            if resource == "embedding_index" and not (
+                document.use_index and document.index_ready
+            ):
+                # Loaded on demand once the vector index is built
+                continue
+            if resource == "quantized_embeddings" and document.quantize is None:
+                continue
+            if resource == "embeddings" and document.quantize is not None:
+                # Searched through the quantized embeddings instead
+                continue
+            self.get(document, resource)
+
+    def remove(self, document):
+        for resource in self.resources:
+            self.cache.pop((document.filename, resource))
+        document.store = None
+
+    def get(self, document, resource):
+        key = (document.filename, resource)
+        entry = self.cache.get(key)
+        if entry is None:
+            value = getattr(document, f"load_{resource}")()
+            entry = (value, get_resource_size(value))
+            self.cache.put(key, entry)
+        return entry[0]
+
+    def clear(self):
+        self.cache.clear()
+
+    @property
+    def size(self):
+        return self.cache.size
+
+
+# Max number of document contents (e.g. open pdfium handles) kept open at once
+MAX_OPEN_CONTENTS = 32
+
+
+def close_content(content):
+    if hasattr(content, "close"):
+        content.close()
+
+
+class ContentRegistry:
+    """Opens the content of each document once to serve files and pages.
+
+    Contents are used under a lease, from `lease` (or `acquire` and
+    `release`). At most `max_open` contents stay in the registry; the least
+    recently used ones are dropped beyond that and reopened on demand, but
+    only closed once their last lease is released.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_CONTENTS):
+        self.cache = LRUCache(max_size=max_open, on_evict=self.retire)
+        # Reentrant, as opening a content can evict (and retire) another
+        self.lock = RLock()
+        # Number of leases of each content in use, and those to close once
+        # their last lease is released
+        self.leases = {}
+        self.retired = set()
+
+    def acquire(self, document):
+        with self.lock:
+            content = self.cache.get(document.filename)
+            if content is None:
+                content = document.open_content()
+                self.cache.put(document.filename, content)
+            self.leases[content] = self.leases.get(content, 0) + 1
+            return content
+
+    def retain(self, content):
+        # Take another lease of a content that is already leased
+        with self.lock:
+            self.leases[content] += 1
+
+    def release(self, content):
+        with self.lock:
+            self.leases[content] -= 1
+            if self.leases[content] > 0:
+                return
+            del self.leases[content]
+            if content not in self.retired:
+                return
+            self.retired.discard(content)
+        close_content(content)
+
+    @contextmanager
+    def lease(self, document):
+        content = self.acquire(document)
+        try:
+            yield content
+        finally:
+            self.release(content)
+
+    def retire(self, content):
+        # Close a content dropped from the registry, once nothing uses it
+        with self.lock:
+            if content in self.leases:
+                self.retired.add(content)
+                return
+        close_content(content)
+
+    def close(self, document):
+        content = self.cache.pop(document.filename)
+        if content is not None:
+            self.retire(content)
+
+    def close_all(self):
+        for filename in self.cache.keys():
+            content = self.cache.pop(filename)
+            if content is not None:
+                self.retire(content)
@@ -0,0 +1,193 @@
+import math
+
+import numpy as np
+
+from models import as_numpy
+from search import normalize_rows
+from util import LRUCache, join_text_chunks
+
+# Max megabytes of split embeddings to keep for explaining results again
+EXPLAIN_CACHE_SIZE = 64
+
+
+def get_splits(length, divide_factor, num_splits):
+    # Overlapping ranges of a result's text chunks to leave out in turn
+    window_length = math.ceil(length / divide_factor)
+    split_length = math.ceil(length / num_splits)
+    return [
+        (min(length, i * split_length), min(length, i * split_length + window_length))
+        for i in range(num_splits)
+    ]
+
+
+def get_highlights(text_chunks, splits):
+    # Text of the result with the given splits highlighted
+    highlights = []
+
+    def append(start, end, type):
+        if start >= end:
+            return
+        highlights.append(
+            {
+                "text": join_text_chunks(text_chunks[start:end]),
+                "type": type,
+            }
+        )
+
+    last_index = 0
+    for start, end in sorted(splits):
+        append(last_index, start, "normal")
+        append(max(start, last_index), end, "highlight")
+        last_index = end
+    append(last_index, len(text_chunks), "normal")
+    return highlights
+
+
+class ExplainEngine:
+    """Finds the parts of search results that match a query the most.
+
+    Each result is split into `split_count` overlapping parts, and embedded
+    with each part left out in turn; the `num_highlights` parts whose absence
+    lowers the similarity to the query the most are highlighted.
+
+    The windows leaving out each part are cut from the token ids stored with
+    the document's text chunks, so the windows of all results explained
+    together are embedded in a single batch without tokenizing them again. Their embeddings are cached by result, so
+    explaining a result again for another query only takes a dot product.
+    """
+
+    def __init__(
+        self,
+        model,
+        split_count,
+        split_divide,
+        num_highlights,
+        cache_size=EXPLAIN_CACHE_SIZE,
+    ):
+        self.model = model
+        self.split_count = split_count
+        self.split_divide = split_divide
+        self.num_highlights = num_highlights
+        self.cache = LRUCache(
+            max_size=cache_size * 1024 * 1024, sizeof=lambda value: value.nbytes
+        )
+
+    def get_split_windows(self, text_chunks, splits, token_ids):
+        # Windows of the result leaving out each split, as (tokens, offset)
+        # items, or None where nothing would be left. Each text chunk is one
+        # token, so the splits are ranges of the result's token ids
+        if token_ids is None:
+            return self.tokenize_split_windows(text_chunks, splits)
+        windows = []
+        for start, end in splits:
+            window_ids = np.concatenate([token_ids[:start], token_ids[end:]])
+            if len(window_ids) == 0:
+                windows.append(None)
+                continue
+            windows.append(
+                (self.model.get_tokens_from_ids(window_ids), (0, len(window_ids)))
+            )
+        return windows
+
+    def tokenize_split_windows(self, text_chunks, splits):
+        # Like get_split_windows, for documents whose token ids aren't stored
+        # (chunk stores of older versions): the result is tokenized again and
+        # its splits mapped to those tokens through their positions in the text
+        model = self.model
+        text = join_text_chunks(text_chunks)
+        tokens = model.get_tokens(text)
+        token_chunks = model.get_text_chunks(text, tokens)
+        num_tokens = len(token_chunks)
+        tokens = model.slice_tokens(tokens, 0, num_tokens)
+
+        token_lengths = np.array([len(chunk) for chunk in token_chunks], dtype=np.int64)
+        token_ends = np.cumsum(token_lengths)
+        token_starts = token_ends - token_lengths
+        chunk_ends = np.cumsum([0] + [len(chunk) for chunk in text_chunks])
+        starts, ends = np.array(splits, dtype=np.int64).T
+        token_split_starts = np.searchsorted(token_ends, chunk_ends[starts], "right")
+        token_split_ends = np.maximum(
+            token_split_starts,
+            np.searchsorted(token_starts, chunk_ends[ends], "left"),
+        )
+
+        windows = []
+        for start, end in zip(token_split_starts.tolist(), token_split_ends.tolist()):
+            length = start + num_tokens - end
+            if length == 0:
+                windows.append(None)
+                continue
+            window_tokens = model.concat_tokens(
+                model.slice_tokens(tokens, 0, start),
+                model.slice_tokens(tokens, end, num_tokens),
+            )
+            windows.append((window_tokens, (0, length)))
+        return windows
+
+    def embed_splits(self, results):
+        # Normalized embeddings of each result with each split left out
+        split_embeddings = [None] * len(results)
+        items = []
+        pending = []
+        for i, (key, text_chunks, splits, token_ids) in enumerate(results):
+            split_embeddings[i] = self.cache.get(key)
+            if split_embeddings[i] is None:
+                windows = self.get_split_windows(text_chunks, splits, token_ids)
+                pending.append((i, key, len(items), windows))
+                items.extend(window for window in windows if window is not None)
+
+        embeddings = None
+        if len(items) > 0:
+            embeddings = normalize_rows(
+                np.asarray(as_numpy(self.model.embed_batch(items)), dtype=np.float32)
+            )
+        for i, key, start, windows in pending:
+            # Nothing left to embed counts as no similarity at all
+            rows = np.zeros((len(windows), self.model.get_num_dimensions()), np.float32)
+            for row, window in enumerate(windows):
+                if window is not None:
+                    rows[row] = embeddings[start]
+                    start += 1
+            self.cache.put(key, rows)
+            split_embeddings[i] = rows
+        return split_embeddings
+
+    def explain(self, results, embedding):
+        """Explain why each `(document, offset)` result matches an embedding.
+
+        Returns the highlighted text of each result, in order.
+        """
+        prepared = []
+        for document, offset in results:
+            document_chunks = document.text_chunks
+            text_chunks = document_chunks[offset[0] : offset[1]]
+            token_ids = document_chunks.token_ids(offset[0], offset[1])
+            splits = get_splits(len(text_chunks), self.split_divide, self.split_count)
+            key = (document.md5, offset[0], offset[1])
+            prepared.append((key, text_chunks, splits, token_ids))
+
+        embeddable = [result for result in prepared if len(result[1]) > 0]
+        split_embeddings = dict(
+            zip(
+                [key for key, _, _, _ in embeddable],
+                self.embed_splits(embeddable),
+            )
+        )
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm > 0:
+            query = query / query_norm
+
+        explanations = []
+        for key, text_chunks, splits, _ in prepared:
+            if len(text_chunks) == 0:
+                explanations.append([])
+                continue
+            similarities = split_embeddings[key] @ query
+            # Leaving out the most relevant splits lowers the similarity most
+            order = np.argsort(similarities, kind="stable")[: self.num_highlights]
+            explanations.append(
+                get_highlights(text_chunks, [splits[index] for index in order])
+            )
+        return explanations
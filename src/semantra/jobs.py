@@ -0,0 +1,104 @@
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    """Background ingestion of one uploaded file."""
+
+    def __init__(self, filename, basename):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.basename = basename
+        # One of "queued", "running", "done" or "error"
+        self.status = "queued"
+        self.progress = 0
+        self.total = None
+        self.searchable = False
+        self.filetype = None
+        self.error = None
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error")
+
+    def update_progress(self, progress, total):
+        self.progress = progress
+        self.total = total
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "basename": self.basename,
+            "filename": self.filename,
+            "filetype": self.filetype,
+            "status": self.status,
+            "progress": self.progress,
+            "total": self.total,
+            "searchable": self.searchable,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """Runs jobs in the background on a bounded pool of threads.
+
+    At most `max_pending` jobs can be queued or running at once, beyond which
+    `submit` raises `JobQueueFull`. The most recent `max_finished` finished
+    jobs are kept around to be polled.
+    """
+
+    def __init__(self, max_workers=1, max_pending=64, max_finished=256):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.num_pending = 0
+
+    def submit(self, jobs, run):
+        # Queue either all of the jobs or none of them, to be run by `run(job)`
+        with self.lock:
+            if self.num_pending + len(jobs) > self.max_pending:
+                raise JobQueueFull(
+                    f"Too many files are being processed already (max {self.max_pending})"
+                )
+            self.num_pending += len(jobs)
+            for job in jobs:
+                self.jobs[job.id] = job
+        for job in jobs:
+            self.executor.submit(self.run, job, run)
+
+    def run(self, job, run):
+        job.status = "running"
+        try:
+            run(job)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            with self.lock:
+                self.num_pending -= 1
+                self.prune()
+
+    def prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -1,12 +1,12 @@
+import json
 import os
+import sys
 from abc import ABC, abstractmethod
 
 import numpy as np
-import openai
-import tiktoken
-import torch
 from dotenv import load_dotenv
-from transformers import AutoModel, AutoTokenizer
+
+from util import LRUCache
 
 load_dotenv(dotenv_path=os.path.join(os.getcwd(), ".env"))
 
@@ -16,30 +16,23 @@ sgpt_model_name = "Muennighoff/SGPT-125M-weightedmean-msmarco-specb-bitfit"
 sgpt_1_3B_model_name = "Muennighoff/SGPT-1.3B-weightedmean-msmarco-specb-bitfit"
 
 
-def mean_pooling(model_output, attention_mask):
-    token_embeddings = model_output[
-        0
-    ]  # First element of model_output contains all token embeddings
-    input_mask_expanded = (
-        attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-    )
-    sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1)
-    sum_mask = torch.clamp(input_mask_expanded.sum(1), min=1e-9)
-    return sum_embeddings / sum_mask
-
-
-def filter_none(x):
-    return [i for i in x if i is not None]
-
-
 def as_numpy(x):
-    # If x is a tensor, convert it to a numpy array
-    if isinstance(x, torch.Tensor):
+    # If x is a tensor, convert it to a numpy array. Tensors can only exist
+    # once torch has been imported by a model backend
+    torch = sys.modules.get("torch")
+    if torch is not None and isinstance(x, torch.Tensor):
         return x.cpu().numpy()
     return x
 
 
+# Number of query embeddings to keep cached per model
+QUERY_CACHE_SIZE = 1024
+
+
 class BaseModel(ABC):
+    def __init__(self, query_cache_size=QUERY_CACHE_SIZE):
+        self.query_cache = LRUCache(max_size=query_cache_size)
+
     @abstractmethod
     def get_num_dimensions(self) -> int:
         ...
@@ -61,16 +54,59 @@ class BaseModel(ABC):
         ...
 
     @abstractmethod
-    def embed(self, tokens, offsets, is_query: bool = False) -> "list[list[float]]":
+    def embed_batch(self, items, is_query: bool = False) -> "list[list[float]]":
+        """Embed a batch of `(tokens, (start, end))` windows in one call.
+
+        The windows may come from the tokens of different documents.
+        """
         ...
 
+    @abstractmethod
+    def get_window_bytes(self, tokens, offset) -> bytes:
+        """Serialize the token ids of a window, e.g. for hashing."""
+        ...
+
+    @abstractmethod
+    def get_token_ids(self, tokens) -> np.ndarray:
+        """Token ids of `tokens`, as a one-dimensional integer array."""
+        ...
+
+    @abstractmethod
+    def get_tokens_from_ids(self, token_ids):
+        """Tokens from an array of token ids, the inverse of `get_token_ids`."""
+        ...
+
+    def get_segment_tokens(self, text: str):
+        """Tokenize a segment of a longer text, without special tokens."""
+        return self.get_tokens(text)
+
+    @abstractmethod
+    def slice_tokens(self, tokens, start: int, end: int):
+        ...
+
+    @abstractmethod
+    def concat_tokens(self, tokens, other_tokens):
+        ...
+
+    def embed(self, tokens, offsets, is_query: bool = False) -> "list[list[float]]":
+        return self.embed_batch([(tokens, offset) for offset in offsets], is_query)
+
     def embed_document(self, document) -> "list[float]":
         tokens = self.get_tokens(document)
         return self.embed(tokens, [(0, self.get_token_length(tokens))], False)[0]
 
     def embed_query(self, query: str) -> "list[float]":
-        tokens = self.get_tokens(query)
-        return self.embed(tokens, [(0, self.get_token_length(tokens))], True)[0]
+        key = (json.dumps(self.get_config(), sort_keys=True), query, True)
+        embedding = self.query_cache.get(key)
+        if embedding is None:
+            tokens = self.get_tokens(query)
+            embedding = as_numpy(
+                self.embed(tokens, [(0, self.get_token_length(tokens))], True)[0]
+            )
+            # Cached embeddings are shared between requests
+            embedding.setflags(write=False)
+            self.query_cache.put(key, embedding)
+        return embedding
 
     def embed_queries(self, queries) -> "list[float]":
         all_embeddings = [
@@ -100,216 +136,18 @@ class BaseModel(ABC):
     def is_asymmetric(self):
         return False
 
+# Model backends are imported on first use, so that each preset only loads
+# the frameworks it needs
+def get_openai_model(**kwargs):
+    from openai_model import OpenAIModel
 
-class OpenAIModel(BaseModel):
-    def __init__(
-        self,
-        model_name="text-embedding-ada-002",
-        num_dimensions=1536,
-        tokenizer_name="cl100k_base",
-    ):
-        # Check if OpenAI API key is set
-        if "OPENAI_API_KEY" not in os.environ:
-            raise Exception(
-                "OpenAI API key not set. Please set the OPENAI_API_KEY environment variable or create a `.env` file with the key in the current working directory or the Semantra directory, which is revealed by running `semantra --show-semantra-dir`."
-            )
-        
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-
-        self.model_name = model_name
-        self.num_dimensions = num_dimensions
-        self.tokenizer = tiktoken.get_encoding(tokenizer_name)
-
-    def get_config(self):
-        return {
-            "model_type": "openai",
-            "model_name": self.model_name,
-            "tokenizer_name": self.tokenizer.name,
-        }
+    return OpenAIModel(**kwargs)
 
-    def get_num_dimensions(self) -> int:
-        return self.num_dimensions
 
-    def get_tokens(self, text: str):
-        return self.tokenizer.encode(text)
+def get_transformer_model(**kwargs):
+    from transformer_model import TransformerModel
 
-    def get_token_length(self, tokens) -> int:
-        return len(tokens)
-
-    def get_text_chunks(self, _: str, tokens) -> "list[str]":
-        return [self.tokenizer.decode([token]) for token in tokens]
-
-    def embed(self, tokens, offsets, _is_query=False) -> "list[list[float]]":
-        texts = [tokens[i:j] for i, j in offsets]
-        response = openai.Embedding.create(model=self.model_name, input=texts)
-        return np.array([data["embedding"] for data in response["data"]])
-
-
-def zero_if_none(x):
-    return 0 if x is None else x
-
-
-class TransformerModel(BaseModel):
-    def __init__(
-        self,
-        model_name,
-        doc_token_pre=None,
-        doc_token_post=None,
-        query_token_pre=None,
-        query_token_post=None,
-        asymmetric=False,
-        cuda=None,
-    ):
-        if cuda is None:
-            cuda = torch.cuda.is_available()
-        self.model_name = model_name
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModel.from_pretrained(model_name)
-
-        # Get tokens
-        self.pre_post_tokens = [
-            doc_token_pre,
-            doc_token_post,
-            query_token_pre,
-            query_token_post,
-        ]
-        self.doc_token_pre = (
-            self.tokenizer.encode(doc_token_pre, add_special_tokens=False)
-            if doc_token_pre
-            else None
-        )
-        self.doc_token_post = (
-            self.tokenizer.encode(doc_token_post, add_special_tokens=False)
-            if doc_token_post
-            else None
-        )
-        self.query_token_pre = (
-            self.tokenizer.encode(query_token_pre, add_special_tokens=False)
-            if query_token_pre
-            else None
-        )
-        self.query_token_post = (
-            self.tokenizer.encode(query_token_post, add_special_tokens=False)
-            if query_token_post
-            else None
-        )
-
-        self.asymmetric = asymmetric
-
-        self.cuda = cuda
-        if self.cuda:
-            self.model = self.model.cuda()
-
-    def get_config(self):
-        return {
-            "model_type": "transformers",
-            "model_name": self.model_name,
-            "doc_token_pre": self.pre_post_tokens[0],
-            "doc_token_post": self.pre_post_tokens[1],
-            "query_token_pre": self.pre_post_tokens[2],
-            "query_token_post": self.pre_post_tokens[3],
-            "asymmetric": self.asymmetric,
-        }
-
-    def is_asymmetric(self):
-        return self.asymmetric
-
-    def get_num_dimensions(self) -> int:
-        return int(self.model.config.hidden_size)
-
-    def get_tokens(self, text: str):
-        return self.tokenizer(
-            text, return_offsets_mapping=True, verbose=False, return_tensors="pt"
-        )
-
-    def get_token_length(self, tokens) -> int:
-        return len(tokens["input_ids"][0])
-
-    def get_text_chunks(self, text: str, tokens) -> "list[str]":
-        offsets = tokens["offset_mapping"][0]
-        chunks = []
-        prev_i = None
-        prev_j = None
-        for i, j in offsets:
-            new_i = prev_j if i == j else i
-            if prev_i is not None:
-                chunks.append(text[prev_i:new_i])
-            if prev_i is None:
-                prev_i = 0
-            elif new_i > prev_i:
-                prev_i = new_i
-            if prev_j is None:
-                prev_j = j
-            elif j > prev_j:
-                prev_j = j
-        chunks.append(text[0 if prev_i is None else prev_i :])
-        return chunks
-
-    def normalize_input_ids(self, input_ids, is_query):
-        if self.query_token_pre is None and self.query_token_post is None:
-            return input_ids
-        else:
-            token_pre = self.query_token_pre if is_query else self.doc_token_pre
-            token_post = self.query_token_post if is_query else self.doc_token_post
-            return torch.cat(
-                filter_none(
-                    [
-                        torch.tensor(token_pre) if token_pre is not None else None,
-                        input_ids,
-                        torch.tensor(token_post) if token_post is not None else None,
-                    ]
-                )
-            )
-
-    def normalize_attention_mask(self, attention_mask, is_query):
-        if self.query_token_pre is None and self.query_token_post is None:
-            return attention_mask
-        else:
-            token_pre = self.query_token_pre if is_query else self.doc_token_pre
-            token_post = self.query_token_post if is_query else self.doc_token_post
-            return torch.cat(
-                filter_none(
-                    [
-                        torch.ones(len(token_pre)) if token_pre is not None else None,
-                        attention_mask,
-                        torch.ones(len(token_post)) if token_post is not None else None,
-                    ]
-                )
-            )
-
-    def embed(self, tokens, offsets, is_query=False) -> "list[list[float]]":
-        input_ids = torch.nn.utils.rnn.pad_sequence(
-            [
-                self.normalize_input_ids(
-                    tokens["input_ids"][0].index_select(0, torch.tensor(range(i, j))),
-                    is_query,
-                )
-                for i, j in offsets
-            ],
-            batch_first=True,
-            padding_value=zero_if_none(self.tokenizer.pad_token_id),
-        )
-        attention_mask = torch.nn.utils.rnn.pad_sequence(
-            [
-                self.normalize_attention_mask(
-                    tokens["attention_mask"][0].index_select(
-                        0, torch.tensor(range(i, j))
-                    ),
-                    is_query,
-                )
-                for i, j in offsets
-            ],
-            batch_first=True,
-            padding_value=0,
-        )
-        if self.cuda:
-            input_ids = input_ids.cuda()
-            attention_mask = attention_mask.cuda()
-        with torch.no_grad():
-            model_output = self.model(
-                input_ids=input_ids, attention_mask=attention_mask
-            )
-        return mean_pooling(model_output, attention_mask)
+    return TransformerModel(**kwargs)
 
 
 models = {
@@ -317,7 +155,7 @@ models = {
         "cost_per_token": 0.0004 / 1000,
         "pool_size": 50000,
         "pool_count": 2000,
-        "get_model": lambda: OpenAIModel(
+        "get_model": lambda: get_openai_model(
             model_name="text-embedding-ada-002",
             num_dimensions=1536,
             tokenizer_name="cl100k_base",
@@ -326,17 +164,17 @@ models = {
     "minilm": {
         "cost_per_token": None,
         "pool_size": 50000,
-        "get_model": lambda: TransformerModel(model_name=minilm_model_name),
+        "get_model": lambda: get_transformer_model(model_name=minilm_model_name),
     },
     "mpnet": {
         "cost_per_token": None,
         "pool_size": 15000,
-        "get_model": lambda: TransformerModel(model_name=mpnet_model_name),
+        "get_model": lambda: get_transformer_model(model_name=mpnet_model_name),
     },
     "sgpt": {
         "cost_per_token": None,
         "pool_size": 10000,
-        "get_model": lambda: TransformerModel(
+        "get_model": lambda: get_transformer_model(
             model_name=sgpt_model_name,
             query_token_pre="[",
             query_token_post="]",
@@ -348,7 +186,7 @@ models = {
     "sgpt-1.3B": {
         "cost_per_token": None,
         "pool_size": 1000,
-        "get_model": lambda: TransformerModel(
+        "get_model": lambda: get_transformer_model(
             model_name=sgpt_1_3B_model_name,
             query_token_pre="[",
             query_token_post="]",
@@ -0,0 +1,194 @@
+import asyncio
+import random
+import re
+import time
+from threading import Lock
+
+import numpy as np
+import openai
+
+# Errors worth retrying; anything else (e.g. an invalid request) fails fast
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # Retry server-side API errors, but not client errors
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+# Headers of a 429 response telling when each exhausted limit resets
+RATE_LIMIT_RESET_HEADERS = {
+    "x-ratelimit-remaining-requests": "x-ratelimit-reset-requests",
+    "x-ratelimit-remaining-tokens": "x-ratelimit-reset-tokens",
+}
+
+
+def parse_duration(duration):
+    # Seconds in a duration like "20ms", "1.5s" or "6m0s"
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", duration)
+    if len(parts) == 0:
+        return float(duration)
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+def get_rate_limit_reset(error):
+    """Seconds until the rate limit hit by `error` resets, if its response
+    headers say, or None."""
+    headers = getattr(error, "headers", None) or {}
+    resets = []
+    if headers.get("retry-after") is not None:
+        resets.append(headers.get("retry-after"))
+    for remaining_header, reset_header in RATE_LIMIT_RESET_HEADERS.items():
+        if headers.get(remaining_header) == "0" and headers.get(reset_header):
+            resets.append(headers.get(reset_header))
+    try:
+        return max(parse_duration(reset) for reset in resets) if resets else None
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+    """Token bucket over requests and tokens per minute for async requests.
+
+    Budgets refill continuously and are shared by every batch (and thread)
+    using the same client. After a rate limit error, `pause` holds back every
+    request until the backoff has passed.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.updated_at) / 60
+        self.updated_at = now
+        self.available_requests = min(
+            self.requests_per_minute,
+            self.available_requests + elapsed_minutes * self.requests_per_minute,
+        )
+        self.available_tokens = min(
+            self.tokens_per_minute,
+            self.available_tokens + elapsed_minutes * self.tokens_per_minute,
+        )
+
+    def try_acquire(self, num_tokens):
+        # Take budget for a request, or return how many seconds to wait first
+        with self.lock:
+            self.refill()
+            wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                return wait
+            wait = 60 * max(
+                (1 - self.available_requests) / self.requests_per_minute,
+                (num_tokens - self.available_tokens) / self.tokens_per_minute,
+            )
+            if wait > 0:
+                return wait
+            self.available_requests -= 1
+            self.available_tokens -= num_tokens
+            return 0
+
+    async def acquire(self, num_tokens):
+        # A single request larger than the whole budget waits for a full bucket
+        num_tokens = min(num_tokens, self.tokens_per_minute)
+        while True:
+            wait = self.try_acquire(num_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AsyncEmbeddingClient:
+    """Embeds token windows with many OpenAI requests in flight at once.
+
+    A batch of inputs is split into requests of at most `inputs_per_request`
+    inputs, with up to `max_concurrency` of them running concurrently within
+    the requests- and tokens-per-minute budgets. Transient failures are
+    retried with jittered exponential backoff. Embeddings are returned in the
+    order of the inputs. Rate limit errors pause every request until the
+    limit resets, going by the `x-ratelimit-*` headers when the API sends
+    them.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        max_concurrency=8,
+        requests_per_minute=3000,
+        tokens_per_minute=1000000,
+        inputs_per_request=256,
+        max_retries=8,
+        initial_backoff=1.0,
+        max_backoff=60.0,
+    ):
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.inputs_per_request = inputs_per_request
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+    def embed(self, inputs):
+        return asyncio.run(self.embed_async(inputs))
+
+    async def embed_async(self, inputs):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run_request(request_inputs):
+            async with semaphore:
+                return await self.request(request_inputs)
+
+        requests = [
+            inputs[i : i + self.inputs_per_request]
+            for i in range(0, len(inputs), self.inputs_per_request)
+        ]
+        results = await asyncio.gather(
+            *[run_request(request_inputs) for request_inputs in requests]
+        )
+        return np.concatenate(results) if len(results) > 0 else np.zeros((0, 0))
+
+    async def request(self, inputs):
+        num_tokens = sum(len(tokens) for tokens in inputs)
+        attempt = 0
+        while True:
+            await self.limiter.acquire(num_tokens)
+            try:
+                response = await openai.Embedding.acreate(
+                    model=self.model_name, input=inputs
+                )
+                data = sorted(response["data"], key=lambda item: item["index"])
+                return np.array([item["embedding"] for item in data])
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                backoff = min(self.max_backoff, self.initial_backoff * 2**attempt)
+                # Jitter spreads out the retries of concurrent requests
+                delay = random.uniform(backoff / 2, backoff)
+                if isinstance(e, openai.error.RateLimitError):
+                    reset = get_rate_limit_reset(e)
+                    if reset is not None:
+                        delay = max(delay, reset)
+                    self.limiter.pause(delay)
+                attempt += 1
+                await asyncio.sleep(delay)
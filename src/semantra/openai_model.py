@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import openai
+import tiktoken
+
+from models import BaseModel
+from openai_client import AsyncEmbeddingClient
+
+
+class OpenAIModel(BaseModel):
+    def __init__(
+        self,
+        model_name="text-embedding-ada-002",
+        num_dimensions=1536,
+        tokenizer_name="cl100k_base",
+    ):
+        super().__init__()
+        # Check if OpenAI API key is set
+        if "OPENAI_API_KEY" not in os.environ:
+            raise Exception(
+                "OpenAI API key not set. Please set the OPENAI_API_KEY environment variable or create a `.env` file with the key in the current working directory or the Semantra directory, which is revealed by running `semantra --show-semantra-dir`."
+            )
+
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+
+        self.model_name = model_name
+        self.num_dimensions = num_dimensions
+        self.tokenizer = tiktoken.get_encoding(tokenizer_name)
+        # Concurrency and rate limits can be tuned like the API key, and
+        # OPENAI_API_BASE can point requests at another (e.g. local) server
+        self.client = AsyncEmbeddingClient(
+            model_name,
+            max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")),
+            requests_per_minute=int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "3000")),
+            tokens_per_minute=int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "1000000")),
+        )
+
+    def get_config(self):
+        return {
+            "model_type": "openai",
+            "model_name": self.model_name,
+            "tokenizer_name": self.tokenizer.name,
+        }
+
+    def get_num_dimensions(self) -> int:
+        return self.num_dimensions
+
+    def get_tokens(self, text: str):
+        return self.tokenizer.encode(text)
+
+    def get_token_length(self, tokens) -> int:
+        return len(tokens)
+
+    def get_text_chunks(self, _: str, tokens) -> "list[str]":
+        return [self.tokenizer.decode([token]) for token in tokens]
+
+    def get_window_bytes(self, tokens, offset) -> bytes:
+        i, j = offset
+        return np.asarray(tokens[i:j], dtype=np.uint32).tobytes()
+
+    def get_token_ids(self, tokens) -> np.ndarray:
+        return np.asarray(tokens, dtype=np.uint32)
+
+    def get_tokens_from_ids(self, token_ids):
+        return np.asarray(token_ids).tolist()
+
+    def slice_tokens(self, tokens, start: int, end: int):
+        return tokens[start:end]
+
+    def concat_tokens(self, tokens, other_tokens):
+        return tokens + other_tokens
+
+    def embed_batch(self, items, _is_query=False) -> "list[list[float]]":
+        texts = [tokens[i:j] for tokens, (i, j) in items]
+        return self.client.embed(texts)
@@ -0,0 +1,156 @@
+import io
+import os
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from util import LRUCache, safe_remove
+
+PAGE_FORMATS = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+
+
+def encode_page_image(pil_image, format, quality):
+    img_byte_arr = io.BytesIO()
+    if format == "png":
+        pil_image.save(img_byte_arr, format="PNG")
+    else:
+        # Lossy formats don't support the alpha channel pdfium may render
+        pil_image.convert("RGB").save(
+            img_byte_arr, format=format.upper(), quality=quality
+        )
+    return img_byte_arr.getvalue()
+
+
+class PageRenderCache:
+    """Caches rendered and encoded PDF pages in memory and on disk.
+
+    Pages are keyed by (md5, page, scale, format, quality) and bounded by a
+    byte budget at each level, evicting the least recently used pages first.
+    Concurrent requests for the same page share one render, and adjacent
+    pages can be rendered ahead of time in the background. With `contents`,
+    a `ContentRegistry`, background renders hold a lease of the content they
+    render from.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        memory_budget,
+        disk_budget,
+        prefetch_pages=2,
+        max_workers=2,
+        contents=None,
+    ):
+        self.cache_dir = cache_dir
+        self.contents = contents
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.memory = LRUCache(max_size=memory_budget, sizeof=len)
+        self.disk = LRUCache(
+            max_size=disk_budget,
+            sizeof=os.path.getsize,
+            on_evict=safe_remove,
+        )
+        # Pick up pages rendered by previous runs, oldest first
+        paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+        for path in sorted(paths, key=os.path.getmtime):
+            self.disk.put(os.path.basename(path), path)
+        self.prefetch_pages = prefetch_pages
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = {}
+        self.lock = Lock()
+
+    def get_filename(self, key):
+        md5, page, scale, format, quality = key
+        return f"{md5}.{page}.{scale:g}.{quality}.{format}"
+
+    def get_etag(self, md5, page, scale, format="png", quality=80):
+        # Pages are keyed by file content, so the key itself identifies them
+        return self.get_filename((md5, page, scale, format, quality))
+
+    def lookup(self, key):
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+        path = self.disk.get(self.get_filename(key))
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+            self.memory.put(key, data)
+        return data
+
+    def store(self, key, data):
+        self.memory.put(key, data)
+        filename = self.get_filename(key)
+        path = os.path.join(self.cache_dir, filename)
+        # Write atomically so that no partially written page is ever read
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+        self.disk.put(filename, path)
+
+    def render(self, content, key):
+        _, page, scale, format, quality = key
+        # Only rendering holds the document's mutex; encoding happens outside
+        pil_image = content.get_page_image_pil(page, scale)
+        data = encode_page_image(pil_image, format, quality)
+        self.store(key, data)
+        return data
+
+    def start_render(self, content, key, background):
+        # Share a single render between everyone asking for the same page
+        with self.lock:
+            future = self.pending.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self.pending[key] = future
+
+        if background:
+            # The caller's lease may end before the render runs
+            if self.contents is not None:
+                self.contents.retain(content)
+            self.executor.submit(self.run_render, content, key, future, True)
+        else:
+            self.run_render(content, key, future)
+        return future
+
+    def run_render(self, content, key, future, leased=False):
+        try:
+            future.set_result(self.render(content, key))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            if leased and self.contents is not None:
+                self.contents.release(content)
+
+    def get(self, content, md5, page, scale, format="png", quality=80):
+        key = (md5, page, scale, format, quality)
+        data = self.lookup(key)
+        if data is None:
+            data = self.start_render(content, key, False).result()
+        self.prefetch(content, md5, page, scale, format, quality)
+        return data
+
+    def prefetch(self, content, md5, page, scale, format, quality):
+        num_pages = len(content.positions)
+        for offset in range(1, self.prefetch_pages + 1):
+            for adjacent_page in (page + offset, page - offset):
+                if adjacent_page < 0 or adjacent_page >= num_pages:
+                    continue
+                key = (md5, adjacent_page, scale, format, quality)
+                if key in self.memory or self.get_filename(key) in self.disk:
+                    continue
+                self.start_render(content, key, True)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,9 +1,21 @@
 import pypdfium2 as pdfium
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from threading import Lock
 import json
 import os
 from tqdm import tqdm
-from util import get_converted_pdf_txt_filename, get_pdf_positions_filename
+from pdfchars import (
+    PDFChars,
+    PDFCharsWriter,
+    get_textpage_chars,
+    write_pdf_chars_from_document,
+)
+from util import (
+    get_converted_pdf_txt_filename,
+    get_pdf_chars_filename,
+    get_pdf_positions_filename,
+)
 
 mutexes = {}
 
@@ -16,35 +28,73 @@ def get_mutex(filename):
 
 
 class PDFContent:
-    def __init__(self, rawtext, filename, positions):
+    def __init__(self, rawtext, filename, positions, chars_filename=None):
+        # rawtext may be None when the content is only opened to serve pages
         self.rawtext = rawtext
         self.filename = filename
         self.positions = positions
+        self.chars_filename = chars_filename
+        self.chars = None
         self.pdfium = pdfium.PdfDocument(filename)
         self.mutex = get_mutex(filename)
+        # Held while reading the character box sidecar, which close unmaps
+        self.chars_lock = Lock()
         self.filetype = "pdf"
 
+    def get_pdfium(self):
+        # Contents are only closed once nothing holds a lease of them
+        if self.pdfium is None:
+            raise ValueError(f"{self.filename} is closed")
+        return self.pdfium
+
     def get_page_image_pil(self, page_number, scale):
         with self.mutex:
-            page = self.pdfium[page_number]
+            page = self.get_pdfium()[page_number]
             bitmap = page.render(scale=scale)
             return bitmap.to_pil()
 
+    def get_chars(self):
+        # Open the character box sidecar, extracting it first for PDFs
+        # ingested before it existed (or before its current format). Called
+        # with chars_lock held
+        if self.chars is None:
+            try:
+                self.chars = PDFChars(self.chars_filename)
+            except (FileNotFoundError, ValueError):
+                with self.mutex:
+                    write_pdf_chars_from_document(
+                        self.chars_filename, self.get_pdfium()
+                    )
+                self.chars = PDFChars(self.chars_filename)
+        return self.chars
+
     def get_page_chars(self, page_number):
+        if self.chars_filename is not None:
+            with self.chars_lock:
+                return self.get_chars().get_page_chars(page_number)
         with self.mutex:
-            page = self.pdfium[page_number]
-            textpage = page.get_textpage()
-            num_chars = textpage.count_chars()
-            char_boxes = [textpage.get_charbox(i) for i in range(num_chars)]
-            chars = [
-                textpage.get_text_range(index=i, count=1) for i in range(num_chars)
-            ]
-            return [(c, b) for c, b in list(zip(chars, char_boxes))]
+            page = self.get_pdfium()[page_number]
+            chars, boxes = get_textpage_chars(page.get_textpage())
+            return list(zip(chars, boxes.tolist()))
+
+    def get_page_chars_binary(self, page_number):
+        with self.chars_lock:
+            return self.get_chars().get_page_binary(page_number)
 
     def close(self):
         """Properly close and release resources"""
+        # Wait for any page being rendered from this document
+        with self.mutex:
+            self.close_pdfium()
+        # and for any characters being read from the sidecar
+        with self.chars_lock:
+            if self.chars is not None:
+                self.chars.close()
+                self.chars = None
+
+    def close_pdfium(self):
         try:
-            if hasattr(self, 'pdfium') and self.pdfium is not None:
+            if hasattr(self, "pdfium") and self.pdfium is not None:
                 self.pdfium.close()
                 self.pdfium = None
         except Exception as e:
@@ -52,60 +102,114 @@ class PDFContent:
 
     def __del__(self):
         """Ensure resources are released when object is garbage collected"""
-        self.close()
+        self.close_pdfium()
 
 
 # Page separator character
 LINE_FEED = "\f"
 
 
-def get_pdf_content(md5, filename, semantra_dir, force, silent):
+# Pages extracted by each worker when extracting in parallel
+PAGES_PER_SHARD = 32
+
+
+def iter_pages(pdf, start, end):
+    # Yield the text, size and characters of each page in a range
+    for page_index in range(start, end):
+        page = pdf[page_index]
+        page_width, page_height = page.get_size()
+        textpage = page.get_textpage()
+        pagetext = textpage.get_text_range()
+        yield pagetext, page_width, page_height, get_textpage_chars(textpage)
+
+
+def extract_pages(filename, start, end):
+    # Runs in a worker process. pdfium isn't thread-safe, so each worker opens
+    # its own copy of the document
+    pdf = pdfium.PdfDocument(filename)
+    try:
+        return list(iter_pages(pdf, start, end))
+    finally:
+        pdf.close()
+
+
+def iter_pdf_pages(filename, n_pages, workers):
+    # Yield the pages of a PDF in order, sharding page ranges across a process
+    # pool if there are enough pages to make it worthwhile
+    if workers <= 1 or n_pages <= PAGES_PER_SHARD:
+        pdf = pdfium.PdfDocument(filename)
+        try:
+            yield from iter_pages(pdf, 0, n_pages)
+        finally:
+            pdf.close()
+        return
+
+    starts = range(0, n_pages, PAGES_PER_SHARD)
+    ends = [min(start + PAGES_PER_SHARD, n_pages) for start in starts]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for pages in executor.map(extract_pages, repeat(filename), starts, ends):
+            yield from pages
+
+
+def extract_pdf_content(md5, filename, semantra_dir, force, silent, workers=1):
+    """Write the text and page positions of a PDF to the Semantra directory.
+
+    Pages are extracted by up to `workers` processes and written in order.
+    Returns the page positions if the PDF was extracted, or None if the
+    extracted files already exist and `force` is not set.
+    """
     converted_txt = os.path.join(semantra_dir, get_converted_pdf_txt_filename(md5))
     position_index = os.path.join(semantra_dir, get_pdf_positions_filename(md5))
+    chars_filename = os.path.join(semantra_dir, get_pdf_chars_filename(md5))
+
+    # The character box sidecar isn't checked: PDFs extracted before it
+    # existed have it written on first use instead
+    if not force and os.path.exists(converted_txt) and os.path.exists(position_index):
+        return None
 
     pdf = pdfium.PdfDocument(filename)
     n_pages = len(pdf)
+    pdf.close()
+
+    positions = []
+    position = 0
+    # newline="" ensures pdfium's \r is preserved
+    with open(
+        converted_txt, "w", newline="", encoding="utf-8", errors="ignore"
+    ) as f, PDFCharsWriter(chars_filename, n_pages) as chars_writer:
+        for pagetext, page_width, page_height, chars in tqdm(
+            iter_pdf_pages(filename, n_pages, workers),
+            total=n_pages,
+            desc="Extracting PDF contents",
+            leave=False,
+            disable=silent,
+        ):
+            chars_writer.append(*chars)
+            positions.append(
+                {
+                    "char_index": position,
+                    "page_width": page_width,
+                    "page_height": page_height,
+                }
+            )
+            position += f.write(pagetext)
+            position += f.write(LINE_FEED)
+    with open(position_index, "w", encoding="utf-8") as f:
+        json.dump(positions, f)
+    return positions
+
+
+def get_pdf_content(md5, filename, semantra_dir, force, silent, workers=1):
+    converted_txt = os.path.join(semantra_dir, get_converted_pdf_txt_filename(md5))
+    position_index = os.path.join(semantra_dir, get_pdf_positions_filename(md5))
+    chars_filename = os.path.join(semantra_dir, get_pdf_chars_filename(md5))
+
+    positions = extract_pdf_content(md5, filename, semantra_dir, force, silent, workers)
 
-    if force or not os.path.exists(converted_txt) or not os.path.exists(position_index):
-        positions = []
-        position = 0
-        # newline="" ensures pdfium's \r is preserved
-        with open(
-            converted_txt, "w", newline="", encoding="utf-8", errors="ignore"
-        ) as f:
-            for page_index in tqdm(
-                range(n_pages),
-                desc="Extracting PDF contents",
-                leave=False,
-                disable=silent,
-            ):
-                page = pdf[page_index]
-                page_width, page_height = page.get_size()
-                textpage = page.get_textpage()
-                pagetext = textpage.get_text_range()
-
-                positions.append(
-                    {
-                        "char_index": position,
-                        "page_width": page_width,
-                        "page_height": page_height,
-                    }
-                )
-                position += f.write(pagetext)
-                position += f.write(LINE_FEED)
-        with open(position_index, "w", encoding="utf-8") as f:
-            json.dump(positions, f)
-        with open(
-            converted_txt, "r", newline="", encoding="utf-8", errors="ignore"
-        ) as f:
-            rawtext = f.read()
-        return PDFContent(rawtext, filename, positions)
-    else:
-        with open(
-            converted_txt, "r", newline="", encoding="utf-8", errors="ignore"
-        ) as f:
-            rawtext = f.read()
+    with open(converted_txt, "r", newline="", encoding="utf-8", errors="ignore") as f:
+        rawtext = f.read()
+    if positions is None:
         with open(position_index, "r", encoding="utf-8") as f:
             positions = json.load(f)
 
-        return PDFContent(rawtext, filename, positions)
+    return PDFContent(rawtext, filename, positions, chars_filename)
@@ -0,0 +1,202 @@
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+import numpy as np
+import pypdfium2.raw as pdfium_c
+
+from util import safe_remove
+
+# Columnar sidecar of the character boxes of every page of a PDF:
+#
+#   magic | num_pages: u32 | num_chars: u32
+#   page_starts: u32[num_pages + 1]   first char index of each page
+#   boxes: f32[num_chars, 4]          (left, bottom, right, top) per char
+#   char_offsets: u32[num_chars + 1]  byte offset of each char in the text
+#   text: UTF-8 bytes of all chars
+CHARS_MAGIC = b"SMC2"
+HEADER = struct.Struct("<4sII")
+
+
+def get_textpage_chars(textpage):
+    # Extract the characters and boxes of a page in one pass. pdfium reports
+    # characters outside the BMP as two UTF-16 surrogates, which are joined
+    # into one character spanning both boxes, so that the characters line up
+    # with the page's text
+    num_chars = textpage.count_chars()
+    codes = [pdfium_c.FPDFText_GetUnicode(textpage.raw, i) for i in range(num_chars)]
+    boxes = np.array(
+        [textpage.get_charbox(i) for i in range(num_chars)], dtype="<f4"
+    ).reshape(num_chars, 4)
+    chars = []
+    kept = []
+    i = 0
+    while i < num_chars:
+        code = codes[i]
+        if (
+            0xD800 <= code < 0xDC00
+            and i + 1 < num_chars
+            and 0xDC00 <= codes[i + 1] < 0xE000
+        ):
+            chars.append(chr(0x10000 + ((code - 0xD800) << 10) + codes[i + 1] - 0xDC00))
+            boxes[i, :2] = np.minimum(boxes[i, :2], boxes[i + 1, :2])
+            boxes[i, 2:] = np.maximum(boxes[i, 2:], boxes[i + 1, 2:])
+            kept.append(i)
+            i += 2
+        else:
+            chars.append(chr(code))
+            kept.append(i)
+            i += 1
+    return chars, boxes[kept]
+
+
+class PDFCharsWriter:
+    """Writes a character box sidecar one page at a time.
+
+    The boxes of each page are written to the sidecar as soon as they are
+    appended, while the char offsets and text, which come after all boxes,
+    are buffered in temporary files until `close` copies them over and fills
+    in the header and page starts. The sidecar is written under a temporary
+    name and only moved into place by `close`, so readers never see a
+    partial sidecar.
+    """
+
+    def __init__(self, filename, num_pages):
+        self.filename = filename
+        self.num_pages = num_pages
+        # Several processes may extract the same PDF, so each writes its own
+        self.temp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        directory = os.path.dirname(filename) or None
+        self.file = open(self.temp_filename, "w+b")
+        self.offsets_file = tempfile.TemporaryFile(dir=directory)
+        self.text_file = tempfile.TemporaryFile(dir=directory)
+        self.page_starts = [0]
+        self.text_size = 0
+        # Boxes start after the header and page starts
+        self.file.seek(HEADER.size + (num_pages + 1) * 4)
+        self.offsets_file.write(np.zeros(1, dtype="<u4").tobytes())
+
+    def append(self, chars, boxes):
+        # Add the next page, as (chars, boxes) from get_textpage_chars
+        encoded_chars = [char.encode("utf-8", errors="surrogatepass") for char in chars]
+        ends = self.text_size + np.cumsum(
+            [len(char) for char in encoded_chars], dtype=np.int64
+        )
+        self.file.write(
+            np.ascontiguousarray(boxes, dtype="<f4").reshape(-1, 4).tobytes()
+        )
+        self.offsets_file.write(ends.astype("<u4").tobytes())
+        self.text_file.write(b"".join(encoded_chars))
+        if len(ends) > 0:
+            self.text_size = int(ends[-1])
+        self.page_starts.append(self.page_starts[-1] + len(chars))
+
+    def close(self):
+        num_pages = len(self.page_starts) - 1
+        if num_pages != self.num_pages:
+            raise ValueError(f"Expected {self.num_pages} pages, got {num_pages}")
+        for f in (self.offsets_file, self.text_file):
+            f.seek(0)
+            shutil.copyfileobj(f, self.file)
+            f.close()
+        self.file.seek(0)
+        self.file.write(HEADER.pack(CHARS_MAGIC, num_pages, self.page_starts[-1]))
+        self.file.write(np.array(self.page_starts, dtype="<u4").tobytes())
+        self.file.close()
+        os.replace(self.temp_filename, self.filename)
+
+    def abort(self):
+        self.offsets_file.close()
+        self.text_file.close()
+        self.file.close()
+        safe_remove(self.temp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_pdf_chars_from_document(filename, pdf):
+    with PDFCharsWriter(filename, len(pdf)) as writer:
+        for i in range(len(pdf)):
+            writer.append(*get_textpage_chars(pdf[i].get_textpage()))
+
+
+class PDFChars:
+    """Memory-mapped reader of a character box sidecar."""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_pages, num_chars = HEADER.unpack_from(self.buffer, 0)
+        if magic != CHARS_MAGIC:
+            raise ValueError(f"Not a character box file: {filename}")
+
+        offset = HEADER.size
+        self.page_starts = np.frombuffer(
+            self.buffer, dtype="<u4", count=num_pages + 1, offset=offset
+        )
+        offset += self.page_starts.nbytes
+        self.boxes = np.frombuffer(
+            self.buffer, dtype="<f4", count=num_chars * 4, offset=offset
+        ).reshape(num_chars, 4)
+        offset += self.boxes.nbytes
+        self.char_offsets = np.frombuffer(
+            self.buffer, dtype="<u4", count=num_chars + 1, offset=offset
+        )
+        self.text_offset = offset + self.char_offsets.nbytes
+
+    def get_page_range(self, page_number):
+        return (
+            int(self.page_starts[page_number]),
+            int(self.page_starts[page_number + 1]),
+        )
+
+    def get_page_chars(self, page_number):
+        # Return the (char, box) pairs of a page
+        start, end = self.get_page_range(page_number)
+        text = self.get_page_text(start, end)
+        offsets = self.char_offsets[start : end + 1] - self.char_offsets[start]
+        chars = [
+            text[offsets[i] : offsets[i + 1]].decode("utf-8", errors="surrogatepass")
+            for i in range(end - start)
+        ]
+        return list(zip(chars, self.boxes[start:end].tolist()))
+
+    def get_page_text(self, start, end):
+        return self.buffer[
+            self.text_offset
+            + self.char_offsets[start] : self.text_offset
+            + self.char_offsets[end]
+        ]
+
+    def get_page_binary(self, page_number):
+        """Encode the chars of a page compactly for the client.
+
+        The layout is `num_chars: u32 | boxes: f32[num_chars, 4] |
+        char_offsets: u32[num_chars + 1] | text`, all little-endian, with the
+        char offsets relative to the start of the page's text.
+        """
+        start, end = self.get_page_range(page_number)
+        offsets = self.char_offsets[start : end + 1] - self.char_offsets[start]
+        return b"".join(
+            [
+                struct.pack("<I", end - start),
+                self.boxes[start:end].tobytes(),
+                offsets.astype("<u4").tobytes(),
+                self.get_page_text(start, end),
+            ]
+        )
+
+    def close(self):
+        # The arrays are views of the map, which can't close while they exist
+        self.page_starts = self.boxes = self.char_offsets = None
+        self.buffer.close()
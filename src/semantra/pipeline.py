@@ -0,0 +1,64 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from pdf import extract_pdf_content
+from util import file_md5
+
+
+def prepare_file(filename, semantra_dir, force, workers=1):
+    """CPU-bound ingestion stage: hash a file and extract its PDF text.
+
+    Runs in a worker process, so it only writes to the Semantra directory and
+    returns the md5 rather than any loaded content. PDF pages are extracted by
+    up to `workers` processes of its own.
+    """
+    md5 = file_md5(filename)
+    if filename.endswith(".pdf"):
+        extract_pdf_content(md5, filename, semantra_dir, force, True, workers)
+    return md5
+
+
+def run_pipeline(filenames, semantra_dir, force, tokenize, embed, workers=None):
+    """Ingest files with hashing, tokenization and embedding overlapped.
+
+    Files are hashed and their PDFs extracted in a process pool, tokenized one
+    file ahead on a background thread, and embedded in order on the calling
+    thread. `tokenize(filename, md5)` and `embed(filename, tokenized)` run the
+    later stages. Yields `(filename, embed result)` pairs in input order.
+    """
+    filenames = list(filenames)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or len(filenames) == 0:
+        for filename in filenames:
+            yield filename, embed(filename, tokenize(filename, None))
+        return
+
+    if len(filenames) == 1:
+        # Spend every worker on extracting the pages of a single PDF
+        (filename,) = filenames
+        md5 = prepare_file(filename, semantra_dir, force, workers)
+        yield filename, embed(filename, tokenize(filename, md5))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as prepare_pool, ThreadPoolExecutor(
+        max_workers=1
+    ) as tokenize_pool:
+        # Each file's pages are extracted within its worker process, rather
+        # than in a nested process pool
+        md5_futures = [
+            prepare_pool.submit(prepare_file, filename, semantra_dir, force)
+            for filename in filenames
+        ]
+
+        def tokenize_at(i):
+            return tokenize(filenames[i], md5_futures[i].result())
+
+        next_tokenized = tokenize_pool.submit(tokenize_at, 0)
+        for i, filename in enumerate(filenames):
+            tokenized = next_tokenized.result()
+            # Tokenize the next file while this one is being embedded
+            if i + 1 < len(filenames):
+                next_tokenized = tokenize_pool.submit(tokenize_at, i + 1)
+            yield filename, embed(filename, tokenized)
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+
+from search import normalize_rows
+from util import get_num_embeddings, memmap_embeddings_file
+
+QUANTIZE_TYPES = ["float16", "int8"]
+
+# Embeddings quantized and written at a time
+QUANTIZE_BLOCK_SIZE = 16384
+
+
+def get_quantized_dtype(quantize, num_dimensions):
+    # Rows of quantized embeddings files: int8 rows carry their own scale
+    if quantize == "float16":
+        return np.dtype([("values", "<f2", (num_dimensions,))])
+    if quantize == "int8":
+        return np.dtype([("scale", "<f4"), ("values", "i1", (num_dimensions,))])
+    raise ValueError(f"Unknown quantization: {quantize}")
+
+
+def quantize_embeddings(embeddings, quantize):
+    """Quantize the normalized rows of `embeddings`.
+
+    Each int8 row is scaled to use the full range of its largest component.
+    """
+    embeddings = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    rows = np.zeros(
+        len(embeddings), dtype=get_quantized_dtype(quantize, embeddings.shape[1])
+    )
+    if quantize == "float16":
+        rows["values"] = embeddings
+    else:
+        scales = np.abs(embeddings).max(axis=1) / 127
+        # Leave all-zero rows (e.g. skipped empty windows) as zeros
+        scales[scales == 0] = 1
+        rows["scale"] = scales
+        rows["values"] = np.rint(embeddings / scales[:, None])
+    return rows
+
+
+def write_quantized_embeddings_file(
+    filename, embeddings_filename, num_dimensions, quantize
+):
+    # Quantize from the memory-mapped embeddings file a block at a time
+    embeddings, num_embeddings = memmap_embeddings_file(
+        embeddings_filename,
+        num_dimensions,
+        get_num_embeddings(embeddings_filename, num_dimensions),
+    )
+
+    # Only move the file into place once it is complete
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, "wb") as f:
+        for start in range(0, num_embeddings, QUANTIZE_BLOCK_SIZE):
+            block = embeddings[start : start + QUANTIZE_BLOCK_SIZE]
+            f.write(quantize_embeddings(block, quantize).tobytes())
+    os.replace(temp_filename, filename)
+
+
+def read_quantized_embeddings_file(filename, num_dimensions, quantize):
+    # Read into memory rather than memory-mapping, to keep them resident
+    return np.fromfile(filename, dtype=get_quantized_dtype(quantize, num_dimensions))
+
+
+def get_num_quantized_embeddings(filename, num_dimensions, quantize):
+    return (
+        os.path.getsize(filename)
+        // get_quantized_dtype(quantize, num_dimensions).itemsize
+    )
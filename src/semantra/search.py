@@ -0,0 +1,481 @@
+import itertools
+import json
+import os
+from bisect import bisect_right
+from threading import Lock
+
+import numpy as np
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # Leave all-zero rows (e.g. skipped empty windows) as zeros
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k(scores, k):
+    # Return the indices of the k highest scores, highest first
+    if k <= 0 or len(scores) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        indices = np.argpartition(-scores, k - 1)[:k]
+    else:
+        indices = np.arange(len(scores))
+    return indices[np.argsort(-scores[indices], kind="stable")]
+
+
+def search_embeddings(embeddings, embedding, num_results):
+    """Search one document's embeddings for the closest to an embedding.
+
+    Returns the top results as (index, distance) tuples, like the per-file
+    results of `ExactSearchIndex.search`.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(embeddings) == 0:
+        return []
+    query = np.asarray(embedding, dtype=np.float32)
+    query_norm = np.linalg.norm(query)
+    if query_norm > 0:
+        query = query / query_norm
+    scores = normalize_rows(embeddings) @ query
+    return [(int(index), float(scores[index])) for index in top_k(scores, num_results)]
+
+
+# Rows of quantized embeddings scored at a time, bounding float32 temporaries
+QUANTIZED_SCORE_BLOCK_SIZE = 16384
+# Candidates per result re-ranked in full precision after a quantized search
+QUANTIZED_RERANK_FACTOR = 4
+
+
+def score_quantized(rows, query):
+    # Approximate cosine similarities of quantized rows to a normalized query
+    values = rows["values"]
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), QUANTIZED_SCORE_BLOCK_SIZE):
+        block = values[start : start + QUANTIZED_SCORE_BLOCK_SIZE]
+        scores[start : start + len(block)] = block.astype(np.float32) @ query
+    if "scale" in rows.dtype.names:
+        scores *= rows["scale"]
+    return scores
+
+
+def rerank(embeddings, candidates, query, num_results):
+    # Score candidate rows in full precision, reading only those rows of
+    # memory-mapped embeddings
+    candidates = np.sort(candidates)
+    scores = (
+        normalize_rows(np.asarray(embeddings[candidates], dtype=np.float32)) @ query
+    )
+    return [
+        (int(candidates[index]), float(scores[index]))
+        for index in top_k(scores, num_results)
+    ]
+
+
+class ExactSearchIndex:
+    """Exact cosine-similarity search across the first window of all documents.
+
+    The embeddings of every document are concatenated into one pre-normalized
+    float32 matrix alongside a side table of each document's row range, so a
+    query is answered with a single matrix-vector product. The matrix is built
+    lazily and rebuilt after the document set changes.
+
+    With `quantized`, the matrix is made of the documents' float16 or int8
+    `quantized_embeddings` instead, and the best candidates of each document
+    are re-ranked against its full-precision embeddings.
+    """
+
+    def __init__(self, quantized=False, store=None):
+        self.quantized = quantized
+        self.store = store
+        self.lock = Lock()
+        # Bumped on every change to the documents, so that a change made while
+        # a build is reading them is picked up by the next search
+        self.generations = itertools.count()
+        self.generation = next(self.generations)
+        self.built_generation = None
+        self.matrix = None
+        self.filenames = []
+        self.starts = np.zeros(1, dtype=np.int64)
+
+    def invalidate(self):
+        self.generation = next(self.generations)
+
+    def build(self, documents):
+        filenames = list(documents.keys())
+        if self.quantized:
+            embeddings = [
+                documents[filename].quantized_embeddings for filename in filenames
+            ]
+        else:
+            embeddings = [
+                np.asarray(documents[filename].embeddings, dtype=np.float32)
+                for filename in filenames
+            ]
+        counts = [len(doc_embeddings) for doc_embeddings in embeddings]
+        self.starts = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+        self.filenames = filenames
+        if len(embeddings) > 0 and self.quantized:
+            # Quantized rows are normalized already
+            self.matrix = np.concatenate(embeddings)
+        elif len(embeddings) > 0:
+            self.matrix = normalize_rows(np.concatenate(embeddings))
+        else:
+            self.matrix = None
+        if self.store is not None:
+            # The matrix is a copy, so count it against the memory budget
+            self.store.reserve(
+                "exact_index", 0 if self.matrix is None else self.matrix.nbytes
+            )
+
+    def ensure_built(self, documents):
+        with self.lock:
+            generation = self.generation
+            if self.built_generation != generation:
+                self.build(documents)
+                self.built_generation = generation
+            return self.matrix, self.filenames, self.starts
+
+    def search(self, documents, embedding, num_results):
+        """Search all documents for the closest windows to an embedding.
+
+        Returns a pair of the global top results as (filename, index, distance)
+        tuples and a dict mapping each filename to its own top results as
+        (index, distance) tuples.
+        """
+        matrix, filenames, starts = self.ensure_built(documents)
+        if matrix is None:
+            return [], {}
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm > 0:
+            query = query / query_norm
+        if self.quantized:
+            return self.search_quantized(
+                documents, matrix, filenames, starts, query, num_results
+            )
+        scores = matrix @ query
+
+        rows = top_k(scores, num_results)
+        doc_ids = np.searchsorted(starts, rows, side="right") - 1
+        global_results = []
+        for row, doc_id in zip(rows, doc_ids):
+            global_results.append(
+                (filenames[doc_id], int(row - starts[doc_id]), float(scores[row]))
+            )
+
+        per_file_results = {}
+        for doc_id, filename in enumerate(filenames):
+            doc_scores = scores[starts[doc_id] : starts[doc_id + 1]]
+            per_file_results[filename] = [
+                (int(index), float(doc_scores[index]))
+                for index in top_k(doc_scores, num_results)
+            ]
+
+        return global_results, per_file_results
+
+    def search_quantized(
+        self, documents, matrix, filenames, starts, query, num_results
+    ):
+        scores = score_quantized(matrix, query)
+        per_file_results = {}
+        global_results = []
+        for doc_id, filename in enumerate(filenames):
+            doc_scores = scores[starts[doc_id] : starts[doc_id + 1]]
+            candidates = top_k(doc_scores, num_results * QUANTIZED_RERANK_FACTOR)
+            per_file_results[filename] = rerank(
+                documents[filename].embeddings, candidates, query, num_results
+            )
+            global_results.extend(
+                (filename, index, distance)
+                for index, distance in per_file_results[filename]
+            )
+
+        # The global top results are among the top results of each file
+        global_results.sort(key=lambda result: result[2], reverse=True)
+        return global_results[:num_results], per_file_results
+
+
+# Rebuild a corpus index that can't be changed incrementally once documents
+# added or removed since it was built account for this fraction of its items,
+# or at least this many items
+CORPUS_INDEX_REBUILD_FRACTION = 0.1
+CORPUS_INDEX_REBUILD_MIN_ITEMS = 10000
+# Embeddings inserted into an incremental corpus index at a time, so searches
+# aren't held up for a whole document
+CORPUS_INDEX_INSERT_BLOCK_SIZE = 256
+
+
+class CorpusAnnIndex:
+    """Approximate search across the first window of all documents at once.
+
+    The embeddings of every document are added to a single vector index from
+    `create_index()`, with a side table of each document's range of item ids,
+    so one query returns the global top results. Documents added since the
+    last `update` are searched exactly in the meantime: incremental indexes
+    (e.g. HNSW) insert them on the next update, while others (e.g. Annoy) are
+    only rebuilt once enough documents were added or removed for
+    `needs_update` to call for it.
+
+    With a `filename`, the index is saved there after each update along with
+    the side table, and `restore` reloads it with `load_index(filename)` so
+    that only documents that changed since need indexing again.
+    """
+
+    def __init__(self, create_index, filename=None, load_index=None):
+        self.create_index = create_index
+        self.filename = filename
+        self.load_index = load_index
+        self.index = create_index()
+        self.lock = Lock()
+        self.updating = False
+        # Documents to search by filename, and those not in the index yet
+        self.documents = {}
+        self.pending = {}
+        # Range of item ids of each document in the index, and the document
+        # each range of ids was allocated to, in order
+        self.ranges = {}
+        self.starts = []
+        self.owners = []
+        self.next_id = 0
+        self.num_indexed = 0
+        self.num_removed = 0
+        self.built = False
+
+    def add(self, document):
+        with self.lock:
+            self.remove_indexed(document.filename)
+            self.documents[document.filename] = document
+            self.pending[document.filename] = document
+
+    def remove(self, filename):
+        with self.lock:
+            self.remove_indexed(filename)
+            self.documents.pop(filename, None)
+
+    def remove_indexed(self, filename):
+        self.pending.pop(filename, None)
+        ids = self.ranges.pop(filename, None)
+        if ids is not None:
+            self.index.remove(np.arange(*ids))
+            self.num_indexed -= ids[1] - ids[0]
+            self.num_removed += ids[1] - ids[0]
+
+    def allocate(self, filename, count):
+        # Reserve the next `count` item ids for a document
+        start = self.next_id
+        self.next_id += count
+        self.starts.append(start)
+        self.owners.append(filename)
+        return start
+
+    def needs_update(self):
+        with self.lock:
+            if self.updating:
+                return False
+            if self.index.incremental and len(self.pending) > 0:
+                return True
+            return self.needs_rebuild()
+
+    def needs_rebuild(self):
+        # Incremental indexes only count removed items, which still take up
+        # space in them
+        num_changed = self.num_removed
+        if not self.index.incremental:
+            num_changed += sum(
+                document.num_embeddings for document in self.pending.values()
+            )
+        return num_changed > max(
+            CORPUS_INDEX_REBUILD_MIN_ITEMS if self.built else 0,
+            CORPUS_INDEX_REBUILD_FRACTION * self.num_indexed,
+        )
+
+    def update(self):
+        with self.lock:
+            if self.updating:
+                return
+            self.updating = True
+            rebuild = self.needs_rebuild()
+        try:
+            changed = rebuild
+            if rebuild:
+                self.rebuild()
+            if self.index.incremental:
+                changed = self.insert_pending() or changed
+            if changed:
+                self.save()
+        finally:
+            with self.lock:
+                self.updating = False
+
+    def insert_pending(self):
+        # Insert pending documents one block at a time, searching them exactly
+        # until they are complete. Returns whether any were inserted
+        inserted_any = False
+        while True:
+            with self.lock:
+                if len(self.pending) == 0:
+                    return inserted_any
+                filename, document = next(iter(self.pending.items()))
+                embeddings = document.embeddings
+                start = self.allocate(filename, len(embeddings))
+            inserted = True
+            for offset in range(0, len(embeddings), CORPUS_INDEX_INSERT_BLOCK_SIZE):
+                block = np.asarray(
+                    embeddings[offset : offset + CORPUS_INDEX_INSERT_BLOCK_SIZE],
+                    dtype=np.float32,
+                )
+                with self.lock:
+                    if self.pending.get(filename) is not document:
+                        inserted = False
+                        break
+                    ids = np.arange(start + offset, start + offset + len(block))
+                    self.index.add(ids, block)
+            with self.lock:
+                if inserted and self.pending.get(filename) is document:
+                    del self.pending[filename]
+                    self.ranges[filename] = (start, start + len(embeddings))
+                    self.num_indexed += len(embeddings)
+                    inserted_any = True
+                else:
+                    # Removed or replaced while inserting
+                    self.index.remove(np.arange(start, start + len(embeddings)))
+
+    def rebuild(self):
+        # Build a new index of the current documents, searching the old one
+        # in the meantime
+        with self.lock:
+            indexed = dict(self.documents)
+        filenames = list(indexed.keys())
+        embedding_arrays = [indexed[filename].embeddings for filename in filenames]
+        index = self.create_index()
+        index.build(embedding_arrays)
+        with self.lock:
+            self.index = index
+            self.ranges = {}
+            self.starts = []
+            self.owners = []
+            self.next_id = 0
+            for filename, embeddings in zip(filenames, embedding_arrays):
+                start = self.allocate(filename, len(embeddings))
+                self.ranges[filename] = (start, self.next_id)
+            self.num_indexed = self.next_id
+            self.num_removed = 0
+            self.built = True
+            # Keep track of changes made while building
+            self.pending = {
+                filename: document
+                for filename, document in self.documents.items()
+                if indexed.get(filename) is not document
+            }
+            for filename, document in indexed.items():
+                if self.documents.get(filename) is not document:
+                    ids = self.ranges.pop(filename)
+                    self.index.remove(np.arange(*ids))
+                    self.num_indexed -= ids[1] - ids[0]
+                    self.num_removed += ids[1] - ids[0]
+
+    def save(self):
+        if self.filename is None:
+            return
+        temp_filename = f"{self.filename}.json.tmp"
+        with self.lock:
+            try:
+                self.index.write(self.filename)
+            except ValueError:
+                # Annoy indexes changed since they were built can't be saved,
+                # so leave the last one saved until the next rebuild
+                return
+            metadata = {
+                "next_id": self.next_id,
+                "num_removed": self.num_removed,
+                "documents": {
+                    filename: {
+                        "embeddings_filename": self.documents[
+                            filename
+                        ].embeddings_filenames[0],
+                        "ids": list(ids),
+                    }
+                    for filename, ids in self.ranges.items()
+                },
+            }
+            with open(temp_filename, "w") as f:
+                json.dump(metadata, f)
+            os.replace(temp_filename, f"{self.filename}.json")
+
+    def restore(self, documents):
+        """Load the index saved by an earlier run and add `documents`.
+
+        Documents whose embeddings are still the ones in the saved index are
+        searched with it right away, and the rest are pending as with `add`.
+        Saved documents that aren't in `documents` are removed. Returns
+        whether a saved index was loaded.
+        """
+        try:
+            with open(f"{self.filename}.json") as f:
+                metadata = json.load(f)
+            index = self.load_index(self.filename)
+        except Exception:
+            # Start over if there is no saved index or it can't be read
+            index = None
+
+        with self.lock:
+            if index is not None:
+                self.index = index
+                self.next_id = metadata["next_id"]
+                self.num_removed = metadata["num_removed"]
+                self.built = True
+                saved = sorted(
+                    metadata["documents"].items(), key=lambda item: item[1]["ids"]
+                )
+                for filename, entry in saved:
+                    start, end = entry["ids"]
+                    document = documents.get(filename)
+                    self.starts.append(start)
+                    self.owners.append(filename)
+                    if (
+                        document is not None
+                        and document.embeddings_filenames[0]
+                        == entry["embeddings_filename"]
+                        and document.num_embeddings == end - start
+                    ):
+                        self.ranges[filename] = (start, end)
+                        self.num_indexed += end - start
+                    else:
+                        self.index.remove(np.arange(start, end))
+                        self.num_removed += end - start
+            for filename, document in documents.items():
+                self.documents[filename] = document
+                if filename not in self.ranges:
+                    self.pending[filename] = document
+        return index is not None
+
+    def search(self, embedding, num_results):
+        """Search all documents for the closest windows to an embedding.
+
+        Returns the global top results as (filename, index, distance) tuples,
+        like `ExactSearchIndex.search`.
+        """
+        results = []
+        with self.lock:
+            ids, similarities = self.index.search(embedding, num_results)
+            for id, similarity in zip(ids.tolist(), similarities.tolist()):
+                owner = bisect_right(self.starts, id) - 1
+                filename = self.owners[owner]
+                start = self.starts[owner]
+                # Skip documents still being inserted, which are searched exactly
+                if self.ranges.get(filename, (None,))[0] != start:
+                    continue
+                results.append((filename, id - start, similarity))
+            pending = list(self.pending.values())
+
+        for document in pending:
+            for index, distance in search_embeddings(
+                document.embeddings, embedding, num_results
+            ):
+                results.append((document.filename, index, distance))
+
+        results.sort(key=lambda result: result[2], reverse=True)
+        return results[:num_results]
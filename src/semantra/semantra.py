@@ -1,19 +1,21 @@
+import functools
 import hashlib
-import io
+import importlib.metadata
 import json
-import math
 import os
 import sys
 import gc
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from threading import Lock
 from werkzeug.utils import secure_filename
 import tempfile
 import logging
 import atexit
 import signal
+import shutil
 import click
 import numpy as np
-import pkg_resources
 from dotenv import load_dotenv
 from flask import Flask, jsonify, make_response, request, send_file, send_from_directory
 from flask_cors import CORS
@@ -21,30 +23,68 @@ from tqdm import tqdm
 from werkzeug.utils import secure_filename
 import tempfile
 
-from models import BaseModel, TransformerModel, as_numpy, models
-from pdf import get_pdf_content
+from batcher import EmbeddingBatcher, EmbeddingSink
+from chunk_cache import ChunkEmbeddingCache
+from chunkstore import (
+    ChunkStore,
+    ChunkStoreWriter,
+    migrate_tokens_json,
+    write_chunk_store,
+)
+from corpus import ContentRegistry, CorpusStore
+from explain import ExplainEngine
+from jobs import Job, JobQueue, JobQueueFull
+from models import BaseModel, get_transformer_model, models
+from pagecache import PAGE_FORMATS, PageRenderCache
+from pdf import PDFContent, extract_pdf_content, get_pdf_content
+from pipeline import run_pipeline
+from quantize import (
+    QUANTIZE_TYPES,
+    get_num_quantized_embeddings,
+    read_quantized_embeddings_file,
+    write_quantized_embeddings_file,
+)
+from search import CorpusAnnIndex, ExactSearchIndex, search_embeddings
+from serve import SERVE_MODES, serve
+from streaming import TokenStream, iter_text_segments
 from util import (
     HASH_LENGTH,
     file_md5,
-    get_annoy_filename,
+    get_chunk_offsets_filename,
+    get_chunks_filename,
+    get_converted_pdf_txt_filename,
     get_config_filename,
+    get_corpus_index_filename,
     get_embeddings_filename,
-    get_num_annoy_embeddings,
+    get_index_filename,
     get_num_embeddings,
     get_offsets,
+    get_pdf_chars_filename,
+    get_pdf_positions_filename,
+    get_quantized_embeddings_filename,
     get_tokens_filename,
     join_text_chunks,
-    load_annoy_db,
+    memmap_embeddings_file,
     read_embeddings_file,
+    safe_remove,
     sort_results,
-    write_annoy_db,
-    write_embedding,
 )
-from PyQt5.QtWidgets import QApplication, QFileDialog
+from vectorindex import (
+    INDEX_BACKENDS,
+    create_index,
+    get_num_index_items,
+    hnswlib_installed,
+    load_index,
+    write_index_from_file,
+)
 
-VERSION = pkg_resources.require("semantra")[0].version
+VERSION = importlib.metadata.version("semantra")
 DEFAULT_ENCODING = "utf-8"
 DEFAULT_PORT = 5000
+# Uploads and deletes would only reach the worker process handling them
+PREFORK_READ_ONLY_ERROR = (
+    "Uploading and deleting files is not supported in the prefork serve mode"
+)
 
 package_directory = os.path.dirname(os.path.abspath(__file__))
 
@@ -58,8 +98,12 @@ class Content:
         self.filetype = "text"
 
 
+def get_filetype(filename):
+    return "pdf" if filename.endswith(".pdf") else "text"
+
+
 def get_text_content(md5, filename, semantra_dir, force, silent, encoding):
-    if filename.endswith(".pdf"):
+    if get_filetype(filename) == "pdf":
         return get_pdf_content(md5, filename, semantra_dir, force, silent)
 
     with open(filename, "r", encoding=encoding, errors="ignore") as f:
@@ -68,6 +112,8 @@ def get_text_content(md5, filename, semantra_dir, force, silent, encoding):
 
 
 TRANSFORMER_POOL_DEFAULT = 15000
+CHUNK_CACHE_FILENAME = "chunk_embeddings.sqlite"
+PAGE_CACHE_DIRNAME = "pages"
 
 
 class Document:
@@ -79,13 +125,17 @@ class Document:
         base_filename,
         config,
         embeddings_filenames,
-        use_annoy,
-        annoy_filenames,
+        use_index,
+        index_backend,
+        index_filenames,
         windows,
         offsets,
-        tokens_filename,
+        chunks_filename,
+        chunk_offsets_filename,
         num_dimensions,
         encoding,
+        quantize=None,
+        quantized_filenames=None,
     ):
         self.filename = filename
         self.md5 = md5
@@ -93,38 +143,106 @@ class Document:
         self.base_filename = base_filename
         self.config = config
         self.embeddings_filenames = embeddings_filenames
-        self.use_annoy = use_annoy
-        self.annoy_filenames = annoy_filenames
+        self.use_index = use_index
+        self.index_backend = index_backend
+        self.index_filenames = index_filenames
         self.windows = windows
         self.offsets = offsets
-        self.tokens_filename = tokens_filename
+        self.chunks_filename = chunks_filename
+        self.chunk_offsets_filename = chunk_offsets_filename
         self.num_dimensions = num_dimensions
         self.encoding = encoding
+        self.quantize = quantize
+        self.quantized_filenames = quantized_filenames
+        self.filetype = get_filetype(filename)
+        self.cached_positions = None
+        # Memory-mapped float32 embeddings of quantized documents, see
+        # embeddings
+        self.cached_embeddings = None
+        # Resident corpus store serving loaded resources, if any
+        self.store = None
+        # Sink of the first window's embeddings while they are calculated
+        self.embedding_sink = None
+        self.index_built = False
 
     @property
-    def content(self):
-        return get_text_content(
-            self.md5, self.filename, self.semantra_dir, False, True, self.encoding
-        )
+    def positions(self):
+        # Page positions of PDFs, loaded once from their extracted index
+        if self.filetype != "pdf":
+            return []
+        if self.cached_positions is None:
+            position_index = os.path.join(
+                self.semantra_dir, get_pdf_positions_filename(self.md5)
+            )
+            with open(position_index, "r", encoding="utf-8") as f:
+                self.cached_positions = json.load(f)
+        return self.cached_positions
+
+    def open_content(self):
+        # Open the document to serve it without reading its extracted text
+        if self.filetype == "pdf":
+            chars_filename = os.path.join(
+                self.semantra_dir, get_pdf_chars_filename(self.md5)
+            )
+            return PDFContent(None, self.filename, self.positions, chars_filename)
+        return Content(None, self.filename)
 
     @property
     def text_chunks(self):
-        with open(self.tokens_filename, "r") as f:
-            return json.loads(f.read())
+        if self.store is not None:
+            return self.store.get(self, "text_chunks")
+        return self.load_text_chunks()
+
+    def load_text_chunks(self):
+        return ChunkStore(self.chunks_filename, self.chunk_offsets_filename)
 
     @property
     def num_embeddings(self):
         return len(self.offsets[0])
 
     @property
-    def embedding_db(self):
-        if not self.use_annoy:
-            raise ValueError("Embeddings are not stored in Annoy database")
-        return load_annoy_db(self.annoy_filenames[0], self.num_dimensions)
+    def embedding_index(self):
+        if not self.use_index:
+            raise ValueError("Embeddings are not stored in a vector index")
+        if self.store is not None:
+            return self.store.get(self, "embedding_index")
+        return self.load_embedding_index()
+
+    def load_embedding_index(self):
+        return load_index(
+            self.index_backend, self.index_filenames[0], self.num_dimensions
+        )
+
+    @property
+    def index_ready(self):
+        # Vector indexes may be built some time after embedding is complete
+        if not self.index_built:
+            self.index_built = self.ready and os.path.exists(self.index_filenames[0])
+        return self.index_built
+
+    @property
+    def ready(self):
+        # Whether the first window's embeddings (and vector index) are written
+        return self.embedding_sink is None or self.embedding_sink.complete
 
     @property
     def embeddings(self):
-        results, embedding_count = read_embeddings_file(
+        if not self.ready:
+            embeddings = self.embedding_sink.get_embeddings()
+            if embeddings is not None:
+                return embeddings
+        if self.quantize is not None:
+            # Searches only read the rows they re-rank, so the memory map
+            # isn't loaded into (or counted against) the corpus store
+            if self.cached_embeddings is None:
+                self.cached_embeddings = self.load_embeddings()
+            return self.cached_embeddings
+        if self.store is not None:
+            return self.store.get(self, "embeddings")
+        return self.load_embeddings()
+
+    def load_embeddings(self):
+        results, embedding_count = memmap_embeddings_file(
             self.embeddings_filenames[0],
             self.num_dimensions,
             self.num_embeddings,
@@ -132,54 +250,235 @@ class Document:
         assert embedding_count == self.num_embeddings
         return results
 
+    @property
+    def quantized_embeddings(self):
+        if self.quantize is None:
+            raise ValueError("Embeddings are not quantized")
+        if self.store is not None:
+            return self.store.get(self, "quantized_embeddings")
+        return self.load_quantized_embeddings()
+
+    def load_quantized_embeddings(self):
+        return read_quantized_embeddings_file(
+            self.quantized_filenames[0], self.num_dimensions, self.quantize
+        )
+
 
-def process(
+def get_full_config(
+    config,
     filename,
-    semantra_dir,
-    model,
+    md5,
     num_dimensions,
-    use_annoy,
-    num_annoy_trees,
-    windows,
     cost_per_token,
-    pool_count,
-    pool_size,
-    force,
-    silent,
-    no_confirm,
-    encoding,
+    windows,
+    num_tokens,
+    offsets,
+    num_embedding_tokens,
+    use_index,
+    index_backend,
+    num_annoy_trees,
+    quantize=None,
+):
+    return {
+        **config,
+        "filename": filename,
+        "md5": md5,
+        "base_filename": os.path.basename(filename),
+        "num_dimensions": num_dimensions,
+        "cost_per_token": cost_per_token,
+        "windows": windows,
+        "num_tokens": num_tokens,
+        "num_embeddings": len(offsets),
+        "num_embedding_tokens": num_embedding_tokens,
+        "use_annoy": use_index and index_backend == "annoy",
+        "index_backend": index_backend if use_index else "exact",
+        "num_annoy_trees": num_annoy_trees,
+        "quantize": quantize,
+        "semantra_version": VERSION,
+    }
+
+
+def is_embedded(
+    embeddings_filename, index_backend, index_filename, num_dimensions, num_windows
 ):
+    # Whether all windows are embedded (and in the vector index, if any)
+    if not os.path.exists(embeddings_filename):
+        return False
+    if get_num_embeddings(embeddings_filename, num_dimensions) != num_windows:
+        return False
+    if index_filename is None:
+        return True
+    return (
+        os.path.exists(index_filename)
+        and get_num_index_items(index_backend, index_filename, num_dimensions)
+        == num_windows
+    )
+
+
+def ensure_quantized(
+    quantized_filename, embeddings_filename, num_dimensions, num_windows, quantize
+):
+    # Quantize complete embeddings missing their quantized copy, e.g. when
+    # --quantize is turned on for files embedded before
+    if quantize is None:
+        return
+    if (
+        os.path.exists(quantized_filename)
+        and get_num_quantized_embeddings(quantized_filename, num_dimensions, quantize)
+        == num_windows
+    ):
+        return
+    write_quantized_embeddings_file(
+        quantized_filename, embeddings_filename, num_dimensions, quantize
+    )
+
+
+def get_chunk_store_filenames(semantra_dir, md5, config_hash):
+    chunks_filename = os.path.join(semantra_dir, get_chunks_filename(md5, config_hash))
+    chunk_offsets_filename = os.path.join(
+        semantra_dir, get_chunk_offsets_filename(md5, config_hash)
+    )
+    # Convert the text chunks of older versions the first time they are used
+    tokens_filename = os.path.join(semantra_dir, get_tokens_filename(md5, config_hash))
+    if os.path.exists(tokens_filename) and not os.path.exists(chunk_offsets_filename):
+        migrate_tokens_json(tokens_filename, chunks_filename, chunk_offsets_filename)
+    return chunks_filename, chunk_offsets_filename
+
+
+class TokenizedFile:
+    def __init__(self, filename, md5, config, config_hash, text_chunks, tokens):
+        self.filename = filename
+        self.md5 = md5
+        self.config = config
+        self.config_hash = config_hash
+        self.text_chunks = text_chunks
+        # Model tokens, or None if the text chunks were loaded from cache
+        self.tokens = tokens
+
+
+def tokenize(filename, semantra_dir, model, force, silent, encoding, md5=None):
     # Check if semantra dir exists
     if not os.path.exists(semantra_dir):
         os.makedirs(semantra_dir)
 
-    # Get the md5 and config
-    md5 = file_md5(filename)
-    base_filename = os.path.basename(filename)
+    # Get the md5 and config. If the md5 is passed in, the file has already
+    # been prepared (and any PDF extracted) by the ingestion pipeline
+    prepared = md5 is not None
+    if not prepared:
+        md5 = file_md5(filename)
     config = model.get_config()
     if encoding != DEFAULT_ENCODING:
         config["encoding"] = encoding
     config_hash = hashlib.shake_256(json.dumps(config).encode()).hexdigest(HASH_LENGTH)
 
-    # File names
-    tokens_filename = os.path.join(semantra_dir, get_tokens_filename(md5, config_hash))
-    config_filename = os.path.join(semantra_dir, get_config_filename(md5, config_hash))
+    chunks_filename, chunk_offsets_filename = get_chunk_store_filenames(
+        semantra_dir, md5, config_hash
+    )
 
-    should_calculate_tokens = True
-    if force or not os.path.exists(tokens_filename):
+    tokens = None
+    if force or not os.path.exists(chunk_offsets_filename):
         # Calculate tokens to get text chunks
-        content = get_text_content(md5, filename, semantra_dir, force, silent, encoding)
+        content = get_text_content(
+            md5, filename, semantra_dir, force and not prepared, silent, encoding
+        )
         text = content.rawtext
         tokens = model.get_tokens(text)
-        should_calculate_tokens = False
         text_chunks = model.get_text_chunks(text, tokens)
-        with open(tokens_filename, "w") as f:
-            f.write(json.dumps(text_chunks))
+        write_chunk_store(
+            chunks_filename,
+            chunk_offsets_filename,
+            text_chunks,
+            model.get_token_ids(tokens),
+        )
+    else:
+        text_chunks = ChunkStore(chunks_filename, chunk_offsets_filename)
+
+    return TokenizedFile(filename, md5, config, config_hash, text_chunks, tokens)
+
+
+def build_index(
+    index_backend,
+    index_filename,
+    embeddings_filename,
+    num_dimensions,
+    num_annoy_trees,
+    index_builds=None,
+):
+    # Build a vector index now, or leave it to be built later
+    build = functools.partial(
+        write_index_from_file,
+        index_backend,
+        index_filename,
+        embeddings_filename,
+        num_dimensions,
+        num_annoy_trees,
+    )
+    if index_builds is None:
+        build()
     else:
-        with open(tokens_filename, "r") as f:
-            text_chunks = json.loads(f.read())
+        index_builds.append(build)
+
+
+def process(
+    filename,
+    semantra_dir,
+    model,
+    num_dimensions,
+    use_index,
+    index_backend,
+    num_annoy_trees,
+    windows,
+    cost_per_token,
+    pool_count,
+    pool_size,
+    force,
+    silent,
+    no_confirm,
+    encoding,
+    tokenized=None,
+    batcher=None,
+    chunk_cache=None,
+    on_document=None,
+    on_progress=None,
+    index_builds=None,
+    quantize=None,
+):
+    """Tokenize and embed a file, returning its `Document`.
+
+    `on_document` is called with the document before its embeddings are
+    calculated; until then, it is searchable as far as they have been
+    calculated. `on_progress` is called with the number of tokens processed so
+    far and the total as the progress bar advances. Vector indexes are built
+    as soon as embeddings are complete, unless `index_builds` is given: then
+    the builds are appended to it, to be called once a batch is embedded.
+    With `quantize` ("float16" or "int8"), quantized copies of the embeddings
+    are written alongside them.
+    """
+    if tokenized is None:
+        tokenized = tokenize(filename, semantra_dir, model, force, silent, encoding)
+
+    # Without a shared batcher, embed this document's windows on its own. With
+    # one, embeddings and vector indexes are complete once it is flushed
+    flush_batcher = batcher is None
+    if flush_batcher:
+        batcher = EmbeddingBatcher(model, pool_size, pool_count, chunk_cache)
+
+    md5 = tokenized.md5
+    base_filename = os.path.basename(filename)
+    config = tokenized.config
+    config_hash = tokenized.config_hash
+    text_chunks = tokenized.text_chunks
+    tokens = tokenized.tokens
+    should_calculate_tokens = tokens is None
     num_tokens = len(text_chunks)
 
+    # File names
+    chunks_filename = os.path.join(semantra_dir, get_chunks_filename(md5, config_hash))
+    chunk_offsets_filename = os.path.join(
+        semantra_dir, get_chunk_offsets_filename(md5, config_hash)
+    )
+    config_filename = os.path.join(semantra_dir, get_config_filename(md5, config_hash))
+
     # Get embedding offsets based on config parameters
     (
         offsets,
@@ -187,21 +486,21 @@ def process(
     ) = get_offsets(num_tokens, windows)
 
     # Full config contains additional details
-    full_config = {
-        **config,
-        "filename": filename,
-        "md5": md5,
-        "base_filename": base_filename,
-        "num_dimensions": num_dimensions,
-        "cost_per_token": cost_per_token,
-        "windows": windows,
-        "num_tokens": num_tokens,
-        "num_embeddings": len(offsets),
-        "num_embedding_tokens": num_embedding_tokens,
-        "use_annoy": use_annoy,
-        "num_annoy_trees": num_annoy_trees,
-        "semantra_version": VERSION,
-    }
+    full_config = get_full_config(
+        config,
+        filename,
+        md5,
+        num_dimensions,
+        cost_per_token,
+        windows,
+        num_tokens,
+        offsets,
+        num_embedding_tokens,
+        use_index,
+        index_backend,
+        num_annoy_trees,
+        quantize,
+    )
 
     if force or not os.path.exists(config_filename):
         if cost_per_token is not None and not no_confirm:
@@ -215,134 +514,437 @@ def process(
         f.write(json.dumps(full_config))
 
     embeddings_filenames = []
-    annoy_filenames = []
+    index_filenames = []
+    quantized_filenames = []
+    sinks = []
+    num_skips = []
+    for (size, offset, rewind), sub_offsets in zip(windows, offsets):
+        embeddings_filename = os.path.join(
+            semantra_dir,
+            get_embeddings_filename(md5, config_hash, size, offset, rewind),
+        )
+        index_filename = os.path.join(
+            semantra_dir,
+            get_index_filename(
+                md5, config_hash, size, offset, rewind, index_backend, num_annoy_trees
+            ),
+        )
+        quantized_filename = os.path.join(
+            semantra_dir,
+            get_quantized_embeddings_filename(
+                md5, config_hash, size, offset, rewind, quantize
+            ),
+        )
+        embeddings_filenames.append(embeddings_filename)
+        index_filenames.append(index_filename)
+        quantized_filenames.append(quantized_filename)
+
+        if not force and is_embedded(
+            embeddings_filename,
+            index_backend,
+            index_filename if use_index else None,
+            num_dimensions,
+            len(sub_offsets),
+        ):
+            # Embedding is fully calculated
+            ensure_quantized(
+                quantized_filename,
+                embeddings_filename,
+                num_dimensions,
+                len(sub_offsets),
+                quantize,
+            )
+            sinks.append(None)
+            num_skips.append(0)
+            continue
+
+        if should_calculate_tokens:
+            tokens = model.get_tokens(join_text_chunks(text_chunks))
+            should_calculate_tokens = False
+
+        # Read embeddings if they exist
+        embedding_index = 0
+        if not force and os.path.exists(embeddings_filename):
+            embeddings, embedding_index = read_embeddings_file(
+                embeddings_filename, num_dimensions, len(sub_offsets)
+            )
+        else:
+            embeddings = np.empty((len(sub_offsets), num_dimensions), dtype=np.float32)
+            embedding_index = 0
+            # Start over rather than appending to stale embeddings
+            safe_remove(embeddings_filename)
+        # The vector index only exists once it is rebuilt with all embeddings
+        safe_remove(index_filename)
+
+        def on_complete(
+            _,
+            embeddings_filename=embeddings_filename,
+            index_filename=index_filename,
+            quantized_filename=quantized_filename,
+        ):
+            if quantize is not None:
+                write_quantized_embeddings_file(
+                    quantized_filename, embeddings_filename, num_dimensions, quantize
+                )
+            # Write embeddings db
+            if use_index:
+                build_index(
+                    index_backend,
+                    index_filename,
+                    embeddings_filename,
+                    num_dimensions,
+                    num_annoy_trees,
+                    index_builds,
+                )
+
+        sinks.append(
+            EmbeddingSink(embeddings_filename, embeddings, embedding_index, on_complete)
+        )
+        num_skips.append(embedding_index)
+
+    document = Document(
+        filename=filename,
+        md5=md5,
+        semantra_dir=semantra_dir,
+        base_filename=base_filename,
+        config=full_config,
+        embeddings_filenames=embeddings_filenames,
+        use_index=use_index,
+        index_backend=index_backend,
+        index_filenames=index_filenames,
+        windows=windows,
+        offsets=offsets,
+        chunks_filename=chunks_filename,
+        chunk_offsets_filename=chunk_offsets_filename,
+        num_dimensions=num_dimensions,
+        encoding=encoding,
+        quantize=quantize,
+        quantized_filenames=quantized_filenames,
+    )
+    # Until the first window is complete, its embeddings are searched as
+    # they arrive
+    document.embedding_sink = sinks[0]
+    if on_document is not None:
+        on_document(document)
+
     with tqdm(
         total=num_embedding_tokens,
         desc="Calculating embeddings",
         leave=False,
         disable=silent,
     ) as pbar:
-        for (size, offset, rewind), sub_offsets in zip(windows, offsets):
-            embeddings_filename = os.path.join(
-                semantra_dir,
-                get_embeddings_filename(md5, config_hash, size, offset, rewind),
-            )
-            annoy_filename = os.path.join(
-                semantra_dir,
-                get_annoy_filename(
-                    md5, config_hash, size, offset, rewind, num_annoy_trees
-                ),
-            )
-            embeddings_filenames.append(embeddings_filename)
-            annoy_filenames.append(annoy_filename)
+        # Counted separately, as disabled progress bars don't count
+        num_processed = 0
 
-            if os.path.exists(embeddings_filename) and (
-                not use_annoy or os.path.exists(annoy_filename)
-            ):
-                num_embeddings = get_num_embeddings(embeddings_filename, num_dimensions)
-                if use_annoy:
-                    num_annoy_embeddings = get_num_annoy_embeddings(
-                        annoy_filename, num_dimensions
-                    )
+        def update_progress(size):
+            nonlocal num_processed
+            num_processed += size
+            pbar.update(size)
+            if on_progress is not None:
+                on_progress(num_processed, num_embedding_tokens)
 
-                if (
-                    not force
-                    and num_embeddings == len(sub_offsets)
-                    and (not use_annoy or num_annoy_embeddings == len(sub_offsets))
-                ):
-                    # Embedding is fully calculated
+        for sink, num_skip, sub_offsets in zip(sinks, num_skips, offsets):
+            if sink is None:
+                continue
+
+            # Queue windows to be embedded and written out by the batcher
+            iteration = 0
+            for offset in sub_offsets:
+                size = offset[1] - offset[0]
+
+                # Skip if already calculated
+                if iteration < num_skip:
+                    iteration += 1
+                    update_progress(size)
                     continue
 
-            if should_calculate_tokens:
-                tokens = model.get_tokens(join_text_chunks(text_chunks))
-                should_calculate_tokens = False
+                window_text = join_text_chunks(text_chunks[offset[0] : offset[1]])
+                if len(window_text) == 0:
+                    update_progress(size)
+                    continue
 
-            # Read embeddings if they exist
-            embedding_index = 0
-            if not force and os.path.exists(embeddings_filename):
-                embeddings, embedding_index = read_embeddings_file(
-                    embeddings_filename, num_dimensions, len(sub_offsets)
-                )
-            else:
-                embeddings = np.empty(
-                    (len(sub_offsets), num_dimensions), dtype=np.float32
-                )
-                embedding_index = 0
+                batcher.add(sink, tokens, offset)
+                update_progress(size)
+            sink.finish()
 
-            num_skip = embedding_index
-            iteration = 0
+        if flush_batcher:
+            batcher.flush()
 
-            # Write embeddings
-            pool = []
-            pool_token_count = 0
+    return document
 
-            with open(embeddings_filename, "ab") as f:
 
-                def flush_pool():
-                    nonlocal pool, pool_token_count, embeddings, embedding_index, f
+# Rough number of bytes of text per token, to estimate costs before streaming
+BYTES_PER_TOKEN_ESTIMATE = 4
 
-                    if len(pool) > 0:
-                        embedding_results = model.embed(tokens, pool)
-                        # Call .cpu if embedding_results contains it
-                        if hasattr(embedding_results, "cpu"):
-                            embedding_results = embedding_results.cpu()
-                        embeddings[embedding_index : embedding_index + len(pool)] = (
-                            embedding_results
-                        )
-                        for embedding in embedding_results:
-                            write_embedding(f, embedding, num_dimensions)
-                        embedding_index += len(pool)
-                        pool = []
-                        pool_token_count = 0
-
-                for offset in sub_offsets:
-                    size = offset[1] - offset[0]
-
-                    # Skip if already calculated
-                    if iteration < num_skip:
-                        iteration += 1
-                        pbar.update(size)
-                        continue
-
-                    window_text = join_text_chunks(text_chunks[offset[0] : offset[1]])
-                    if len(window_text) == 0:
-                        pbar.update(size)
-                        continue
-
-                    pool.append(offset)
-                    pool_token_count += size
-                    if (
-                        pool_count is not None and len(pool) >= pool_count
-                    ) or pool_token_count >= pool_size:
-                        flush_pool()
-                    pbar.update(size)
-
-                flush_pool()
 
-            # Write embeddings db
-            if use_annoy:
-                write_annoy_db(
-                    filename=annoy_filename,
-                    num_dimensions=num_dimensions,
-                    embeddings=embeddings,
-                    num_trees=num_annoy_trees,
+def process_streaming(
+    filename,
+    semantra_dir,
+    model,
+    num_dimensions,
+    use_index,
+    index_backend,
+    num_annoy_trees,
+    windows,
+    cost_per_token,
+    pool_count,
+    pool_size,
+    force,
+    silent,
+    no_confirm,
+    encoding,
+    md5=None,
+    batcher=None,
+    chunk_cache=None,
+    on_progress=None,
+    index_builds=None,
+    quantize=None,
+):
+    """Tokenize and embed a file in bounded-size segments.
+
+    Unlike `process`, the file is never fully loaded into memory: segments
+    are read, tokenized and windowed one at a time, windows are embedded as
+    soon as their tokens are available, and text chunks and embeddings are
+    written out incrementally. `on_progress` is called with the number of
+    bytes of text read so far and the total, and vector index builds and
+    quantized embeddings are handled as in `process`.
+    """
+    if not os.path.exists(semantra_dir):
+        os.makedirs(semantra_dir)
+
+    flush_batcher = batcher is None
+    if flush_batcher:
+        batcher = EmbeddingBatcher(model, pool_size, pool_count, chunk_cache)
+
+    # If the md5 is passed in, the file has already been prepared (and any
+    # PDF extracted) by the ingestion pipeline
+    prepared = md5 is not None
+    if not prepared:
+        md5 = file_md5(filename)
+    config = model.get_config()
+    if encoding != DEFAULT_ENCODING:
+        config["encoding"] = encoding
+    # Segments are tokenized separately, which can differ slightly from
+    # tokenizing the whole text at once
+    config["streaming"] = True
+    config_hash = hashlib.shake_256(json.dumps(config).encode()).hexdigest(HASH_LENGTH)
+
+    chunks_filename, chunk_offsets_filename = get_chunk_store_filenames(
+        semantra_dir, md5, config_hash
+    )
+    config_filename = os.path.join(semantra_dir, get_config_filename(md5, config_hash))
+    embeddings_filenames = [
+        os.path.join(
+            semantra_dir,
+            get_embeddings_filename(md5, config_hash, size, offset, rewind),
+        )
+        for size, offset, rewind in windows
+    ]
+    index_filenames = [
+        os.path.join(
+            semantra_dir,
+            get_index_filename(
+                md5, config_hash, size, offset, rewind, index_backend, num_annoy_trees
+            ),
+        )
+        for size, offset, rewind in windows
+    ]
+    quantized_filenames = [
+        os.path.join(
+            semantra_dir,
+            get_quantized_embeddings_filename(
+                md5, config_hash, size, offset, rewind, quantize
+            ),
+        )
+        for size, offset, rewind in windows
+    ]
+
+    def make_document(full_config, offsets):
+        return Document(
+            filename=filename,
+            md5=md5,
+            semantra_dir=semantra_dir,
+            base_filename=os.path.basename(filename),
+            config=full_config,
+            embeddings_filenames=embeddings_filenames,
+            use_index=use_index,
+            index_backend=index_backend,
+            index_filenames=index_filenames,
+            windows=windows,
+            offsets=offsets,
+            chunks_filename=chunks_filename,
+            chunk_offsets_filename=chunk_offsets_filename,
+            num_dimensions=num_dimensions,
+            encoding=encoding,
+            quantize=quantize,
+            quantized_filenames=quantized_filenames,
+        )
+
+    # The windows of a previous run follow from its number of tokens
+    if (
+        not force
+        and os.path.exists(config_filename)
+        and os.path.exists(chunk_offsets_filename)
+    ):
+        with open(config_filename, "r") as f:
+            full_config = json.loads(f.read())
+        offsets, _ = get_offsets(full_config["num_tokens"], windows)
+        if all(
+            is_embedded(
+                embeddings_filename,
+                index_backend,
+                index_filename if use_index else None,
+                num_dimensions,
+                len(sub_offsets),
+            )
+            for embeddings_filename, index_filename, sub_offsets in zip(
+                embeddings_filenames, index_filenames, offsets
+            )
+        ):
+            for embeddings_filename, quantized_filename, sub_offsets in zip(
+                embeddings_filenames, quantized_filenames, offsets
+            ):
+                ensure_quantized(
+                    quantized_filename,
+                    embeddings_filename,
+                    num_dimensions,
+                    len(sub_offsets),
+                    quantize,
                 )
+            return make_document(full_config, offsets)
+
+    # Stream the extracted text of PDFs
+    if get_filetype(filename) == "pdf":
+        extract_pdf_content(md5, filename, semantra_dir, force and not prepared, silent)
+        text_filename = os.path.join(semantra_dir, get_converted_pdf_txt_filename(md5))
+        text_file = open(
+            text_filename, "r", newline="", encoding="utf-8", errors="ignore"
+        )
+    else:
+        text_filename = filename
+        text_file = open(filename, "r", encoding=encoding, errors="ignore")
 
-    return Document(
-        filename=filename,
-        md5=md5,
-        semantra_dir=semantra_dir,
-        base_filename=base_filename,
-        config=full_config,
-        embeddings_filenames=embeddings_filenames,
-        use_annoy=use_annoy,
-        annoy_filenames=annoy_filenames,
-        windows=windows,
-        offsets=offsets,
-        tokens_filename=tokens_filename,
-        num_dimensions=num_dimensions,
-        encoding=encoding,
+    if (force or not os.path.exists(config_filename)) and (
+        cost_per_token is not None and not no_confirm
+    ):
+        # The number of tokens is only known once the file has been read
+        _, estimated_embedding_tokens = get_offsets(
+            os.path.getsize(text_filename) // BYTES_PER_TOKEN_ESTIMATE, windows
+        )
+        click.confirm(
+            f"Tokens will cost about ${estimated_embedding_tokens * cost_per_token:.2f}. Proceed?",
+            abort=True,
+        )
+
+    # Resume after the embeddings of a previous run
+    sinks = []
+    num_skip = []
+    for embeddings_filename, index_filename, quantized_filename in zip(
+        embeddings_filenames, index_filenames, quantized_filenames
+    ):
+        if not force and os.path.exists(embeddings_filename):
+            num_embeddings = get_num_embeddings(embeddings_filename, num_dimensions)
+            # Drop any partly written last row, so that appended embeddings
+            # line up with their windows
+            with open(embeddings_filename, "ab") as f:
+                f.truncate(num_embeddings * num_dimensions * 4)
+            num_skip.append(num_embeddings)
+        else:
+            num_skip.append(0)
+            safe_remove(embeddings_filename)
+        # The vector index only exists once it is rebuilt with all embeddings
+        safe_remove(index_filename)
+
+        def on_complete(
+            _,
+            embeddings_filename=embeddings_filename,
+            index_filename=index_filename,
+            quantized_filename=quantized_filename,
+        ):
+            if quantize is not None:
+                write_quantized_embeddings_file(
+                    quantized_filename, embeddings_filename, num_dimensions, quantize
+                )
+            if use_index:
+                build_index(
+                    index_backend,
+                    index_filename,
+                    embeddings_filename,
+                    num_dimensions,
+                    num_annoy_trees,
+                    index_builds,
+                )
+
+        sinks.append(
+            EmbeddingSink(embeddings_filename, None, num_skip[-1], on_complete)
+        )
+
+    offsets = [[] for _ in windows]
+    text_size = os.path.getsize(text_filename)
+    with text_file, ChunkStoreWriter(
+        chunks_filename, chunk_offsets_filename
+    ) as chunk_writer, tqdm(
+        total=text_size,
+        desc="Calculating embeddings",
+        unit="B",
+        unit_scale=True,
+        leave=False,
+        disable=silent,
+    ) as pbar:
+        # Counted separately, as disabled progress bars don't count
+        num_read = 0
+
+        def read_segments():
+            nonlocal num_read
+            for segment in iter_text_segments(text_file):
+                yield segment
+                num_read += len(segment)
+                pbar.update(len(segment))
+                if on_progress is not None:
+                    on_progress(num_read, text_size)
+
+        def write_chunks(text_chunks, tokens):
+            chunk_writer.append(text_chunks, model.get_token_ids(tokens))
+
+        stream = TokenStream(model, read_segments(), windows, write_chunks)
+        for window in stream.windows():
+            window_index, offset, tokens, tokens_offset, text_chunks = window
+            offsets[window_index].append(offset)
+            # Skip if already calculated
+            if len(offsets[window_index]) <= num_skip[window_index]:
+                continue
+            if len(join_text_chunks(text_chunks)) == 0:
+                continue
+            batcher.add(sinks[window_index], tokens, tokens_offset)
+
+    for sink in sinks:
+        sink.finish()
+
+    num_embedding_tokens = sum(
+        end - start for sub_offsets in offsets for start, end in sub_offsets
+    )
+    full_config = get_full_config(
+        config,
+        filename,
+        md5,
+        num_dimensions,
+        cost_per_token,
+        windows,
+        stream.num_tokens,
+        offsets,
+        num_embedding_tokens,
+        use_index,
+        index_backend,
+        num_annoy_trees,
+        quantize,
     )
+    with open(config_filename, "w") as f:
+        f.write(json.dumps(full_config))
+
+    if flush_batcher:
+        batcher.flush()
+
+    return make_document(full_config, offsets)
 
 
 def process_windows(windows: str) -> "list[tuple[int, int, int]]":
@@ -360,6 +962,9 @@ def process_windows(windows: str) -> "list[tuple[int, int, int]]":
 
 
 def ask_for_pdf_file():
+    # PyQt is slow to import and only needed for the file dialog
+    from PyQt5.QtWidgets import QApplication, QFileDialog
+
     app = QApplication(sys.argv)
     pdf_path, _ = QFileDialog.getOpenFileName(
         None, "Select a PDF file", "", "PDF Files (*.pdf)"
@@ -422,6 +1027,26 @@ def ask_for_pdf_file():
     show_default=True,
     help="Host to use for embedding server. Set to 0.0.0.0 to make the server available externally.",
 )
+@click.option(
+    "--serve-mode",
+    type=click.Choice(SERVE_MODES),
+    default="debug",
+    show_default=True,
+    help="How to serve the UI: Flask's debug server, a pool of threads, or pre-forked worker processes sharing the loaded model and corpus. In prefork mode, files can't be uploaded or deleted through the UI, and vector indexes are built before serving",
+)
+@click.option(
+    "--serve-workers",
+    type=int,
+    default=None,
+    help="Number of threads (threaded) or processes (prefork) serving requests (default: number of CPUs)",
+)
+@click.option(
+    "--upload-workers",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of files uploaded through the UI to process at once in the background",
+)
 @click.option(
     "--pool-size",
     type=int,
@@ -466,12 +1091,18 @@ def ask_for_pdf_file():
     help="Number of results (neighbors) to retrieve per file for queries",
 )
 @click.option(
-    "--annoy",
-    is_flag=True,
+    "--annoy/--no-annoy",
     default=True,
     show_default=True,
     help="Use approximate kNN via Annoy for queries (faster querying at a slight cost of accuracy); if false, use exact exhaustive kNN",
 )
+@click.option(
+    "--index-backend",
+    type=click.Choice(INDEX_BACKENDS),
+    default="annoy",
+    show_default=True,
+    help="Vector index to use for approximate kNN: Annoy, an HNSW graph that files can be added to and removed from without rebuilding, or exact exhaustive kNN (same as --no-annoy)",
+)
 @click.option(
     "--num-annoy-trees",
     type=int,
@@ -479,6 +1110,19 @@ def ask_for_pdf_file():
     show_default=True,
     help="Number of trees to use for approximate kNN via Annoy",
 )
+@click.option(
+    "--corpus-index",
+    is_flag=True,
+    default=False,
+    help="Search all files with a single vector index instead of one per file, returning the top --num-results results across all files rather than per file",
+)
+@click.option(
+    "--quantize",
+    type=click.Choice(["none"] + QUANTIZE_TYPES),
+    default="none",
+    show_default=True,
+    help="Also store embeddings as float16 or per-vector scaled int8, and search those in memory for exact kNN (--no-annoy), re-ranking the best candidates in full precision. Ignored with approximate kNN or --svm",
+)
 @click.option(
     "--svm",
     is_flag=True,
@@ -553,6 +1197,45 @@ def ask_for_pdf_file():
     default=None,
     help="Directory to store semantra files in",
 )
+@click.option(
+    "--ingest-workers",
+    type=int,
+    default=None,
+    help="Number of worker processes used to hash files and extract PDF pages while embedding (default: number of CPUs)",
+)
+@click.option(
+    "--streaming",
+    is_flag=True,
+    default=False,
+    help="Read, tokenize and embed files in bounded-size segments, so very large files never have to fit in memory",
+)
+@click.option(
+    "--chunk-cache-size",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Max megabytes of window embeddings to cache by content in an SQLite database in the Semantra directory, so identical windows across documents and runs are only embedded once. 0 disables the cache",
+)
+@click.option(
+    "--page-cache-size",
+    type=int,
+    default=256,
+    show_default=True,
+    help="Max megabytes of rendered PDF pages to keep in memory",
+)
+@click.option(
+    "--page-cache-disk-size",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="Max megabytes of rendered PDF pages to keep on disk",
+)
+@click.option(
+    "--memory-budget",
+    type=int,
+    default=None,
+    help="Max megabytes of embeddings, vector indexes, text chunks and the exact search matrix to keep loaded in memory between queries (default: unlimited)",
+)
 @click.option(
     "--search",
     type=str,
@@ -580,6 +1263,9 @@ def main(
     no_server=False,
     port=5000,
     host="0.0.0.0",
+    serve_mode="debug",
+    serve_workers=None,
+    upload_workers=1,
     pool_size=None,
     pool_count=None,
     doc_token_pre=None,
@@ -592,6 +1278,9 @@ def main(
     num_annoy_trees=100,
     num_results=10,
     annoy=True,
+    index_backend="annoy",
+    corpus_index=False,
+    quantize="none",
     svm=False,
     svm_c=1.0,
     explain_split_count=9,
@@ -604,6 +1293,12 @@ def main(
     list_models=False,
     show_semantra_dir=False,
     semantra_dir=None,  # auto
+    ingest_workers=None,
+    streaming=False,
+    chunk_cache_size=0,
+    page_cache_size=256,
+    page_cache_disk_size=1024,
+    memory_budget=None,
     search=None,
     save_search_to=None,
     show_dialog=False,
@@ -655,8 +1350,8 @@ def main(
             pool_size = TRANSFORMER_POOL_DEFAULT
 
         cost_per_token = None
-        model = TransformerModel(
-            transformer_model,
+        model = get_transformer_model(
+            model_name=transformer_model,
             doc_token_pre=doc_token_pre,
             doc_token_post=doc_token_post,
             query_token_pre=query_token_pre,
@@ -679,16 +1374,60 @@ def main(
             "Please use a symmetric model or kNN."
         )
 
-    documents = {}
-    pbar = tqdm(filename, disable=silent)
-    for fn in pbar:
+    if not os.path.exists(semantra_dir):
+        os.makedirs(semantra_dir)
+
+    # The exact backend searches the embeddings themselves
+    use_index = annoy and index_backend != "exact"
+    if use_index and index_backend == "hnsw" and not hnswlib_installed():
+        raise ValueError(
+            "--index-backend hnsw requires hnswlib. "
+            "Please install it with `pip install semantra[hnsw]`."
+        )
+    if quantize == "none":
+        quantize = None
+    elif use_index or svm:
+        # Only exact kNN searches quantized embeddings
+        logger.warning("--quantize only applies to exact kNN (--no-annoy); ignoring it")
+        quantize = None
+
+    def tokenize_file(fn, md5):
+        if streaming:
+            # Streamed files are tokenized as they are embedded
+            return md5
+        return tokenize(fn, semantra_dir, model, force, silent, encoding, md5=md5)
+
+    def process_file(fn, tokenized):
         pbar.set_description(f"{os.path.basename(fn)}")
-        documents[fn] = process(
+        if streaming:
+            return process_streaming(
+                filename=fn,
+                semantra_dir=semantra_dir,
+                model=model,
+                num_dimensions=model.get_num_dimensions(),
+                use_index=use_index,
+                index_backend=index_backend,
+                num_annoy_trees=num_annoy_trees,
+                windows=processed_windows,
+                cost_per_token=cost_per_token,
+                pool_count=pool_count,
+                pool_size=pool_size,
+                force=force,
+                silent=silent,
+                no_confirm=no_confirm,
+                encoding=encoding,
+                md5=tokenized,
+                batcher=batcher,
+                index_builds=index_builds,
+                quantize=quantize,
+            )
+        return process(
             filename=fn,
             semantra_dir=semantra_dir,
             model=model,
             num_dimensions=model.get_num_dimensions(),
-            use_annoy=annoy,
+            use_index=use_index,
+            index_backend=index_backend,
             num_annoy_trees=num_annoy_trees,
             windows=processed_windows,
             cost_per_token=cost_per_token,
@@ -698,47 +1437,154 @@ def main(
             silent=silent,
             no_confirm=no_confirm,
             encoding=encoding,
+            tokenized=tokenized,
+            batcher=batcher,
+            index_builds=index_builds,
+            quantize=quantize,
+        )
+
+    # Share embeddings of identical windows across documents and runs
+    chunk_cache = None
+    if chunk_cache_size > 0:
+        embedding_bytes = model.get_num_dimensions() * 4
+        chunk_cache = ChunkEmbeddingCache(
+            os.path.join(semantra_dir, CHUNK_CACHE_FILENAME),
+            model,
+            max_entries=chunk_cache_size * 1024 * 1024 // embedding_bytes,
         )
 
-    cached_content = None
-    cached_content_filename = None
-
-    def get_content(filename):
-        nonlocal cached_content, cached_content_filename
-        # Check if we can pull from cache
-        if filename == cached_content_filename:
-            return cached_content
-        # If not, grab content
-        content = documents[filename].content
-        # Cache the content
-        cached_content_filename = filename
-        cached_content = content
-        # Return the now-cached content
-        return content
+    # Hash, extract and tokenize upcoming files while the current one embeds,
+    # packing windows from all files into shared embedding batches
+    batcher = EmbeddingBatcher(model, pool_size, pool_count, chunk_cache)
+    # Vector indexes are built once all files are embedded
+    index_builds = []
+    documents = {}
+    # Uploads change the documents from the job queue's threads while requests
+    # read them, so changes are made under this lock and requests work on a
+    # snapshot from get_documents
+    documents_lock = Lock()
+    pbar = tqdm(total=len(filename), disable=silent)
+    for fn, document in run_pipeline(
+        filename,
+        semantra_dir,
+        force,
+        tokenize=tokenize_file,
+        embed=process_file,
+        workers=ingest_workers,
+    ):
+        documents[fn] = document
+        pbar.update(1)
+
+    def get_documents():
+        with documents_lock:
+            return dict(documents)
+    batcher.flush()
+    pbar.close()
+
+    # Build vector indexes in the background while serving. Until a
+    # document's index is built, it is searched exactly
+    index_builder = ThreadPoolExecutor(max_workers=1)
+
+    def build_indexes(builds):
+        for build in builds:
+            try:
+                build()
+            except Exception:
+                logger.exception("Failed to build vector index")
+
+    if no_server:
+        for build in tqdm(
+            index_builds, desc="Building vector indexes", leave=False, disable=silent
+        ):
+            build()
+    else:
+        index_builder.submit(build_indexes, index_builds)
+
+    # Keep loaded document resources resident between queries
+    store = CorpusStore(
+        memory_budget * 1024 * 1024 if memory_budget is not None else None
+    )
+    for doc in documents.values():
+        store.add(doc)
+    exact_index = ExactSearchIndex(quantized=quantize is not None, store=store)
+
+    # Search all documents with one vector index rather than one each
+    corpus_ann_index = None
+    if use_index and corpus_index:
+        # Saved across runs for the model and the first window
+        model_hash = hashlib.shake_256(
+            json.dumps(model.get_config()).encode()
+        ).hexdigest(HASH_LENGTH)
+        corpus_ann_index = CorpusAnnIndex(
+            functools.partial(
+                create_index,
+                index_backend,
+                model.get_num_dimensions(),
+                num_annoy_trees,
+            ),
+            filename=os.path.join(
+                semantra_dir,
+                get_corpus_index_filename(
+                    model_hash, *processed_windows[0], index_backend, num_annoy_trees
+                ),
+            ),
+            load_index=functools.partial(
+                load_index, index_backend, num_dimensions=model.get_num_dimensions()
+            ),
+        )
+        corpus_ann_index.restore(documents)
+        if not no_server:
+            index_builder.submit(corpus_ann_index.update)
+
+    def update_corpus_index():
+        # Index added documents, or rebuild once enough documents were added
+        # or removed since the last build
+        if corpus_ann_index is not None and corpus_ann_index.needs_update():
+            index_builder.submit(corpus_ann_index.update)
+
+    # Highlight what makes results match, embedding their splits in batches
+    explain_engine = ExplainEngine(
+        model, explain_split_count, explain_split_divide, num_explain_highlights
+    )
+
+    # Process uploaded files in the background
+    job_queue = JobQueue(max_workers=upload_workers)
+
+    # Open documents once to serve their files and pages
+    contents = ContentRegistry()
+
+    # Keep rendered pages around for scrolling back and forth through PDFs
+    page_cache = PageRenderCache(
+        os.path.join(semantra_dir, PAGE_CACHE_DIRNAME),
+        memory_budget=page_cache_size * 1024 * 1024,
+        disk_budget=page_cache_disk_size * 1024 * 1024,
+        contents=contents,
+    )
+
+    cleaned_up = False
 
     def cleanup_resources():
+        # Runs on shutdown as well as at exit, but only needs to run once
+        nonlocal cleaned_up
+        if cleaned_up:
+            return
+        cleaned_up = True
         print("Cleaning up resources before shutdown...")
         # Force garbage collection first to resolve any circular references
         gc.collect()
 
-        # Close all document resources
-        for doc_name, doc in list(documents.items()):
-            try:
-                if hasattr(doc, 'content'):
-                    # Handle both PDFContent and Content classes
-                    if hasattr(doc.content, 'close'):
-                        doc.content.close()
-
-                    # Explicitly set pdfium to None to avoid memory leaks
-                    if hasattr(doc.content, 'pdfium'):
-                        try:
-                            if doc.content.pdfium is not None:
-                                doc.content.pdfium.close()
-                        except Exception:
-                            pass
-                        doc.content.pdfium = None
-            except Exception as e:
-                print(f"Error cleaning up document {doc_name}: {e}")
+        # Stop picking up queued uploads and index builds
+        job_queue.shutdown()
+        index_builder.shutdown(wait=False)
+
+        # Close all open document contents
+        page_cache.close()
+        contents.close_all()
+
+        # Release resident embeddings, vector indexes and text chunks
+        store.clear()
+        if chunk_cache is not None:
+            chunk_cache.close()
 
         # Force garbage collection again to clean up any newly dereferenced objects
         gc.collect()
@@ -767,7 +1613,7 @@ def main(
     @app.route("/")
     def base():
         return send_from_directory(
-            pkg_resources.resource_filename("semantra", "client_public"),
+            os.path.join(package_directory, "client_public"),
             "index.html",
         )
 
@@ -775,7 +1621,7 @@ def main(
     @app.route("/<path:path>")
     def home(path):
         return send_from_directory(
-            pkg_resources.resource_filename("semantra", "client_public"),
+            os.path.join(package_directory, "client_public"),
             path,
         )
 
@@ -787,9 +1633,9 @@ def main(
                 {
                     "basename": os.path.basename(doc.filename),
                     "filename": doc.filename,
-                    "filetype": doc.content.filetype,
+                    "filetype": doc.filetype,
                 }
-                for doc in documents.values()
+                for doc in get_documents().values()
             ]
             return jsonify(files_list)
         except Exception as e:
@@ -800,6 +1646,8 @@ def main(
     @app.route("/api/upload", methods=["POST"])
     def upload_files():
         """API endpoint to handle file uploads directly"""
+        if serve_mode == "prefork":
+            return jsonify({"error": PREFORK_READ_ONLY_ERROR}), 405
         if 'files' not in request.files:
             return jsonify({'error': 'No files in request'}), 400
 
@@ -807,70 +1655,121 @@ def main(
         if not files or files[0].filename == '':
             return jsonify({'error': 'No files selected'}), 400
 
-        # List to keep track of processed files
-        processed_files = []
-
         # Create temporary directory for uploads if needed
         temp_dir = tempfile.mkdtemp()
 
-        try:
-            for file in files:
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(temp_dir, filename)
-                file.save(file_path)
-
-                try:
-                    app.logger.info(f"Processing file: {filename}")
-                    # Process the file with existing semantra functionality
-                    document = process(
-                        filename=file_path,
-                        semantra_dir=semantra_dir,
-                        model=model,
-                        num_dimensions=model.get_num_dimensions(),
-                        use_annoy=annoy,
-                        num_annoy_trees=num_annoy_trees,
-                        windows=processed_windows,
-                        cost_per_token=cost_per_token,
-                        pool_count=pool_count,
-                        pool_size=pool_size,
-                        force=False,
-                        silent=True,
-                        no_confirm=True,  # Don't ask for confirmation during API uploads
-                        encoding=encoding,
-                    )
-
-                    # Add the file to documents dictionary
-                    documents[file_path] = document
-
-                    processed_files.append({
-                        'basename': filename,
-                        'filename': file_path,
-                        'filetype': document.content.filetype,
-                        'status': 'success'
-                    })
-
-                    app.logger.info(f"Successfully processed file: {filename}")
+        jobs = []
+        for file in files:
+            filename = secure_filename(file.filename)
+            file_path = os.path.join(temp_dir, filename)
+            file.save(file_path)
+            jobs.append(Job(file_path, filename))
 
-                except Exception as e:
-                    app.logger.error(f"Error processing file {filename}: {str(e)}")
-                    processed_files.append({
-                        'basename': filename,
-                        'filename': file_path,
-                        'status': 'error',
-                        'error': str(e)
-                    })
-
-            return jsonify({
-                'status': 'success',
-                'processed_files': processed_files
-            })
+        # Process the files in the background and let the client poll for them
+        try:
+            job_queue.submit(jobs, process_upload)
+        except JobQueueFull as e:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return jsonify({'error': str(e)}), 503
+
+        return jsonify({
+            'status': 'queued',
+            'jobs': [job.to_dict() for job in jobs]
+        }), 202
+
+    def process_upload(job):
+        app.logger.info(f"Processing file: {job.basename}")
+        index_builds = []
+
+        def on_document(document):
+            # Search the document while its embeddings are being calculated
+            with documents_lock:
+                documents[job.filename] = document
+            job.searchable = True
 
+        try:
+            if streaming:
+                document = process_streaming(
+                    filename=job.filename,
+                    semantra_dir=semantra_dir,
+                    model=model,
+                    num_dimensions=model.get_num_dimensions(),
+                    use_index=use_index,
+                    index_backend=index_backend,
+                    num_annoy_trees=num_annoy_trees,
+                    windows=processed_windows,
+                    cost_per_token=cost_per_token,
+                    pool_count=pool_count,
+                    pool_size=pool_size,
+                    force=False,
+                    silent=True,
+                    no_confirm=True,  # Don't ask for confirmation during API uploads
+                    encoding=encoding,
+                    chunk_cache=chunk_cache,
+                    on_progress=job.update_progress,
+                    index_builds=index_builds,
+                    quantize=quantize,
+                )
+            else:
+                document = process(
+                    filename=job.filename,
+                    semantra_dir=semantra_dir,
+                    model=model,
+                    num_dimensions=model.get_num_dimensions(),
+                    use_index=use_index,
+                    index_backend=index_backend,
+                    num_annoy_trees=num_annoy_trees,
+                    windows=processed_windows,
+                    cost_per_token=cost_per_token,
+                    pool_count=pool_count,
+                    pool_size=pool_size,
+                    force=False,
+                    silent=True,
+                    no_confirm=True,
+                    encoding=encoding,
+                    chunk_cache=chunk_cache,
+                    on_document=on_document,
+                    on_progress=job.update_progress,
+                    index_builds=index_builds,
+                    quantize=quantize,
+                )
         except Exception as e:
-            app.logger.error(f"Error in /api/upload: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            app.logger.error(f"Error processing file {job.basename}: {str(e)}")
+            if job.searchable:
+                with documents_lock:
+                    documents.pop(job.filename, None)
+            raise
+
+        with documents_lock:
+            if job.searchable and documents.get(job.filename) is not document:
+                # Deleted while it was being processed
+                return
+            documents[job.filename] = document
+        store.add(document)
+        exact_index.invalidate()
+        index_builder.submit(build_indexes, index_builds)
+        if corpus_ann_index is not None:
+            corpus_ann_index.add(document)
+            update_corpus_index()
+        job.filetype = document.filetype
+        job.searchable = True
+        app.logger.info(f"Successfully processed file: {job.basename}")
+
+    @app.route("/api/jobs", methods=["GET"])
+    def api_jobs():
+        return jsonify([job.to_dict() for job in job_queue.list()])
+
+    @app.route("/api/jobs/<job_id>", methods=["GET"])
+    def api_job(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job.to_dict())
 
     @app.route("/api/delete", methods=["POST"])
     def delete_document():
+        if serve_mode == "prefork":
+            return jsonify({"error": PREFORK_READ_ONLY_ERROR}), 405
         try:
             data = request.json
             if not data or 'filename' not in data:
@@ -879,20 +1778,19 @@ def main(
             filename = data['filename']
             logger.info(f"Request to delete document: {filename}")
 
-            # Check if the file exists in our documents dictionary
-            if filename not in documents:
+            # Remove the document from our documents dictionary
+            with documents_lock:
+                document = documents.pop(filename, None)
+            if document is None:
                 return jsonify({'error': 'File not found in index'}), 404
 
             # Close the PDF document properly
-            document = documents[filename]
-            if hasattr(document, 'content'):
-                if hasattr(document.content, 'close'):
-                    document.content.close()
-                elif hasattr(document.content, 'pdfium') and document.content.pdfium is not None:
-                    document.content.pdfium.close()
-
-            # Remove the document from our documents dictionary
-            del documents[filename]
+            contents.close(document)
+            store.remove(document)
+            exact_index.invalidate()
+            if corpus_ann_index is not None:
+                corpus_ann_index.remove(filename)
+                update_corpus_index()
             logger.info(f"Successfully deleted document: {filename}")
 
             return jsonify({
@@ -904,6 +1802,10 @@ def main(
             logger.error(f"Error deleting document: {str(e)}", exc_info=True)
             return jsonify({'error': str(e)}), 500
 
+    @app.route("/api/stats", methods=["GET"])
+    def stats():
+        return jsonify({"query_cache": model.query_cache.info()})
+
     @app.route("/api/query", methods=["POST"])
     def query():
         queries = request.json["queries"]
@@ -924,30 +1826,38 @@ def main(
         if svm:
             svm_results = querysvm_by_queries_and_preferences(queries, preferences)
             return svm_results
-        if annoy:
+        if corpus_ann_index is not None:
+            return querycorpus_by_queries_and_preferences(queries, preferences)
+        if use_index:
             ann_results = queryann_by_queries_and_preferences(queries, preferences)
             return ann_results
 
+        documents = get_documents()
         # Get combined query and preference embedding
         embedding = model.embed_queries_and_preferences(queries, preferences, documents)
 
-        results = []
+        # Get kNN with cosine similarity across all documents at once
+        ready_documents = {
+            filename: doc for filename, doc in documents.items() if doc.ready
+        }
+        _, per_file_results = exact_index.search(
+            ready_documents, embedding, num_results
+        )
         for doc in documents.values():
-            embeddings = doc.embeddings
-
-            # Get kNN with cosine similarity
-            distances = np.dot(embeddings, embedding) / (
-                np.linalg.norm(embeddings, axis=1) * np.linalg.norm(embedding)
-            )
-            sorted_ix = np.argsort(-distances)
+            if doc.filename not in per_file_results:
+                # Not in the index (yet), e.g. still being embedded
+                per_file_results[doc.filename] = search_embeddings(
+                    doc.embeddings, embedding, num_results
+                )
 
+        results = []
+        for doc in documents.values():
             text_chunks = doc.text_chunks
             offsets = doc.offsets[0]
             sub_results = []
-            for index in sorted_ix[:num_results]:
-                distance = float(distances[index])
+            for index, distance in per_file_results.get(doc.filename, []):
                 offset = offsets[index]
-                text = join_text_chunks(text_chunks[offset[0] : offset[1]])
+                text = text_chunks.text(offset[0], offset[1])
                 sub_results.append(
                     {
                         "text": text,
@@ -973,6 +1883,7 @@ def main(
         return jsonify(querysvm_by_queries_and_preferences(queries, preferences))
 
     def querysvm_by_queries_and_preferences(queries, preferences):
+        documents = get_documents()
         # Get combined query and preference embedding
         embedding = model.embed_queries_and_preferences(queries, preferences, documents)
         results = []
@@ -1003,7 +1914,7 @@ def main(
             for index in sorted_ix[:num_results]:
                 distance = similarities[index]
                 offset = offsets[index]
-                text = join_text_chunks(text_chunks[offset[0] : offset[1]])
+                text = text_chunks.text(offset[0], offset[1])
                 sub_results.append(
                     {
                         "text": text,
@@ -1027,25 +1938,30 @@ def main(
 
     def queryann_by_queries_and_preferences(queries, preferences):
 
+        documents = get_documents()
         # Get combined query and preference embedding
         embedding = model.embed_queries_and_preferences(queries, preferences, documents)
 
         results = []
         for doc in documents.values():
-            embedding_db = doc.embedding_db
+            if doc.index_ready:
+                indices, distances = doc.embedding_index.search(embedding, num_results)
+                indices, distances = indices.tolist(), distances.tolist()
+            else:
+                # Search exactly until the vector index is built
+                doc_results = search_embeddings(doc.embeddings, embedding, num_results)
+                indices = [index for index, _ in doc_results]
+                distances = [distance for _, distance in doc_results]
             text_chunks = doc.text_chunks
             offsets = doc.offsets[0]
             sub_results = []
-            for [index, distance] in zip(
-                *embedding_db.get_nns_by_vector(embedding, num_results, -1, True)
-            ):
+            for [index, distance] in zip(indices, distances):
                 offset = offsets[index]
-                text = join_text_chunks(text_chunks[offset[0] : offset[1]])
+                text = text_chunks.text(offset[0], offset[1])
                 sub_results.append(
                     {
                         "text": text,
-                        # Convert distance from Euclidean distance of normalized vectors to cosine
-                        "distance": 1 - distance**2.0 / 2.0,
+                        "distance": distance,
                         "offset": offset,
                         "index": int(index),
                         "filename": doc.filename,
@@ -1056,125 +1972,120 @@ def main(
             results.append([doc.filename, sub_results])
         return sort_results(results, True)
 
+    def querycorpus_by_queries_and_preferences(queries, preferences):
+        documents = get_documents()
+        # Get combined query and preference embedding
+        embedding = model.embed_queries_and_preferences(queries, preferences, documents)
+
+        # Get the top results across all documents at once
+        matches = corpus_ann_index.search(embedding, num_results)
+        for doc in documents.values():
+            if not doc.ready:
+                # Documents are only added to the index once embedded
+                for index, distance in search_embeddings(
+                    doc.embeddings, embedding, num_results
+                ):
+                    matches.append((doc.filename, index, distance))
+        matches.sort(key=lambda match: match[2], reverse=True)
+
+        sub_results_by_filename = {}
+        for filename, index, distance in matches[:num_results]:
+            doc = documents.get(filename)
+            if doc is None:
+                # Deleted since it was searched
+                continue
+            offset = doc.offsets[0][index]
+            text = doc.text_chunks.text(offset[0], offset[1])
+            sub_results_by_filename.setdefault(filename, []).append(
+                {
+                    "text": text,
+                    "distance": distance,
+                    "offset": offset,
+                    "index": int(index),
+                    "filename": filename,
+                    "queries": queries,
+                    "preferences": preferences,
+                }
+            )
+        results = [
+            [filename, sub_results]
+            for filename, sub_results in sub_results_by_filename.items()
+        ]
+        return sort_results(results, True)
+
     @app.route("/api/explain", methods=["POST"])
     def explain():
-        filename = request.json["filename"]
-        offset = request.json["offset"]
-        tokens = documents[filename].text_chunks[offset[0] : offset[1]]
         queries = request.json["queries"]
         preferences = request.json["preferences"]
+        documents = get_documents()
         embedding = model.embed_queries_and_preferences(queries, preferences, documents)
 
-        # Find hot-spots within the result tokens
-        def get_splits(divide_factor=2, num_splits=3, start=0, end=len(tokens)):
-            window_length = math.ceil((end - start) / divide_factor)
-            split_length = math.ceil((end - start) / num_splits)
-            splits = []
-            for i in range(num_splits):
-                splits.append(
-                    (
-                        start + i * split_length,
-                        min(end, start + i * split_length + window_length),
-                    )
-                )
-            return splits
-
-        def exclude_window(start, end):
-            nonlocal tokens
-            return join_text_chunks(tokens[:start] + tokens[end:])
-
-        def get_highest_ranked_split(splits):
-            nonlocal tokens, embedding
-            split_queries = [exclude_window(start, end) for start, end in splits]
-            split_windows = np.array(
-                [
-                    as_numpy(model.embed_document(split_query))
-                    for split_query in split_queries
-                ]
-            )
-            distances = split_windows.dot(embedding) / (
-                np.linalg.norm(split_windows, axis=1) * np.linalg.norm(embedding)
-            )
-            # Return the splits in order of highest to lowest ranked
-            return sorted(zip(splits, distances), key=lambda x: x[1], reverse=False)
-
-        def as_tokens(splits):
-            nonlocal tokens
-            indices = sorted([split[0] for split in splits], key=lambda x: x[0])
-            last_index = 0
-            chunks = []
-
-            def append(start, end, type):
-                if start >= end:
-                    return
-                nonlocal chunks, tokens
-                chunks.append(
-                    {
-                        "text": join_text_chunks(tokens[start:end]),
-                        "type": type,
-                    }
-                )
-
-            for index in indices:
-                append(last_index, index[0], "normal")
-                append(max(index[0], last_index), index[1], "highlight")
-                last_index = index[1]
-
-            append(last_index, len(tokens), "normal")
-            return chunks
-
-        splits = get_splits(
-            divide_factor=explain_split_divide,
-            num_splits=explain_split_count,
-            start=0,
-            end=len(tokens),
-        )
-        top_splits = get_highest_ranked_split(splits)[:num_explain_highlights]
-        return jsonify(as_tokens(top_splits))
+        # Explain a list of results at once, or a single result
+        if "results" in request.json:
+            results = [
+                (documents[result["filename"]], result["offset"])
+                for result in request.json["results"]
+            ]
+            return jsonify(explain_engine.explain(results, embedding))
+        document = documents[request.json["filename"]]
+        offset = request.json["offset"]
+        return jsonify(explain_engine.explain([(document, offset)], embedding)[0])
 
     @app.route("/api/getfile", methods=["GET"])
     def getfile():
         filename = request.args.get("filename")
-        content = get_content(filename)
-        filename = content.filename
-        return send_file(filename)
+        return send_file(documents[filename].filename)
 
     @app.route("/api/pdfpositions", methods=["GET"])
     def pdfpositions():
         filename = request.args.get("filename")
-        content = get_content(filename)
-        if content.filetype == "pdf":
-            return jsonify(content.positions)
-        else:
-            return jsonify([])
+        return jsonify(documents[filename].positions)
 
     @app.route("/api/pdfpage", methods=["GET"])
     def pdfpage():
         filename = request.args.get("filename")
-        content = get_content(filename)
-        page = request.args.get("page")
-        scale = request.args.get("scale")
-        if content.filetype == "pdf":
-            pil_image = content.get_page_image_pil(int(page), float(scale))
-            img_byte_arr = io.BytesIO()
-            pil_image.save(img_byte_arr, format="PNG")
-            response = make_response(img_byte_arr.getvalue())
-            response.headers.set("Content-Type", "image/png")
+        document = documents[filename]
+        page = int(request.args.get("page"))
+        scale = float(request.args.get("scale"))
+        format = request.args.get("format", "png")
+        quality = int(request.args.get("quality", 80))
+        if format not in PAGE_FORMATS:
+            return jsonify({"error": f"Unsupported page format: {format}"}), 400
+        if document.filetype == "pdf":
+            etag = page_cache.get_etag(document.md5, page, scale, format, quality)
+            if etag in request.if_none_match:
+                response = make_response("", 304)
+            else:
+                with contents.lease(document) as content:
+                    response = make_response(
+                        page_cache.get(
+                            content, document.md5, page, scale, format, quality
+                        )
+                    )
+                response.headers.set("Content-Type", PAGE_FORMATS[format])
+            response.set_etag(etag)
+            response.headers.set("Cache-Control", "private, max-age=3600")
             return response
 
     @app.route("/api/pdfchars", methods=["GET"])
     def pdfchars():
         filename = request.args.get("filename")
-        content = get_content(filename)
-        if content.filetype != "pdf":
+        document = documents[filename]
+        if document.filetype != "pdf":
             return jsonify([])
-        page = request.args.get("page")
-        return jsonify(content.get_page_chars(int(page)))
+        page = int(request.args.get("page"))
+        with contents.lease(document) as content:
+            if request.args.get("format") == "binary":
+                # Packed boxes and chars, see PDFChars.get_page_binary
+                response = make_response(content.get_page_chars_binary(page))
+                response.headers["Content-Type"] = "application/octet-stream"
+                return response
+            return jsonify(content.get_page_chars(page))
 
     @app.route("/api/text", methods=["GET"])
     def text():
         filename = request.args.get("filename")
-        return jsonify(documents[filename].text_chunks)
+        return jsonify(documents[filename].text_chunks.tolist())
 
     def save_dict_as_json_to_path(data: dict, path: str):
         full_path = Path(os.path.abspath(path))
@@ -1195,7 +2106,32 @@ def main(
         else:
             print(query_results)
 
-    if not no_server:
+    def after_fork():
+        nonlocal index_builder
+        # Forked workers open their own PDF handles and database connections
+        contents.close_all()
+        # and build the vector indexes of their uploads on their own thread
+        index_builder = ThreadPoolExecutor(max_workers=1)
+        if chunk_cache is not None:
+            chunk_cache.reopen()
+
+    if not no_server and serve_mode != "debug":
+        if serve_workers is None:
+            serve_workers = os.cpu_count() or 1
+        if serve_mode == "prefork":
+            # Finish building indexes before forking, so that workers neither
+            # inherit locks held by the builder thread nor search unbuilt ones
+            index_builder.shutdown(wait=True)
+        serve(
+            app,
+            host,
+            port,
+            serve_mode,
+            serve_workers,
+            cleanup_resources,
+            after_fork=after_fork,
+        )
+    elif not no_server:
         try:
             app.run(host=host, port=port, debug=True)
         except SystemExit as e:
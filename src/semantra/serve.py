@@ -0,0 +1,155 @@
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+SERVE_MODES = ["debug", "threaded", "prefork"]
+
+# Seconds to wait before replacing a worker that exited, doubled for each
+# worker in a row that exited within WORKER_MIN_UPTIME seconds of starting.
+# After WORKER_MAX_RAPID_FAILURES of those, serving gives up
+WORKER_RESTART_DELAY = 1
+WORKER_MIN_UPTIME = 10
+WORKER_MAX_RAPID_FAILURES = 5
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server handling requests on a fixed-size pool of threads."""
+
+    def __init__(self, host, port, app, num_threads):
+        super().__init__(host, port, app)
+        self.num_threads = num_threads
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        # Let requests in flight finish
+        self.executor.shutdown(wait=True)
+
+
+def on_shutdown_signals(handler):
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, handler)
+
+
+def run_until_signal(server):
+    # Serve until SIGINT or SIGTERM, then stop accepting requests and wait for
+    # the ones in flight
+    def request_shutdown(sig, frame):
+        # shutdown() waits for serve_forever to return, so it can't be called
+        # from the serving thread itself
+        threading.Thread(target=server.shutdown).start()
+
+    on_shutdown_signals(request_shutdown)
+    server.serve_forever()
+    server.server_close()
+
+
+def serve_threaded(server, cleanup):
+    print(f"Serving with {server.num_threads} threads on port {server.port}")
+    run_until_signal(server)
+    cleanup()
+
+
+def serve_prefork(server, num_workers, cleanup, after_fork=None):
+    """Serve from worker processes forked from the fully loaded app.
+
+    Workers share the listening socket as well as the model and corpus
+    loaded before forking, copy-on-write. Workers that die are replaced
+    after a delay, unless they keep dying right after starting.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("The prefork serve mode is not supported on this platform")
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if after_fork is not None:
+                    after_fork()
+                run_until_signal(server)
+            finally:
+                # Leave the parent's exit handlers to the parent
+                os._exit(0)
+        return pid
+
+    # Start time of each worker by pid
+    workers = {}
+    shutting_down = False
+
+    def stop_workers(sig=None, frame=None):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    print(f"Serving with {num_workers} worker processes on port {server.port}")
+    for _ in range(num_workers):
+        workers[spawn_worker()] = time.monotonic()
+    on_shutdown_signals(stop_workers)
+
+    rapid_failures = 0
+    gave_up = False
+    while len(workers) > 0:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        started_at = workers.pop(pid, None)
+        if shutting_down or started_at is None:
+            continue
+        if time.monotonic() - started_at < WORKER_MIN_UPTIME:
+            rapid_failures += 1
+        else:
+            rapid_failures = 0
+        if rapid_failures >= WORKER_MAX_RAPID_FAILURES:
+            gave_up = True
+            stop_workers()
+            continue
+        delay = WORKER_RESTART_DELAY * 2 ** max(0, rapid_failures - 1)
+        print(f"Worker {pid} exited, starting a new one in {delay}s")
+        time.sleep(delay)
+        if not shutting_down:
+            workers[spawn_worker()] = time.monotonic()
+
+    server.server_close()
+    cleanup()
+    if gave_up:
+        raise RuntimeError(
+            f"Workers exited {rapid_failures} times in a row right after starting"
+        )
+
+
+def serve(app, host, port, mode, num_workers, cleanup, after_fork=None):
+    """Serve the app until it is shut down, then call `cleanup`.
+
+    In "threaded" mode, one process handles requests on `num_workers`
+    threads. In "prefork" mode, `num_workers` processes handle requests one
+    at a time each, and `after_fork` is called in every worker once it has
+    been forked.
+    """
+    if mode == "threaded":
+        serve_threaded(PooledWSGIServer(host, port, app, num_workers), cleanup)
+    elif mode == "prefork":
+        # Bind before forking so that every worker accepts on the same socket
+        server = BaseWSGIServer(host, port, app)
+        serve_prefork(server, num_workers, cleanup, after_fork)
+    else:
+        raise ValueError(f"Unknown serve mode: {mode}")
@@ -0,0 +1,131 @@
+import re
+
+# Characters of text read and tokenized at a time when streaming a file
+SEGMENT_SIZE = 1 << 20
+# How far back from the end of a segment to look for a place to cut it
+SEGMENT_LOOKBACK = 1 << 16
+# Segments are cut at the start of a run of whitespace following a word, so
+# that no token spans two segments
+SEGMENT_BREAK = re.compile(r"(?<=\S)\s")
+
+
+def find_segment_cut(text):
+    cut = None
+    for match in SEGMENT_BREAK.finditer(text, max(0, len(text) - SEGMENT_LOOKBACK)):
+        cut = match.start()
+    return cut
+
+
+def iter_text_segments(f, segment_size=SEGMENT_SIZE):
+    """Read an open text file in segments of about `segment_size` characters."""
+    remainder = ""
+    while True:
+        data = f.read(segment_size)
+        if not data:
+            break
+        text = remainder + data
+        cut = find_segment_cut(text)
+        if not cut:
+            # Text without whitespace (e.g. CJK) is cut wherever it ends
+            cut = len(text)
+        yield text[:cut]
+        remainder = text[cut:]
+    if remainder:
+        yield remainder
+
+
+class WindowCursor:
+    """Computes the windows of one window configuration as tokens arrive.
+
+    Produces the same windows as `get_offsets`, without knowing the total
+    number of tokens in advance.
+    """
+
+    def __init__(self, size, offset, rewind):
+        self.size = size
+        self.offset = offset
+        self.rewind = rewind
+        self.first_pending = offset > 0
+        # Start of the next window
+        self.start = offset - rewind if offset > 0 else 0
+
+    def advance(self, num_tokens, final):
+        # Return the windows that are complete with `num_tokens` tokens, or
+        # all remaining windows if there are no more tokens to come
+        windows = []
+        if self.first_pending and (final or num_tokens >= self.offset):
+            windows.append([0, self.offset])
+            self.first_pending = False
+        while self.start + self.rewind < num_tokens and (
+            final or self.start + self.size <= num_tokens
+        ):
+            windows.append([self.start, min(self.start + self.size, num_tokens)])
+            self.start += self.size - self.rewind
+        return windows
+
+    def get_keep_from(self):
+        # First token that windows still to come may contain
+        return 0 if self.first_pending else self.start
+
+
+class TokenStream:
+    """Tokenizes a stream of text segments into windows.
+
+    Only the tokens and text chunks that upcoming windows still need are kept
+    in memory. `windows()` yields `(window_index, offset, tokens,
+    tokens_offset, text_chunks)` for each window as soon as its tokens are
+    available, where `offset` is the window's position in the whole document
+    and `tokens_offset` its position in `tokens`. The text chunks of each
+    segment are passed to `on_text_chunks` along with their tokens as it is
+    tokenized.
+    """
+
+    def __init__(self, model, segments, windows, on_text_chunks=None):
+        self.model = model
+        self.segments = segments
+        self.cursors = [WindowCursor(*window) for window in windows]
+        self.on_text_chunks = on_text_chunks
+        self.num_tokens = 0
+
+    def windows(self):
+        model = self.model
+        tokens = None
+        text_chunks = []
+        # Position of the first buffered token in the whole document
+        buffer_start = 0
+        segments = iter(self.segments)
+        final = False
+        while not final:
+            segment = next(segments, None)
+            if segment is None:
+                final = True
+            else:
+                segment_tokens = model.get_segment_tokens(segment)
+                segment_chunks = model.get_text_chunks(segment, segment_tokens)
+                segment_tokens = model.slice_tokens(
+                    segment_tokens, 0, len(segment_chunks)
+                )
+                if self.on_text_chunks is not None:
+                    self.on_text_chunks(segment_chunks, segment_tokens)
+                tokens = (
+                    segment_tokens
+                    if tokens is None
+                    else model.concat_tokens(tokens, segment_tokens)
+                )
+                text_chunks.extend(segment_chunks)
+                self.num_tokens += len(segment_chunks)
+
+            for window_index, cursor in enumerate(self.cursors):
+                for start, end in cursor.advance(self.num_tokens, final):
+                    i, j = start - buffer_start, end - buffer_start
+                    yield window_index, [start, end], tokens, [i, j], text_chunks[i:j]
+
+            # Drop the tokens that no window needs anymore. Windows already
+            # yielded keep a reference to the previous tokens
+            keep_from = min(cursor.get_keep_from() for cursor in self.cursors)
+            if tokens is not None and keep_from > buffer_start:
+                tokens = model.slice_tokens(
+                    tokens, keep_from - buffer_start, self.num_tokens - buffer_start
+                )
+                del text_chunks[: keep_from - buffer_start]
+                buffer_start = keep_from
@@ -0,0 +1,235 @@
+from threading import Lock
+
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+from models import BaseModel, as_numpy
+
+
+def mean_pooling(model_output, attention_mask):
+    token_embeddings = model_output[
+        0
+    ]  # First element of model_output contains all token embeddings
+    input_mask_expanded = (
+        attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
+    )
+    sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1)
+    sum_mask = torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+    return sum_embeddings / sum_mask
+
+
+def zero_if_none(x):
+    return 0 if x is None else x
+
+
+# Max number of padded tokens to run through a transformer in one forward pass
+MAX_BATCH_TOKENS_DEFAULT = 16384
+
+
+class TransformerModel(BaseModel):
+    def __init__(
+        self,
+        model_name,
+        doc_token_pre=None,
+        doc_token_post=None,
+        query_token_pre=None,
+        query_token_post=None,
+        asymmetric=False,
+        cuda=None,
+        max_batch_tokens=MAX_BATCH_TOKENS_DEFAULT,
+    ):
+        super().__init__()
+        if cuda is None:
+            cuda = torch.cuda.is_available()
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # Fast tokenizers can't be called from several threads at once, and the
+        # ingestion pipeline tokenizes ahead on a background thread
+        self.tokenizer_lock = Lock()
+        self.model = AutoModel.from_pretrained(model_name)
+
+        # Get tokens
+        self.pre_post_tokens = [
+            doc_token_pre,
+            doc_token_post,
+            query_token_pre,
+            query_token_post,
+        ]
+        self.doc_token_pre = (
+            self.tokenizer.encode(doc_token_pre, add_special_tokens=False)
+            if doc_token_pre
+            else None
+        )
+        self.doc_token_post = (
+            self.tokenizer.encode(doc_token_post, add_special_tokens=False)
+            if doc_token_post
+            else None
+        )
+        self.query_token_pre = (
+            self.tokenizer.encode(query_token_pre, add_special_tokens=False)
+            if query_token_pre
+            else None
+        )
+        self.query_token_post = (
+            self.tokenizer.encode(query_token_post, add_special_tokens=False)
+            if query_token_post
+            else None
+        )
+
+        self.asymmetric = asymmetric
+        self.max_batch_tokens = max_batch_tokens
+
+        self.cuda = cuda
+        if self.cuda:
+            self.model = self.model.cuda()
+
+    def get_config(self):
+        return {
+            "model_type": "transformers",
+            "model_name": self.model_name,
+            "doc_token_pre": self.pre_post_tokens[0],
+            "doc_token_post": self.pre_post_tokens[1],
+            "query_token_pre": self.pre_post_tokens[2],
+            "query_token_post": self.pre_post_tokens[3],
+            "asymmetric": self.asymmetric,
+        }
+
+    def is_asymmetric(self):
+        return self.asymmetric
+
+    def get_num_dimensions(self) -> int:
+        return int(self.model.config.hidden_size)
+
+    def get_tokens(self, text: str):
+        with self.tokenizer_lock:
+            return self.tokenizer(
+                text, return_offsets_mapping=True, verbose=False, return_tensors="pt"
+            )
+
+    def get_segment_tokens(self, text: str):
+        with self.tokenizer_lock:
+            return self.tokenizer(
+                text,
+                add_special_tokens=False,
+                return_offsets_mapping=True,
+                verbose=False,
+                return_tensors="pt",
+            )
+
+    def get_token_length(self, tokens) -> int:
+        return len(tokens["input_ids"][0])
+
+    def get_text_chunks(self, text: str, tokens) -> "list[str]":
+        offsets = np.asarray(as_numpy(tokens["offset_mapping"][0]), dtype=np.int64)
+        if len(offsets) == 0:
+            return [text]
+        i, j = offsets[:, 0], offsets[:, 1]
+        # Zero-width (e.g. special) tokens start where the furthest token so
+        # far ended
+        ends = np.where(i[1:] == j[1:], np.maximum.accumulate(j)[:-1], i[1:])
+        # Each chunk starts where the furthest chunk so far ended, so chunks
+        # never overlap and the first one always starts at the beginning
+        starts = np.maximum.accumulate(np.concatenate([[0], ends]))
+        chunks = [text[a:b] for a, b in zip(starts[:-1].tolist(), ends.tolist())]
+        chunks.append(text[int(starts[-1]) :])
+        return chunks
+
+    def get_pre_post_tokens(self, is_query):
+        if self.query_token_pre is None and self.query_token_post is None:
+            return None, None
+        if is_query:
+            return self.query_token_pre, self.query_token_post
+        return self.doc_token_pre, self.doc_token_post
+
+    def get_window_bytes(self, tokens, offset) -> bytes:
+        i, j = offset
+        return tokens["input_ids"][0][i:j].numpy().tobytes()
+
+    def get_token_ids(self, tokens) -> np.ndarray:
+        return tokens["input_ids"][0].numpy()
+
+    def get_tokens_from_ids(self, token_ids):
+        input_ids = torch.from_numpy(np.asarray(token_ids, dtype=np.int64))[None]
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+    def slice_tokens(self, tokens, start: int, end: int):
+        # Only the inputs to the model are kept, not the offset mapping
+        return {
+            key: tokens[key][:, start:end] for key in ("input_ids", "attention_mask")
+        }
+
+    def concat_tokens(self, tokens, other_tokens):
+        return {
+            key: torch.cat([tokens[key], other_tokens[key]], dim=1)
+            for key in ("input_ids", "attention_mask")
+        }
+
+    def get_length_buckets(self, items, is_query):
+        # Group windows of similar length, so each forward pass pads as little
+        # as possible while staying within max_batch_tokens padded tokens
+        token_pre, token_post = self.get_pre_post_tokens(is_query)
+        extra_length = len(token_pre or []) + len(token_post or [])
+
+        order = sorted(range(len(items)), key=lambda k: items[k][1][1] - items[k][1][0])
+        buckets = []
+        bucket = []
+        for k in order:
+            i, j = items[k][1]
+            # Items are sorted by length, so the newest is always the longest
+            padded_length = j - i + extra_length
+            if bucket and (len(bucket) + 1) * padded_length > self.max_batch_tokens:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(k)
+        if len(bucket) > 0:
+            buckets.append(bucket)
+        return buckets
+
+    def embed_batch(self, items, is_query=False) -> "list[list[float]]":
+        embeddings = None
+        for bucket in self.get_length_buckets(items, is_query):
+            bucket_embeddings = self.embed_padded([items[k] for k in bucket], is_query)
+            if embeddings is None:
+                embeddings = bucket_embeddings.new_empty(
+                    (len(items), bucket_embeddings.shape[1])
+                )
+            # Restore the original order of the windows
+            embeddings[torch.tensor(bucket, device=embeddings.device)] = (
+                bucket_embeddings
+            )
+        return embeddings
+
+    def embed_padded(self, items, is_query):
+        token_pre, token_post = self.get_pre_post_tokens(is_query)
+        num_pre = len(token_pre) if token_pre is not None else 0
+        num_post = len(token_post) if token_post is not None else 0
+        lengths = [num_pre + j - i + num_post for _, (i, j) in items]
+
+        # Write every window straight into one preallocated padded batch
+        input_ids = torch.full(
+            (len(items), max(lengths)),
+            zero_if_none(self.tokenizer.pad_token_id),
+            dtype=torch.long,
+        )
+        attention_mask = torch.zeros((len(items), max(lengths)), dtype=torch.long)
+        if num_pre > 0:
+            input_ids[:, :num_pre] = torch.tensor(token_pre)
+            attention_mask[:, :num_pre] = 1
+        post_ids = torch.tensor(token_post) if num_post > 0 else None
+        for row, ((tokens, (i, j)), length) in enumerate(zip(items, lengths)):
+            # Copy from contiguous slices (views) of the document tokens
+            end = num_pre + j - i
+            input_ids[row, num_pre:end] = tokens["input_ids"][0][i:j]
+            attention_mask[row, num_pre:end] = tokens["attention_mask"][0][i:j]
+            if post_ids is not None:
+                input_ids[row, end:length] = post_ids
+                attention_mask[row, end:length] = 1
+        if self.cuda:
+            input_ids = input_ids.cuda()
+            attention_mask = attention_mask.cuda()
+        with torch.no_grad():
+            model_output = self.model(
+                input_ids=input_ids, attention_mask=attention_mask
+            )
+        return mean_pooling(model_output, attention_mask)
@@ -1,6 +1,8 @@
-import struct
 import hashlib
 import os
+from collections import OrderedDict
+from threading import Lock
+
 import numpy as np
 
 HASH_LENGTH = 24
@@ -27,63 +29,69 @@ def get_pdf_positions_filename(md5):
     return f"{md5}.pdf.positions.json"
 
 
+def get_pdf_chars_filename(md5):
+    return f"{md5}.pdf.chars.bin"
+
+
 def get_tokens_filename(md5, config_hash):
+    # Text chunks as JSON, as cached by older versions
     return f"{md5}.{config_hash}.tokens.json"
 
 
+def get_chunks_filename(md5, config_hash):
+    return f"{md5}.{config_hash}.chunks.bin"
+
+
+def get_chunk_offsets_filename(md5, config_hash):
+    return f"{md5}.{config_hash}.chunks.offsets"
+
+
 def get_embeddings_filename(md5, config_hash, size, offset, rewind):
     return f"{md5}.{config_hash}.{size}_{offset}_{rewind}.embeddings"
 
 
+def get_quantized_embeddings_filename(md5, config_hash, size, offset, rewind, quantize):
+    return f"{md5}.{config_hash}.{size}_{offset}_{rewind}.{quantize}.embeddings"
+
+
 def get_annoy_filename(md5, config_hash, size, offset, rewind, num_trees):
     return f"{md5}.{config_hash}.{size}_{offset}_{rewind}.{num_trees}t.annoy"
 
 
+def get_index_filename(md5, config_hash, size, offset, rewind, backend, num_trees):
+    if backend == "annoy":
+        return get_annoy_filename(md5, config_hash, size, offset, rewind, num_trees)
+    return f"{md5}.{config_hash}.{size}_{offset}_{rewind}.{backend}"
+
+
+def get_corpus_index_filename(config_hash, size, offset, rewind, backend, num_trees):
+    return get_index_filename(
+        "corpus", config_hash, size, offset, rewind, backend, num_trees
+    )
+
+
 def get_config_filename(md5, config_hash):
     return f"{md5}.{config_hash}.config.json"
 
 
 def write_embedding(file, embedding, num_dimensions):
     # Write float-encoded embeddings
-    for i in range(num_dimensions):
-        file.write(struct.pack("f", embedding[i]))
+    file.write(np.asarray(embedding[:num_dimensions], dtype=np.float32).tobytes())
     file.flush()
 
 
-def read_embedding(chunk, num_dimensions):
-    # Read float-encoded embeddings
-    embedding = []
-    for i in range(num_dimensions):
-        embedding.append(struct.unpack("f", chunk[i * 4 : (i + 1) * 4])[0])
-    return embedding
-
-
-def write_annoy_db(filename, num_dimensions, embeddings, num_trees):
-    # Import annoy here so that it's not required for the CLI
-    from annoy import AnnoyIndex
-
-    dbs = []
-    db = AnnoyIndex(num_dimensions, "angular")
-    for i, embedding in enumerate(embeddings):
-        db.add_item(i, embedding)
-    db.build(num_trees)
-    db.save(filename)
-    dbs.append(db)
-
-    return dbs
-
-
-def load_annoy_db(filename, num_dimensions):
-    # Import annoy here so that it's not required for the CLI
-    from annoy import AnnoyIndex
-
-    db = AnnoyIndex(num_dimensions, "angular")
-    db.load(filename)
-    return db
+def write_embeddings(file, embeddings, fsync=True):
+    # Write a batch of float-encoded embeddings as one contiguous buffer, in
+    # the same layout as consecutive calls to write_embedding
+    file.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+    file.flush()
+    if fsync:
+        os.fsync(file.fileno())
 
 
-def get_num_annoy_embeddings(annoy_filename, num_dimensions):
-    return load_annoy_db(annoy_filename, num_dimensions).get_n_items()
+def read_embedding(chunk, num_dimensions):
+    # Read float-encoded embeddings
+    return np.frombuffer(chunk, dtype=np.float32, count=num_dimensions).tolist()
 
 
 def safe_remove(filename):
@@ -133,6 +141,24 @@ def read_embeddings_file(embeddings_filename, num_dimensions, capacity):
     return embeddings, num_embeddings
 
 
+def memmap_embeddings_file(embeddings_filename, num_dimensions, num_embeddings):
+    # Map a fully calculated embeddings file read-only without copying it
+    if get_num_embeddings(embeddings_filename, num_dimensions) != num_embeddings:
+        # Fall back to a zero-padded copy if the file is incomplete
+        return read_embeddings_file(embeddings_filename, num_dimensions, num_embeddings)
+
+    if num_embeddings == 0:
+        return np.zeros((0, num_dimensions), dtype="float32"), 0
+
+    embeddings = np.memmap(
+        embeddings_filename,
+        dtype="float32",
+        mode="r",
+        shape=(num_embeddings, num_dimensions),
+    )
+    return embeddings, num_embeddings
+
+
 def get_offsets(doc_size, windows):
     num_tokens = 0
 
@@ -170,3 +196,100 @@ def sort_results(results, reverse):
         "results": [x for _, x in sorted(zip(avg_distances, results), reverse=reverse)],
         "sort": "desc" if reverse else "asc",
     }
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache bounded by a total size.
+
+    `sizeof` measures each value (defaulting to 1 so that `max_size` acts as an
+    item count). A `max_size` of None disables eviction. `on_evict` is called
+    with each value evicted to make room for new ones.
+    """
+
+    def __init__(self, max_size=None, sizeof=None, on_evict=None):
+        self.max_size = max_size
+        self.sizeof = sizeof if sizeof is not None else (lambda _: 1)
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        value_size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, value_size)
+            self.size += value_size
+            evicted = self.evict()
+        self.notify_evicted(evicted)
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            evicted = self.evict()
+        self.notify_evicted(evicted)
+
+    def evict(self):
+        # Evict the least recently used entries, but always keep the newest
+        evicted = []
+        while (
+            self.max_size is not None
+            and self.size > self.max_size
+            and len(self.entries) > 1
+        ):
+            _, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            evicted.append(evicted_value)
+        return evicted
+
+    def notify_evicted(self, evicted):
+        if self.on_evict is not None:
+            for evicted_value in evicted:
+                self.on_evict(evicted_value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value, value_size = self.entries.pop(key)
+            self.size -= value_size
+            return value
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def info(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size,
+            }
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,443 @@
+import os
+import struct
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from search import normalize_rows, top_k
+from util import get_num_embeddings, memmap_embeddings_file, safe_remove
+
+INDEX_BACKENDS = ["annoy", "hnsw", "exact"]
+
+# Embeddings converted and added to an Annoy database at a time
+ANNOY_ADD_BLOCK_SIZE = 4096
+
+# Links per item and per layer (doubled on the bottom layer), and the number
+# of candidates considered while inserting and searching an HNSW graph
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+
+
+def normalize(embedding):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm > 0 else embedding
+
+
+class VectorIndex(ABC):
+    """Nearest-neighbor index of embeddings by cosine similarity.
+
+    Items are identified by integer ids. `search` returns the ids of the
+    closest items to an embedding and their cosine similarities, closest
+    first.
+    """
+
+    # Whether items can be added and removed without ever rebuilding
+    incremental = False
+
+    def __init__(self, num_dimensions):
+        self.num_dimensions = num_dimensions
+
+    @abstractmethod
+    def build(self, embedding_arrays):
+        """Replace the contents of the index with the rows of all arrays in
+        `embedding_arrays`, with ids numbered consecutively from 0."""
+        ...
+
+    @abstractmethod
+    def add(self, ids, embeddings): ...
+
+    @abstractmethod
+    def remove(self, ids): ...
+
+    @abstractmethod
+    def search(self, embedding, num_results): ...
+
+    @abstractmethod
+    def save(self, filename): ...
+
+    @classmethod
+    @abstractmethod
+    def load(cls, filename, num_dimensions): ...
+
+    @classmethod
+    def get_num_items(cls, filename, num_dimensions):
+        index = cls.load(filename, num_dimensions)
+        try:
+            return len(index)
+        finally:
+            index.close()
+
+    @abstractmethod
+    def __len__(self): ...
+
+    @property
+    @abstractmethod
+    def nbytes(self): ...
+
+    def close(self):
+        pass
+
+    def write(self, filename):
+        # Only move the index into place once it is complete
+        temp_filename = f"{filename}.tmp"
+        self.save(temp_filename)
+        os.replace(temp_filename, filename)
+
+
+class ExactVectorIndex(VectorIndex):
+    """Exhaustive search over a pre-normalized float32 matrix."""
+
+    incremental = True
+
+    def __init__(self, num_dimensions):
+        super().__init__(num_dimensions)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.matrix = np.zeros((0, num_dimensions), dtype=np.float32)
+
+    def build(self, embedding_arrays):
+        self.matrix = normalize_rows(
+            np.concatenate(
+                [np.zeros((0, self.num_dimensions), dtype=np.float32)]
+                + [
+                    np.asarray(embeddings, dtype=np.float32)
+                    for embeddings in embedding_arrays
+                ]
+            )
+        )
+        self.ids = np.arange(len(self.matrix), dtype=np.int64)
+
+    def add(self, ids, embeddings):
+        self.remove(ids)
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(
+            -1, self.num_dimensions
+        )
+        self.matrix = np.concatenate([self.matrix, normalize_rows(embeddings)])
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        if not keep.all():
+            self.matrix = self.matrix[keep]
+            self.ids = self.ids[keep]
+
+    def search(self, embedding, num_results):
+        scores = self.matrix @ normalize(embedding)
+        rows = top_k(scores, num_results)
+        return self.ids[rows], scores[rows]
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            np.savez(f, ids=self.ids, matrix=self.matrix)
+
+    @classmethod
+    def load(cls, filename, num_dimensions):
+        index = cls(num_dimensions)
+        with np.load(filename) as data:
+            index.ids = data["ids"]
+            index.matrix = data["matrix"]
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + self.ids.nbytes
+
+
+def create_annoy_db(num_dimensions, embedding_arrays, num_trees, n_jobs=-1):
+    # Import annoy here so that it's not required for the CLI
+    from annoy import AnnoyIndex
+
+    # Items are the rows of all arrays, numbered consecutively
+    db = AnnoyIndex(num_dimensions, "angular")
+    item = 0
+    for embeddings in embedding_arrays:
+        # Convert embeddings in blocks, so memory-mapped ones are read as they go
+        for start in range(0, len(embeddings), ANNOY_ADD_BLOCK_SIZE):
+            block = np.asarray(embeddings[start : start + ANNOY_ADD_BLOCK_SIZE])
+            for embedding in block.tolist():
+                db.add_item(item, embedding)
+                item += 1
+    try:
+        # Build the trees on `n_jobs` threads (-1 for all cores)
+        db.build(num_trees, n_jobs=n_jobs)
+    except TypeError:
+        # Older versions of annoy only build on one thread
+        db.build(num_trees)
+    return db
+
+
+class AnnoyVectorIndex(VectorIndex):
+    """Annoy database of random projection trees.
+
+    Annoy databases can't change once built, so items added afterwards are
+    searched exactly and removed items are filtered out of results until the
+    index is built again.
+    """
+
+    def __init__(self, num_dimensions, num_trees=100):
+        super().__init__(num_dimensions)
+        self.num_trees = num_trees
+        self.db = None
+        self.num_built = 0
+        self.delta = ExactVectorIndex(num_dimensions)
+        self.tombstones = set()
+
+    def build(self, embedding_arrays):
+        self.db = create_annoy_db(self.num_dimensions, embedding_arrays, self.num_trees)
+        self.num_built = self.db.get_n_items()
+        self.delta = ExactVectorIndex(self.num_dimensions)
+        self.tombstones = set()
+
+    def add(self, ids, embeddings):
+        self.remove(ids)
+        self.delta.add(ids, embeddings)
+
+    def remove(self, ids):
+        self.tombstones.update(int(i) for i in ids if 0 <= i < self.num_built)
+        self.delta.remove(ids)
+
+    def search(self, embedding, num_results):
+        ids, similarities = self.delta.search(embedding, num_results)
+        ids, similarities = ids.tolist(), similarities.tolist()
+        if self.db is not None and num_results > 0:
+            # Removed items are filtered out of the results, so ask for more
+            # items until enough are left (or there are no more)
+            num_fetched = num_results + min(len(self.tombstones), num_results)
+            while True:
+                items, distances = self.db.get_nns_by_vector(
+                    embedding, num_fetched, -1, True
+                )
+                results = [
+                    (item, distance)
+                    for item, distance in zip(items, distances)
+                    if item not in self.tombstones
+                ]
+                if len(results) >= num_results or num_fetched >= self.num_built:
+                    break
+                num_fetched *= 2
+            for item, distance in results:
+                ids.append(item)
+                # Convert distance from Euclidean distance of normalized
+                # vectors to cosine
+                similarities.append(1 - distance**2.0 / 2.0)
+        order = np.argsort(-np.asarray(similarities), kind="stable")[:num_results]
+        return (
+            np.asarray(ids, dtype=np.int64)[order],
+            np.asarray(similarities, dtype=np.float32)[order],
+        )
+
+    def save(self, filename):
+        if len(self.delta) > 0 or len(self.tombstones) > 0:
+            raise ValueError("Annoy databases can only be saved as built")
+        self.db.save(filename)
+
+    @classmethod
+    def load(cls, filename, num_dimensions):
+        # Import annoy here so that it's not required for the CLI
+        from annoy import AnnoyIndex
+
+        index = cls(num_dimensions)
+        index.db = AnnoyIndex(num_dimensions, "angular")
+        index.db.load(filename)
+        index.num_built = index.db.get_n_items()
+        return index
+
+    def __len__(self):
+        return self.num_built - len(self.tombstones) + len(self.delta)
+
+    @property
+    def nbytes(self):
+        return self.num_built * self.num_dimensions * 4 + self.delta.nbytes
+
+    def close(self):
+        if self.db is not None:
+            self.db.unload()
+
+
+def get_deleted_filename(filename):
+    return f"{filename}.deleted"
+
+
+class HNSWVectorIndex(VectorIndex):
+    """Hierarchical navigable small world graph, built by hnswlib.
+
+    Removed items are marked as deleted in the graph. hnswlib doesn't report
+    which items are deleted, so they are also tracked here and written next to
+    the graph by `write`.
+    """
+
+    incremental = True
+
+    def __init__(
+        self,
+        num_dimensions,
+        m=HNSW_M,
+        ef_construction=HNSW_EF_CONSTRUCTION,
+        ef_search=HNSW_EF_SEARCH,
+        filename=None,
+    ):
+        # Import hnswlib here so that it's only required for this backend
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError(
+                "The hnsw index backend requires hnswlib, install it with "
+                "`pip install semantra[hnsw]`"
+            ) from None
+
+        super().__init__(num_dimensions)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.db = hnswlib.Index(space="cosine", dim=num_dimensions)
+        if filename is None:
+            self.db.init_index(max_elements=0, M=m, ef_construction=ef_construction)
+        else:
+            self.db.load_index(filename)
+        self.db.set_ef(ef_search)
+        self.deleted = set()
+
+    def reserve(self, num_items):
+        capacity = self.db.get_max_elements()
+        if num_items > capacity:
+            self.db.resize_index(max(num_items, capacity * 2))
+
+    def build(self, embedding_arrays):
+        self.__init__(self.num_dimensions, self.m, self.ef_construction, self.ef_search)
+        self.reserve(sum(len(embeddings) for embeddings in embedding_arrays))
+        start = 0
+        for embeddings in embedding_arrays:
+            self.add(np.arange(start, start + len(embeddings)), embeddings)
+            start += len(embeddings)
+
+    def add(self, ids, embeddings):
+        ids = np.asarray(ids, dtype=np.int64)
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(
+            -1, self.num_dimensions
+        )
+        if len(ids) == 0:
+            return
+        self.reserve(self.db.element_count + len(ids))
+        # Adding an id that is already in the graph replaces it
+        self.db.add_items(embeddings, ids, replace_deleted=False)
+        self.deleted.difference_update(ids.tolist())
+
+    def remove(self, ids):
+        for id in np.asarray(ids).tolist():
+            if id in self.deleted:
+                continue
+            try:
+                self.db.mark_deleted(id)
+            except RuntimeError:
+                # Not in the graph
+                continue
+            self.deleted.add(id)
+
+    def search(self, embedding, num_results):
+        # hnswlib fails rather than return fewer items than asked for
+        num_results = min(num_results, len(self))
+        if num_results <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if num_results > self.db.ef:
+            self.db.set_ef(num_results)
+        labels, distances = self.db.knn_query(
+            np.asarray(embedding, dtype=np.float32), k=num_results
+        )
+        # Convert cosine distance to similarity
+        return labels[0].astype(np.int64), 1 - distances[0]
+
+    def save(self, filename):
+        self.db.save_index(filename)
+        deleted_filename = get_deleted_filename(filename)
+        if len(self.deleted) > 0:
+            with open(deleted_filename, "wb") as f:
+                np.save(f, np.array(sorted(self.deleted), dtype=np.int64))
+        else:
+            safe_remove(deleted_filename)
+
+    def write(self, filename):
+        temp_filename = f"{filename}.tmp"
+        self.save(temp_filename)
+        if len(self.deleted) > 0:
+            os.replace(
+                get_deleted_filename(temp_filename), get_deleted_filename(filename)
+            )
+        else:
+            safe_remove(get_deleted_filename(filename))
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def read_deleted(cls, filename):
+        deleted_filename = get_deleted_filename(filename)
+        if not os.path.exists(deleted_filename):
+            return np.zeros(0, dtype=np.int64)
+        return np.load(deleted_filename)
+
+    @classmethod
+    def load(cls, filename, num_dimensions):
+        index = cls(num_dimensions, filename=filename)
+        index.deleted = set(cls.read_deleted(filename).tolist())
+        return index
+
+    @classmethod
+    def get_num_items(cls, filename, num_dimensions):
+        # The item count is the third field of hnswlib's header, after the
+        # level 0 offset and the capacity
+        with open(filename, "rb") as f:
+            _, _, num_items = struct.unpack("<QQQ", f.read(24))
+        return num_items - len(cls.read_deleted(filename))
+
+    def __len__(self):
+        return self.db.element_count - len(self.deleted)
+
+    @property
+    def nbytes(self):
+        return self.db.index_file_size()
+
+
+def hnswlib_installed():
+    try:
+        import hnswlib  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+index_backends = {
+    "annoy": AnnoyVectorIndex,
+    "hnsw": HNSWVectorIndex,
+    "exact": ExactVectorIndex,
+}
+
+
+def create_index(backend, num_dimensions, num_annoy_trees=100):
+    if backend == "annoy":
+        return AnnoyVectorIndex(num_dimensions, num_annoy_trees)
+    return index_backends[backend](num_dimensions)
+
+
+def load_index(backend, filename, num_dimensions):
+    return index_backends[backend].load(filename, num_dimensions)
+
+
+def get_num_index_items(backend, filename, num_dimensions):
+    return index_backends[backend].get_num_items(filename, num_dimensions)
+
+
+def write_index_from_file(
+    backend, filename, embeddings_filename, num_dimensions, num_annoy_trees
+):
+    # Build from the memory-mapped embeddings file rather than a copy in memory
+    embeddings, _ = memmap_embeddings_file(
+        embeddings_filename,
+        num_dimensions,
+        get_num_embeddings(embeddings_filename, num_dimensions),
+    )
+    index = create_index(backend, num_dimensions, num_annoy_trees)
+    index.build([embeddings])
+    index.write(filename)
+    index.close()
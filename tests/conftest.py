@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Semantra's modules import each other by name, as when run from their folder
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "semantra")
+)
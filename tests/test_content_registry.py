@@ -0,0 +1,39 @@
+from corpus import ContentRegistry
+
+
+class FakeContent:
+    def __init__(self, filename):
+        self.filename = filename
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDocument:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def open_content(self):
+        return FakeContent(self.filename)
+
+
+def test_evicted_contents_close_after_their_last_lease():
+    contents = ContentRegistry(max_open=1)
+    first, second = FakeDocument("first.pdf"), FakeDocument("second.pdf")
+
+    with contents.lease(first) as content:
+        contents.retain(content)
+        # Opening another document evicts the first, which is still in use
+        with contents.lease(second) as other:
+            assert not content.closed
+        contents.release(content)
+        assert not content.closed
+    assert content.closed
+
+    # Evicting an unused content closes it straight away
+    with contents.lease(first) as reopened:
+        assert reopened is not content
+    assert other.closed
+    contents.close_all()
+    assert reopened.closed
@@ -0,0 +1,148 @@
+import functools
+import sys
+
+import numpy as np
+import pytest
+
+from search import CorpusAnnIndex, search_embeddings
+from vectorindex import (
+    create_index,
+    get_num_index_items,
+    hnswlib_installed,
+    load_index,
+)
+
+NUM_DIMENSIONS = 32
+
+BACKENDS = [
+    "annoy",
+    pytest.param(
+        "hnsw",
+        marks=pytest.mark.skipif(
+            not hnswlib_installed(), reason="hnswlib is not installed"
+        ),
+    ),
+]
+
+
+class Document:
+    def __init__(self, filename, embeddings, version=0):
+        self.filename = filename
+        self.embeddings = embeddings
+        self.num_embeddings = len(embeddings)
+        self.embeddings_filenames = [f"{filename}.{version}.embeddings"]
+
+
+def make_documents(rng, sizes):
+    return {
+        f"{i}.txt": Document(
+            f"{i}.txt", rng.normal(size=(size, NUM_DIMENSIONS)).astype(np.float32)
+        )
+        for i, size in enumerate(sizes)
+    }
+
+
+def make_corpus_index(backend, filename):
+    return CorpusAnnIndex(
+        functools.partial(create_index, backend, NUM_DIMENSIONS, 10),
+        filename=filename,
+        load_index=functools.partial(
+            load_index, backend, num_dimensions=NUM_DIMENSIONS
+        ),
+    )
+
+
+def exact_results(documents, query, num_results):
+    results = [
+        (document.filename, index, distance)
+        for document in documents.values()
+        for index, distance in search_embeddings(
+            document.embeddings, query, num_results
+        )
+    ]
+    results.sort(key=lambda result: result[2], reverse=True)
+    return results[:num_results]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_restore_keeps_unchanged_documents(tmp_path, backend):
+    rng = np.random.default_rng(0)
+    documents = make_documents(rng, [50, 80, 30])
+    filename = str(tmp_path / f"corpus.{backend}")
+
+    corpus_index = make_corpus_index(backend, filename)
+    assert not corpus_index.restore(documents)
+    corpus_index.update()
+
+    # Change one document, remove another and add a new one
+    documents["1.txt"] = Document(
+        "1.txt", rng.normal(size=(60, NUM_DIMENSIONS)).astype(np.float32), 1
+    )
+    del documents["2.txt"]
+    documents["3.txt"] = make_documents(rng, [0, 0, 0, 40])["3.txt"]
+
+    corpus_index = make_corpus_index(backend, filename)
+    assert corpus_index.restore(documents)
+    assert set(corpus_index.ranges) == {"0.txt"}
+    assert set(corpus_index.pending) == {"1.txt", "3.txt"}
+
+    # Searches are exact for documents not indexed yet, and never return
+    # windows of the removed or replaced documents
+    query = documents["1.txt"].embeddings[5]
+    results = corpus_index.search(query, 5)
+    assert results[0][:2] == ("1.txt", 5)
+    for document_results in (
+        results,
+        corpus_index.search(documents["0.txt"].embeddings[7], 5),
+    ):
+        for filename_, index, _ in document_results:
+            assert index < documents[filename_].num_embeddings
+
+    # Annoy indexes are only rebuilt once enough has changed
+    corpus_index.update()
+    if backend == "hnsw":
+        assert set(corpus_index.ranges) == set(documents)
+    query = documents["3.txt"].embeddings[3]
+    assert corpus_index.search(query, 1)[0][:2] == ("3.txt", 3)
+    expected = exact_results(documents, query, 5)
+    assert [result[:2] for result in corpus_index.search(query, 5)] == [
+        result[:2] for result in expected
+    ]
+
+
+@pytest.mark.skipif(not hnswlib_installed(), reason="hnswlib is not installed")
+def test_hnsw_deletions_are_saved(tmp_path):
+    rng = np.random.default_rng(1)
+    embeddings = rng.normal(size=(100, NUM_DIMENSIONS)).astype(np.float32)
+    index = create_index("hnsw", NUM_DIMENSIONS)
+    index.build([embeddings])
+    index.remove(np.arange(10))
+    filename = str(tmp_path / "index.hnsw")
+    index.write(filename)
+
+    assert get_num_index_items("hnsw", filename, NUM_DIMENSIONS) == 90
+    index = load_index("hnsw", filename, NUM_DIMENSIONS)
+    assert len(index) == 90
+    # Asking for more items than are left returns all of them
+    ids, _ = index.search(embeddings[0], 200)
+    assert sorted(ids.tolist()) == list(range(10, 100))
+
+
+def test_annoy_search_skips_removed_items():
+    rng = np.random.default_rng(2)
+    embeddings = rng.normal(size=(1000, NUM_DIMENSIONS)).astype(np.float32)
+    index = create_index("annoy", NUM_DIMENSIONS, num_annoy_trees=10)
+    index.build([embeddings])
+    index.remove(np.arange(900))
+
+    # Results are only made of the items left, however many were removed
+    ids, _ = index.search(embeddings[950], 10)
+    assert len(ids) == 10
+    assert ids[0] == 950
+    assert all(id >= 900 for id in ids.tolist())
+
+
+def test_hnsw_requires_hnswlib(monkeypatch):
+    monkeypatch.setitem(sys.modules, "hnswlib", None)
+    with pytest.raises(ImportError, match=r"pip install semantra\[hnsw\]"):
+        create_index("hnsw", NUM_DIMENSIONS)
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+
+SEMANTRA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "src", "semantra"
+)
+
+HEAVY_MODULES = ["torch", "transformers", "openai", "tiktoken", "PyQt5"]
+
+# Records any attempt to import a heavy module, whether or not it is installed
+CHECK_IMPORTS = """
+import sys
+
+heavy_modules = {heavy_modules!r}
+attempted = []
+
+
+class RecordHeavyImports:
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in heavy_modules:
+            attempted.append(name)
+        return None
+
+
+sys.meta_path.insert(0, RecordHeavyImports())
+import semantra
+
+print(sorted(set(attempted) | (set(heavy_modules) & set(sys.modules))))
+"""
+
+
+def test_import_does_not_load_model_backends():
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK_IMPORTS.format(heavy_modules=HEAVY_MODULES)],
+        cwd=SEMANTRA_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "[]"
+
+
+if __name__ == "__main__":
+    # Benchmark CLI startup, each run in a fresh interpreter:
+    # python tests/test_imports.py
+    import time
+
+    for name, args in [
+        ("import semantra", ["-c", "import semantra"]),
+        ("semantra --version", ["semantra.py", "--version"]),
+        ("semantra --list-models", ["semantra.py", "--list-models"]),
+    ]:
+        timings = []
+        for _ in range(5):
+            started_at = time.perf_counter()
+            subprocess.run(
+                [sys.executable, *args],
+                cwd=SEMANTRA_DIR,
+                capture_output=True,
+                check=True,
+            )
+            timings.append(time.perf_counter() - started_at)
+        print(f"{name}: {min(timings):.3f}s")
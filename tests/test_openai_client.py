@@ -0,0 +1,98 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+pytest.importorskip("aiohttp")
+openai = pytest.importorskip("openai")
+pytest.importorskip("openai.error")
+
+from openai_client import AsyncEmbeddingClient, parse_duration
+
+RATE_LIMIT_RESET = 0.3
+
+
+class StubEmbeddingsHandler(BaseHTTPRequestHandler):
+    """Rate limits the first request, then embeds each input as [first token,
+    number of tokens], listing the embeddings in reverse."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.num_requests += 1
+            rate_limited = server.num_requests == 1
+        if rate_limited:
+            self.respond(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                {
+                    "x-ratelimit-remaining-requests": "0",
+                    "x-ratelimit-reset-requests": f"{int(RATE_LIMIT_RESET * 1000)}ms",
+                },
+            )
+            return
+        data = [
+            {"object": "embedding", "index": i, "embedding": [tokens[0], len(tokens)]}
+            for i, tokens in enumerate(body["input"])
+        ]
+        self.respond(200, {"object": "list", "data": data[::-1]})
+
+    def respond(self, status, body, headers={}):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubEmbeddingsHandler)
+    server.lock = threading.Lock()
+    server.num_requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(openai, "api_base", f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(openai, "api_key", "test")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_rate_limit_and_keeps_order(stub_server):
+    client = AsyncEmbeddingClient(
+        "text-embedding-ada-002",
+        max_concurrency=4,
+        inputs_per_request=3,
+        initial_backoff=0.01,
+    )
+    inputs = [[i] * (i % 4 + 1) for i in range(10)]
+
+    started_at = time.monotonic()
+    embeddings = client.embed(inputs)
+
+    # The first request is retried after the reset the 429 asked for, and
+    # every embedding comes back in the order of the inputs
+    assert time.monotonic() - started_at >= RATE_LIMIT_RESET
+    assert stub_server.num_requests == 4 + 1
+    assert client.limiter.paused_until >= started_at + RATE_LIMIT_RESET
+    np.testing.assert_array_equal(
+        embeddings, [[tokens[0], len(tokens)] for tokens in inputs]
+    )
+
+
+def test_parse_duration():
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("1.5s") == 1.5
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("2") == 2
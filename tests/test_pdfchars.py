@@ -0,0 +1,118 @@
+import os
+import struct
+
+import pytest
+
+pytest.importorskip("pypdfium2")
+
+from pdf import LINE_FEED, PDFContent, extract_pdf_content
+from pdfchars import PDFChars
+from util import get_converted_pdf_txt_filename, get_pdf_chars_filename
+
+# Maps "A" to U+1D400 MATHEMATICAL BOLD CAPITAL A, outside the BMP
+TO_UNICODE = b"""/CIDInit /ProcSet findresource begin
+12 dict begin
+begincmap
+/CMapName /Test def
+1 begincodespacerange
+<00> <FF>
+endcodespacerange
+3 beginbfchar
+<41> <D835DC00>
+<62> <0062>
+<20> <0020>
+endbfchar
+endcmap
+CMapName currentdict /CMap defineresource pop
+end
+end"""
+
+
+def stream(data):
+    return b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+
+
+def make_pdf(text):
+    # A one-page PDF showing `text` in Helvetica with the map above
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R"
+        b" /Resources << /Font << /F1 5 0 R >> >> >>",
+        stream(b"BT /F1 24 Tf 72 720 Td (" + text + b") Tj ET"),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /ToUnicode 6 0 R >>",
+        stream(TO_UNICODE),
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + obj + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    pdf += b"startxref\n%d\n%%%%EOF\n" % xref
+    return pdf
+
+
+def decode_page_binary(data):
+    # Inverse of PDFChars.get_page_binary, as the client decodes it
+    (num_chars,) = struct.unpack_from("<I", data)
+    offsets_start = 4 + num_chars * 16
+    offsets = struct.unpack_from(f"<{num_chars + 1}I", data, offsets_start)
+    text = data[offsets_start + (num_chars + 1) * 4 :]
+    return [text[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(num_chars)]
+
+
+@pytest.fixture
+def pdf_filename(tmp_path):
+    filename = str(tmp_path / "non_bmp.pdf")
+    with open(filename, "wb") as f:
+        f.write(make_pdf(b"Ab bA"))
+    return filename
+
+
+def test_non_bmp_chars_line_up_with_text(tmp_path, pdf_filename):
+    semantra_dir = str(tmp_path / "semantra")
+    os.makedirs(semantra_dir)
+    extract_pdf_content("md5", pdf_filename, semantra_dir, False, True)
+
+    with open(
+        os.path.join(semantra_dir, get_converted_pdf_txt_filename("md5")),
+        newline="",
+        encoding="utf-8",
+    ) as f:
+        (page_text,) = f.read().split(LINE_FEED)[:-1]
+    assert page_text == "\U0001d400b b\U0001d400"
+
+    chars = PDFChars(os.path.join(semantra_dir, get_pdf_chars_filename("md5")))
+    try:
+        # One char (and box) per character of the text, so that char indices
+        # are text offsets
+        page_chars = chars.get_page_chars(0)
+        assert [char for char, _ in page_chars] == list(page_text)
+        assert decode_page_binary(chars.get_page_binary(0)) == list(page_text)
+        # The joined surrogates span a real glyph
+        left, bottom, right, top = page_chars[0][1]
+        assert right > left and top > bottom
+    finally:
+        chars.close()
+
+
+def test_chars_sidecar_is_written_on_first_use(tmp_path, pdf_filename):
+    semantra_dir = str(tmp_path / "semantra")
+    os.makedirs(semantra_dir)
+    assert extract_pdf_content("md5", pdf_filename, semantra_dir, False, True)
+    chars_filename = os.path.join(semantra_dir, get_pdf_chars_filename("md5"))
+
+    # Extractions from before the sidecar existed aren't redone
+    os.remove(chars_filename)
+    assert extract_pdf_content("md5", pdf_filename, semantra_dir, False, True) is None
+
+    content = PDFContent(None, pdf_filename, [], chars_filename)
+    try:
+        assert content.get_page_chars(0)[0][0] == "\U0001d400"
+        assert os.path.exists(chars_filename)
+    finally:
+        content.close()
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from quantize import (
+    QUANTIZE_TYPES,
+    get_num_quantized_embeddings,
+    read_quantized_embeddings_file,
+    write_quantized_embeddings_file,
+)
+from search import ExactSearchIndex
+from util import memmap_embeddings_file, write_embeddings
+
+NUM_DIMENSIONS = 384
+NUM_RESULTS = 10
+
+
+class Document:
+    def __init__(self, embeddings, quantized_embeddings):
+        self.embeddings = embeddings
+        self.quantized_embeddings = quantized_embeddings
+
+
+def make_documents(tmp_path, quantize, sizes, rng):
+    # Clustered embeddings, so that near neighbors are close calls
+    centers = rng.normal(size=(100, NUM_DIMENSIONS))
+    documents = {}
+    for i, size in enumerate(sizes):
+        embeddings = centers[rng.integers(0, len(centers), size)]
+        embeddings = embeddings + 0.7 * rng.normal(size=(size, NUM_DIMENSIONS))
+        embeddings_filename = str(tmp_path / f"{i}.embeddings")
+        with open(embeddings_filename, "wb") as f:
+            write_embeddings(f, embeddings)
+        quantized_filename = str(tmp_path / f"{i}.{quantize}.embeddings")
+        write_quantized_embeddings_file(
+            quantized_filename, embeddings_filename, NUM_DIMENSIONS, quantize
+        )
+        assert (
+            get_num_quantized_embeddings(quantized_filename, NUM_DIMENSIONS, quantize)
+            == size
+        )
+        documents[f"file{i}"] = Document(
+            memmap_embeddings_file(embeddings_filename, NUM_DIMENSIONS, size)[0],
+            read_quantized_embeddings_file(
+                quantized_filename, NUM_DIMENSIONS, quantize
+            ),
+        )
+    return documents, centers
+
+
+@pytest.mark.parametrize("quantize", QUANTIZE_TYPES)
+def test_quantized_search_recall(tmp_path, quantize):
+    rng = np.random.default_rng(0)
+    documents, centers = make_documents(tmp_path, quantize, [3000, 12000, 0, 5], rng)
+    exact_index = ExactSearchIndex()
+    quantized_index = ExactSearchIndex(quantized=True)
+
+    global_overlaps = []
+    for _ in range(50):
+        query = centers[rng.integers(0, len(centers))]
+        query = query + 0.7 * rng.normal(size=NUM_DIMENSIONS)
+        exact_global, exact_per_file = exact_index.search(documents, query, NUM_RESULTS)
+        global_results, per_file_results = quantized_index.search(
+            documents, query, NUM_RESULTS
+        )
+        global_overlaps.append(
+            len(
+                {(filename, index) for filename, index, _ in exact_global}
+                & {(filename, index) for filename, index, _ in global_results}
+            )
+            / NUM_RESULTS
+        )
+        for filename, exact_results in exact_per_file.items():
+            results = per_file_results[filename]
+            assert len(results) == len(exact_results)
+            # Re-ranked distances are full precision
+            exact_distances = dict(exact_results)
+            for index, distance in results:
+                if index in exact_distances:
+                    assert distance == pytest.approx(exact_distances[index], abs=1e-5)
+
+    # Top-k overlap with exact float32 search
+    assert np.mean(global_overlaps) >= 0.99
@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+
+from models import BaseModel
+from semantra import process_streaming
+
+NUM_DIMENSIONS = 8
+WINDOWS = [(16, 0, 4)]
+
+
+class ByteModel(BaseModel):
+    """Tokenizes text into bytes and embeds a window as its byte histogram."""
+
+    def get_num_dimensions(self):
+        return NUM_DIMENSIONS
+
+    def get_tokens(self, text):
+        return list(text.encode())
+
+    def get_token_length(self, tokens):
+        return len(tokens)
+
+    def get_text_chunks(self, text, tokens):
+        return [chr(token) for token in tokens]
+
+    def get_config(self):
+        return {"model_type": "bytes"}
+
+    def embed_batch(self, items, is_query=False):
+        embeddings = np.zeros((len(items), NUM_DIMENSIONS), dtype=np.float32)
+        for row, (tokens, (i, j)) in enumerate(items):
+            for token in tokens[i:j]:
+                embeddings[row, token % NUM_DIMENSIONS] += 1
+        return embeddings
+
+    def get_window_bytes(self, tokens, offset):
+        return np.asarray(tokens[offset[0] : offset[1]], dtype=np.uint32).tobytes()
+
+    def get_token_ids(self, tokens):
+        return np.asarray(tokens, dtype=np.uint32)
+
+    def get_tokens_from_ids(self, token_ids):
+        return np.asarray(token_ids).tolist()
+
+    def slice_tokens(self, tokens, start, end):
+        return tokens[start:end]
+
+    def concat_tokens(self, tokens, other_tokens):
+        return tokens + other_tokens
+
+
+def embed_streaming(filename, semantra_dir):
+    return process_streaming(
+        filename=filename,
+        semantra_dir=semantra_dir,
+        model=ByteModel(),
+        num_dimensions=NUM_DIMENSIONS,
+        use_index=False,
+        index_backend="annoy",
+        num_annoy_trees=1,
+        windows=WINDOWS,
+        cost_per_token=None,
+        pool_count=None,
+        pool_size=64,
+        force=False,
+        silent=True,
+        no_confirm=True,
+        encoding="utf-8",
+    )
+
+
+def test_resume_after_partly_written_row(tmp_path):
+    filename = str(tmp_path / "text.txt")
+    with open(filename, "w") as f:
+        f.write(" ".join(f"word{i}" for i in range(100)))
+
+    expected = embed_streaming(filename, str(tmp_path / "expected"))
+    (embeddings_filename,) = expected.embeddings_filenames
+    with open(embeddings_filename, "rb") as f:
+        expected_bytes = f.read()
+    row_size = NUM_DIMENSIONS * 4
+    assert len(expected_bytes) % row_size == 0
+
+    # Interrupt a run partway through writing a row
+    semantra_dir = str(tmp_path / "resumed")
+    os.makedirs(semantra_dir)
+    resumed_filename = os.path.join(semantra_dir, os.path.basename(embeddings_filename))
+    with open(resumed_filename, "wb") as f:
+        f.write(expected_bytes[: 5 * row_size + 11])
+
+    embed_streaming(filename, semantra_dir)
+    with open(resumed_filename, "rb") as f:
+        assert f.read() == expected_bytes
+
+
+def test_token_ids_are_stored_with_chunks(tmp_path):
+    filename = str(tmp_path / "text.txt")
+    text = " ".join(f"word{i}" for i in range(100))
+    with open(filename, "w") as f:
+        f.write(text)
+
+    document = embed_streaming(filename, str(tmp_path / "semantra"))
+    text_chunks = document.text_chunks
+    assert text_chunks.token_ids(0, len(text_chunks)).tolist() == list(text.encode())
+    assert text_chunks.token_ids(5, 9).tolist() == list(text[5:9].encode())
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from transformer_model import TransformerModel
+
+
+def get_text_chunks_loop(text, tokens):
+    # The per-token loop get_text_chunks replaced
+    offsets = tokens["offset_mapping"][0]
+    chunks = []
+    prev_i = None
+    prev_j = None
+    for i, j in offsets:
+        new_i = prev_j if i == j else i
+        if prev_i is not None:
+            chunks.append(text[prev_i:new_i])
+        if prev_i is None:
+            prev_i = 0
+        elif new_i > prev_i:
+            prev_i = new_i
+        if prev_j is None:
+            prev_j = j
+        elif j > prev_j:
+            prev_j = j
+    chunks.append(text[0 if prev_i is None else prev_i :])
+    return chunks
+
+
+def get_text_chunks(text, offsets):
+    tokens = {"offset_mapping": [np.array(offsets, dtype=np.int64).reshape(-1, 2)]}
+    chunks = TransformerModel.get_text_chunks(None, text, tokens)
+    assert chunks == get_text_chunks_loop(text, tokens)
+    return chunks
+
+
+def test_special_and_multibyte_tokens():
+    text = "hé 👋 語"
+    # Like a byte-level tokenizer: special tokens are zero-width, and each
+    # character outside ASCII is one token per UTF-8 byte with its offsets
+    offsets = [(0, 0), (0, 1), (1, 2), (1, 2), (2, 3)]
+    offsets += [(3, 4)] * 4 + [(4, 5)] + [(5, 6)] * 3 + [(6, 6)]
+    chunks = get_text_chunks(text, offsets)
+    assert chunks == ["", "h", "", "é", " ", "", "", "", "👋", " ", "", "", "語", ""]
+    assert "".join(chunks) == text
+
+
+def test_zero_width_tokens_mid_text():
+    text = "one two three"
+    offsets = [(0, 0), (0, 3), (3, 3), (4, 7), (7, 7), (7, 7), (8, 13), (13, 13)]
+    chunks = get_text_chunks(text, offsets)
+    assert chunks == ["", "one", " ", "two", "", " ", "three", ""]
+
+
+def test_empty_offsets():
+    assert get_text_chunks("text", []) == ["text"]
+
+
+def test_random_offsets_match_loop():
+    rng = np.random.default_rng(0)
+    text = "".join(rng.choice(list("ab é👋語 "), size=200))
+    for _ in range(500):
+        num_tokens = int(rng.integers(1, 40))
+        starts = np.sort(rng.integers(0, len(text), num_tokens))
+        lengths = rng.integers(0, 4, num_tokens)
+        # Some tokens are zero-width, as special tokens are
+        lengths[rng.random(num_tokens) < 0.2] = 0
+        offsets = np.stack([starts, np.minimum(starts + lengths, len(text))], axis=1)
+        get_text_chunks(text, offsets)
+
+
+if __name__ == "__main__":
+    # Benchmark against the loop on a million tokens:
+    # PYTHONPATH=src/semantra python tests/test_text_chunks.py
+    import timeit
+
+    rng = np.random.default_rng(0)
+    text = "".join(rng.choice(list("ab é👋語 "), size=1_000_000))
+    starts = np.arange(len(text))
+    lengths = np.ones(len(text), dtype=np.int64)
+    lengths[rng.random(len(text)) < 0.1] = 0
+    offsets = np.stack([starts, starts + lengths], axis=1)
+    tokens = {"offset_mapping": [offsets]}
+
+    assert TransformerModel.get_text_chunks(None, text, tokens) == (
+        get_text_chunks_loop(text, tokens)
+    )
+    for name, function in [
+        ("loop", lambda: get_text_chunks_loop(text, tokens)),
+        ("vectorized", lambda: TransformerModel.get_text_chunks(None, text, tokens)),
+    ]:
+        seconds = min(timeit.repeat(function, number=1, repeat=3))
+        print(f"{name}: {seconds:.3f}s")